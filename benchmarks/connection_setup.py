@@ -0,0 +1,76 @@
+"""Benchmark LDAP connection setup time for each ``GET_INFO`` mode.
+
+Opens and binds a number of connections to a real directory server with
+each ldap3 ``get_info`` setting, plus a server with a preloaded schema
+snapshot (as used with ``SCHEMA_FILE`` / ``SCHEMA_CACHE_ALIAS``), and
+reports setup time per connection.  Usage::
+
+    python benchmarks/connection_setup.py ldap.example.edu \\
+        [--bind-dn DN --password PASSWORD] [--repeat 20] [--no-ssl]
+"""
+
+import argparse
+import statistics
+import time
+
+import ldap3
+
+
+def time_connections(host, get_info, repeat, use_ssl, schema=None,
+                     **bind_args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        server = ldap3.Server(host, get_info=get_info, use_ssl=use_ssl)
+        if schema is not None:
+            server.attach_schema_info(schema)
+        conn = ldap3.Connection(server, auto_bind=True, **bind_args)
+        timings.append(time.perf_counter() - start)
+        conn.unbind()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('host')
+    parser.add_argument('--bind-dn')
+    parser.add_argument('--password')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--no-ssl', action='store_true')
+    args = parser.parse_args()
+
+    bind_args = {}
+    if args.bind_dn and args.password:
+        bind_args = {'user': args.bind_dn, 'password': args.password}
+    use_ssl = not args.no_ssl
+
+    # read schema once, as a snapshot would
+    conn = ldap3.Connection(
+        ldap3.Server(args.host, get_info=ldap3.SCHEMA, use_ssl=use_ssl),
+        auto_bind=True, **bind_args)
+    schema = conn.server.schema
+    conn.unbind()
+
+    modes = [
+        ('ALL', ldap3.ALL, None),
+        ('SCHEMA', ldap3.SCHEMA, None),
+        ('DSA', ldap3.DSA, None),
+        ('NONE', ldap3.NONE, None),
+        ('NONE + snapshot', ldap3.NONE, schema),
+    ]
+    results = {}
+    print('%-16s %10s %10s %10s' % ('mode', 'mean ms', 'median ms', 'max ms'))
+    for label, get_info, snapshot in modes:
+        timings = time_connections(args.host, get_info, args.repeat, use_ssl,
+                                   schema=snapshot, **bind_args)
+        results[label] = statistics.mean(timings)
+        print('%-16s %10.1f %10.1f %10.1f' % (
+            label, results[label] * 1000, statistics.median(timings) * 1000,
+            max(timings) * 1000))
+
+    saved = results['ALL'] - results['NONE + snapshot']
+    print('\nTime saved per connection vs ALL: %.1f ms' % (saved * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""Benchmark pucas lookup and provisioning paths against a fake directory.
+
+Runs entirely in process: Django is configured with an in-memory SQLite
+database, and LDAP connections are replaced with an indexed fake
+directory seeded with ``--entries`` users (or ldap3's ``MOCK_SYNC``
+strategy with ``--mock-sync``, which is much slower for large
+directories since it evaluates filters against every entry).  Each
+search and bind can be delayed by ``--latency`` milliseconds to
+simulate a remote server.
+
+Scenarios: single ``find_user`` lookups, ``init_cas_user``, the CAS
+login signal for new users, the admin **Add CAS Users** view, and
+``createcasuser --from-file`` with a large roster.  Reports throughput,
+p50/p99 latency, and database query, LDAP bind and search counts for
+each.  Usage::
+
+    python benchmarks/hot_paths.py [--entries 20000] [--iterations 500]
+        [--roster 10000] [--latency 2] [--workers 4] [--cache]
+"""
+
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import django  # noqa: E402
+import ldap3  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+FILTER_TERM_RE = re.compile(r'\((\w+)=([^()*]+)\)')
+NETID_ATTR = 'uid'
+SEARCH_BASE = 'ou=people,o=example'
+
+
+def netid(i):
+    return 'u%06d' % i
+
+
+def make_attributes(i):
+    return {
+        'uid': [netid(i)],
+        'givenName': ['Given%d' % i],
+        'sn': ['Surname%d' % i],
+        'mail': ['%s@example.edu' % netid(i)],
+        'title': ['Title %d' % (i % 50)],
+        'objectClass': ['person'],
+    }
+
+
+class Stats(object):
+    binds = 0
+    searches = 0
+
+
+class FakeConnection(object):
+    '''Stand-in for an ldap3 connection, supporting the equality and OR
+    filters pucas generates, attribute selection and paged results.'''
+
+    def __init__(self, directory, latency):
+        self.directory = directory
+        self.latency = latency
+        self.closed = False
+        self.bound = True
+        self.entries = []
+        self.result = {}
+        self.server = None
+        time.sleep(latency)
+        Stats.binds += 1
+
+    def search(self, search_base, search_filter, attributes=None,
+               paged_size=None, paged_cookie=None):
+        from pucas.entry import DirectoryEntry
+
+        time.sleep(self.latency)
+        Stats.searches += 1
+        matches = []
+        for attr, value in FILTER_TERM_RE.findall(search_filter):
+            if attr.lower() == NETID_ATTR:
+                entry = self.directory.get(value.lower())
+                if entry is not None:
+                    matches.append(entry)
+        start = int(paged_cookie or 0)
+        end = start + paged_size if paged_size else len(matches)
+        cookie = str(end).encode() if end < len(matches) else b''
+
+        if attributes == '*':
+            wanted = None
+        else:
+            wanted = set(attr.lower() for attr in attributes or [])
+        self.entries = [
+            DirectoryEntry(dn, {key: val for key, val in attrs.items()
+                                if wanted is None or key.lower() in wanted})
+            for dn, attrs in matches[start:end]]
+        self.result = {'controls': {'1.2.840.113556.1.4.319': {
+            'value': {'cookie': cookie}}}}
+        return bool(self.entries)
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+
+def fake_directory(size):
+    return {netid(i): ('uid=%s,%s' % (netid(i), SEARCH_BASE),
+                       make_attributes(i))
+            for i in range(size)}
+
+
+def mock_sync_server(size):
+    server = ldap3.Server('fake')
+    conn = ldap3.Connection(server, user='cn=admin', password='secret',
+                            client_strategy=ldap3.MOCK_SYNC)
+    conn.strategy.add_entry('cn=admin', {'userPassword': 'secret'})
+    for i in range(size):
+        conn.strategy.add_entry('uid=%s,%s' % (netid(i), SEARCH_BASE),
+                                make_attributes(i))
+    return server
+
+
+def connection_factory(args):
+    if args.mock_sync:
+        server = mock_sync_server(args.entries)
+
+        def create_connection():
+            time.sleep(args.latency / 1000)
+            conn = ldap3.Connection(server, user='cn=admin', password='secret',
+                                    client_strategy=ldap3.MOCK_SYNC)
+            conn.bind()
+            Stats.binds += 1
+            search = conn.search
+
+            def delayed_search(*search_args, **kwargs):
+                time.sleep(args.latency / 1000)
+                Stats.searches += 1
+                return search(*search_args, **kwargs)
+
+            conn.search = delayed_search
+            return conn
+        return create_connection
+
+    directory = fake_directory(args.entries)
+    return lambda: FakeConnection(directory, args.latency / 1000)
+
+
+def configure(args):
+    pucas_ldap = {
+        'SERVERS': ['fake'],
+        'SEARCH_BASE': SEARCH_BASE,
+        'SEARCH_FILTER': '(uid=%(user)s)',
+        'ATTRIBUTE_MAP': {
+            'first_name': 'givenName',
+            'last_name': 'sn',
+            'email': ['mail', 'eduPersonPrincipalName'],
+        },
+        'MAX_CONCURRENCY': args.workers,
+    }
+    if args.cache:
+        pucas_ldap['CACHE'] = {'BACKEND': 'local',
+                               'MAX_ENTRIES': args.entries}
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.admin',
+            'django.contrib.messages',
+            'django.contrib.sessions',
+            'django_cas_ng',
+            'pucas',
+        ],
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+        }],
+        ROOT_URLCONF='pucas.cas_urls',
+        SECRET_KEY='benchmark',
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        PUCAS_LDAP=pucas_ldap,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+    import pucas.ldap
+    pucas.ldap.create_connection = connection_factory(args)
+    pucas.ldap.reset_connection_pool()
+
+
+def percentile(timings, pct):
+    if len(timings) == 1:
+        return timings[0]
+    return statistics.quantiles(timings, n=100, method='inclusive')[pct - 1]
+
+
+class Scenario(object):
+    '''Measure a scenario: per-operation timings plus database query,
+    LDAP bind and search counts.'''
+
+    def __init__(self, name, ops_label='ops'):
+        self.name = name
+        self.ops_label = ops_label
+        self.timings = []
+        self.items = 0
+
+    def __enter__(self):
+        from django.contrib.auth import get_user_model
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        get_user_model().objects.all().delete()
+        # measure steady state: connections already pooled
+        self.binds, self.searches = Stats.binds, Stats.searches
+        self.queries = CaptureQueriesContext(connection)
+        self.queries.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def time(self, func, *args, items=1, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings.append(time.perf_counter() - start)
+        self.items += items
+        return result
+
+    def __exit__(self, *exc_info):
+        self.total = time.perf_counter() - self.start
+        self.queries.__exit__(*exc_info)
+        if exc_info[0] is None:
+            self.report()
+
+    def report(self):
+        print('%-22s %7d %10.1f %9.2f %9.2f %8d %6d %8d' % (
+            self.name, self.items, self.items / self.total,
+            percentile(self.timings, 50) * 1000,
+            percentile(self.timings, 99) * 1000,
+            len(self.queries), Stats.binds - self.binds,
+            Stats.searches - self.searches))
+
+
+def run(args):
+    from django.contrib.auth import get_user_model
+    from django.contrib.admin.sites import AdminSite
+    from django.contrib.messages.storage.cookie import CookieStorage
+    from django.core.management import call_command
+    from django.test import RequestFactory
+    from django_cas_ng.signals import cas_user_authenticated
+
+    from pucas.admin import CasUserAdmin
+    from pucas.cache import invalidate_entry_cache
+    from pucas.ldap import LDAPSearch, init_cas_user
+
+    User = get_user_model()
+    rand = random.Random(args.seed)
+
+    def sample(count):
+        return [netid(i) for i in rand.sample(range(args.entries), count)]
+
+    print('%-22s %7s %10s %9s %9s %8s %6s %8s' % (
+        'scenario', 'items', 'items/s', 'p50 ms', 'p99 ms', 'queries',
+        'binds', 'searches'))
+
+    # warm up the connection pool, so binds measure reconnects only
+    LDAPSearch().close()
+
+    with Scenario('find_user') as scenario:
+        ldap = LDAPSearch()
+        for user in sample(args.iterations):
+            scenario.time(ldap.find_user, user)
+        ldap.close()
+
+    invalidate_entry_cache()
+    with Scenario('init_cas_user') as scenario:
+        for user in sample(args.iterations):
+            scenario.time(init_cas_user, user)
+
+    invalidate_entry_cache()
+
+    def login(username):
+        # as django-cas-ng's backend does for a new user
+        user, created = User.objects.get_or_create(username=username)
+        cas_user_authenticated.send(sender='benchmark', user=user,
+                                    created=created, username=username,
+                                    attributes={}, request=None,
+                                    ticket='ST-1', service='/')
+
+    with Scenario('cas login (new user)') as scenario:
+        for user in sample(args.iterations):
+            scenario.time(login, user)
+
+    invalidate_entry_cache()
+    admin = CasUserAdmin(User, AdminSite())
+    factory = RequestFactory()
+
+    def admin_init(netids):
+        request = factory.post('/admin/auth/user/cas-init/',
+                               data={'netids': '\n'.join(netids)})
+        request.user = User(is_active=True, is_staff=True, is_superuser=True)
+        request._messages = CookieStorage(request)
+        return admin.cas_user_init(request)
+
+    with Scenario('admin bulk init') as scenario:
+        batch = max(1, args.admin_batch)
+        for _ in range(max(1, args.iterations // batch)):
+            scenario.time(admin_init, sample(batch), items=batch)
+
+    invalidate_entry_cache()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'roster.csv')
+        with open(path, 'w') as roster:
+            roster.write('netid,staff\n')
+            for i, user in enumerate(sample(args.roster)):
+                roster.write('%s,%s\n' % (user, 'yes' if i % 10 == 0 else ''))
+        with Scenario('createcasuser roster') as scenario:
+            scenario.time(call_command, 'createcasuser', '--from-file', path,
+                          items=args.roster, stdout=StringIO(),
+                          stderr=StringIO())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=20000,
+                        help='Number of directory entries (default: 20000)')
+    parser.add_argument('--iterations', type=int, default=500,
+                        help='Operations per scenario (default: 500)')
+    parser.add_argument('--roster', type=int, default=10000,
+                        help='Roster size for createcasuser (default: 10000)')
+    parser.add_argument('--admin-batch', type=int, default=100,
+                        help='Netids per admin form submission (default: 100)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay per LDAP bind and search, in ms')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='MAX_CONCURRENCY for batched lookups')
+    parser.add_argument('--cache', action='store_true',
+                        help='Enable the local LDAP entry cache')
+    parser.add_argument('--mock-sync', action='store_true',
+                        help="Use ldap3's MOCK_SYNC strategy instead of the "
+                             'indexed fake directory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.roster = min(args.roster, args.entries)
+    args.iterations = min(args.iterations, args.entries)
+
+    configure(args)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
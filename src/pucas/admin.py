@@ -1,11 +1,15 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.admin import UserAdmin
-from django.shortcuts import redirect
+from django.db import transaction
+from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
 from django.urls import path
 
 from pucas.forms import CasUserInitForm
-from pucas.ldap import LDAPSearchException, LDAPSearch, init_cas_user
+from pucas.ldap import bulk_init_cas_users
+from pucas.models import CasUserInitJob
+from pucas.tasks import restart_stalled_job, start_init_job
 
 
 class CasUserAdmin(UserAdmin):
@@ -26,6 +30,11 @@ class CasUserAdmin(UserAdmin):
                 self.admin_site.admin_view(self.cas_user_init),
                 name="users_user_cas_init",
             ),
+            path(
+                "cas-init/<int:job_id>/",
+                self.admin_site.admin_view(self.cas_user_init_job),
+                name="users_user_cas_init_job",
+            ),
         ]
         return custom_urls + urls
 
@@ -35,24 +44,53 @@ class CasUserAdmin(UserAdmin):
             form = CasUserInitForm(request.POST)
             if form.is_valid():
                 netids = form.cleaned_data["netids"]
-                created_list = []
-                existing_list = []
-                errors = []
+                refresh = form.cleaned_data.get("refresh_existing")
+                existing = set(
+                    self.model.objects.filter(username__in=netids)
+                    .values_list("username", flat=True)
+                )
+                skipped = []
+                # only look up new netids in LDAP unless refreshing
+                if not refresh:
+                    skipped = [netid for netid in netids if netid in existing]
+                    netids = [netid for netid in netids if netid not in existing]
+                # avoid request timeouts for large submissions
+                threshold = getattr(settings, "PUCAS_LDAP", {}).get(
+                    "ADMIN_BACKGROUND_THRESHOLD", 500
+                )
+                if threshold and len(netids) > threshold:
+                    job = CasUserInitJob.objects.create(
+                        netids="\n".join(netids),
+                        refresh_existing=refresh,
+                        total=len(netids),
+                        existing_netids="\n".join(skipped),
+                        requested_by=request.user,
+                    )
+                    transaction.on_commit(lambda: start_init_job(job))
+                    self.message_user(
+                        request,
+                        "Adding %d CAS users in the background" % len(netids),
+                        messages.INFO,
+                    )
+                    return redirect("%d/" % job.pk)
 
-                ldap = LDAPSearch()
-                for netid in netids:
-                    try:
-                        user, created = init_cas_user(netid, ldap=ldap)
-                        if created:
-                            # activate accounts added by an admin directly,
-                            # overriding any EXTRA_USER_INIT that set them inactive
-                            user.is_active = True
-                            user.save()
-                            created_list.append(netid)
-                        else:
-                            existing_list.append(netid)
-                    except LDAPSearchException:
-                        errors.append(netid)
+                created_list, existing_list, errors = [], [], []
+                if netids:
+                    # activate accounts added by an admin directly,
+                    # overriding any EXTRA_USER_INIT that set them inactive
+                    # bypass cached entries when refreshing from LDAP
+                    result = bulk_init_cas_users(
+                        netids, activate_created=True, use_cache=not refresh
+                    )
+                    created_list = result.created
+                    existing_list = result.updated
+                    errors = result.not_found + result.ambiguous
+                refreshed_list = []
+                if refresh:
+                    refreshed_list = existing_list
+                    existing_list = []
+                else:
+                    existing_list = skipped + existing_list
 
                 if created_list:
                     self.message_user(
@@ -66,6 +104,12 @@ class CasUserAdmin(UserAdmin):
                         "Already exists: %s" % ", ".join(existing_list),
                         messages.INFO,
                     )
+                if refreshed_list:
+                    self.message_user(
+                        request,
+                        "Updated from LDAP: %s" % ", ".join(refreshed_list),
+                        messages.INFO,
+                    )
                 if errors:
                     self.message_user(
                         request,
@@ -88,3 +132,26 @@ class CasUserAdmin(UserAdmin):
             "admin/pucas/cas_user_init.html",
             context,
         )
+
+    def cas_user_init_job(self, request, job_id):
+        """Progress and results of a background CAS user init job;
+        reloads until the job is finished, restarting it if it has made
+        no progress for ``ADMIN_JOB_TIMEOUT`` seconds."""
+        job = get_object_or_404(CasUserInitJob, pk=job_id)
+        timeout = getattr(settings, "PUCAS_LDAP", {}).get(
+            "ADMIN_JOB_TIMEOUT", 600
+        )
+        if timeout and restart_stalled_job(job, timeout):
+            job.refresh_from_db()
+        context = dict(
+            self.admin_site.each_context(request),
+            job=job,
+            results=job.results(),
+            opts=self.model._meta,
+            title="Add CAS Users",
+        )
+        return TemplateResponse(
+            request,
+            "admin/pucas/cas_user_init_job.html",
+            context,
+        )
@@ -1,8 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PucasConfig(AppConfig):
     name = 'pucas'
+    default_auto_field = 'django.db.models.AutoField'
 
     def ready(self):
         import pucas.signals
+        from pucas.config import check_search_settings, get_plan
+
+        # validate LDAP configuration at startup, rather than on the
+        # first login
+        if hasattr(settings, 'PUCAS_LDAP'):
+            check_search_settings(settings.PUCAS_LDAP)
+            get_plan()
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from ldap3.core.exceptions import LDAPException
+
+from pucas.metrics import incr
+
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPUnavailable(LDAPException):
+    '''Raised without contacting the directory while the circuit breaker
+    is open, i.e. after repeated connection failures.'''
+    pass
+
+
+class CircuitBreaker(object):
+    '''Base class for circuit breakers around LDAP connections.
+
+    After ``failure_threshold`` consecutive failures the breaker opens,
+    and :meth:`allow` returns False for ``reset_timeout`` seconds.  After
+    that it is half-open: one caller is allowed through as a probe (and
+    another every ``reset_timeout`` seconds while probes are
+    outstanding); a success closes the breaker and a failure opens it
+    again.
+    '''
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def allow(self):
+        '''Whether a connection attempt should be made.'''
+        opened = self._opened_at()
+        if opened is None:
+            return True
+        if time.time() - opened < self.reset_timeout:
+            return False
+        return self._claim_probe()
+
+    def is_open(self):
+        '''Whether the breaker is open (or half-open), without claiming
+        a probe.'''
+        return self._opened_at() is not None
+
+    def record_success(self):
+        if self._opened_at() is not None:
+            logger.info('LDAP circuit breaker closed')
+        self._reset()
+
+    def record_failure(self):
+        failures = self._add_failure()
+        if self._opened_at() is not None or failures >= self.failure_threshold:
+            # threshold reached, or a half-open probe failed
+            if self._opened_at() is None:
+                logger.warning('LDAP circuit breaker opened after %d '
+                               'failures', failures)
+                incr('ldap.breaker.open')
+            self._open()
+
+    def _opened_at(self):
+        raise NotImplementedError
+
+    def _claim_probe(self):
+        raise NotImplementedError
+
+    def _add_failure(self):
+        raise NotImplementedError
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _reset(self):
+        raise NotImplementedError
+
+
+class LocalCircuitBreaker(CircuitBreaker):
+    '''Circuit breaker with state kept in process.'''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._probe = None
+
+    def _opened_at(self):
+        return self._opened
+
+    def _claim_probe(self):
+        with self._lock:
+            now = time.time()
+            if self._probe is None or now - self._probe >= self.reset_timeout:
+                self._probe = now
+                return True
+            return False
+
+    def _add_failure(self):
+        with self._lock:
+            self._failures += 1
+            return self._failures
+
+    def _open(self):
+        with self._lock:
+            self._opened = time.time()
+            self._probe = None
+
+    def _reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._probe = None
+
+
+class DjangoCircuitBreaker(CircuitBreaker):
+    '''Circuit breaker with state in a Django cache, shared by all
+    processes using the cache.'''
+
+    failures_key = 'pucas:breaker:failures'
+    opened_key = 'pucas:breaker:opened'
+    probe_key = 'pucas:breaker:probe'
+
+    def __init__(self, alias='default', **kwargs):
+        super().__init__(**kwargs)
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _opened_at(self):
+        return self.cache.get(self.opened_key)
+
+    def _claim_probe(self):
+        # add is atomic on shared caches, so only one process probes
+        return self.cache.add(self.probe_key, 1, self.reset_timeout)
+
+    def _add_failure(self):
+        self.cache.add(self.failures_key, 0, None)
+        try:
+            return self.cache.incr(self.failures_key)
+        except ValueError:
+            # evicted between add and incr
+            self.cache.set(self.failures_key, 1, None)
+            return 1
+
+    def _open(self):
+        self.cache.set(self.opened_key, time.time(), None)
+        self.cache.delete(self.probe_key)
+
+    def _reset(self):
+        self.cache.delete_many([self.failures_key, self.opened_key,
+                                self.probe_key])
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    '''Get the configured circuit breaker, or None if not enabled.
+
+    Configured with ``CIRCUIT_BREAKER`` in ``PUCAS_LDAP``, a dict with
+    optional keys ``FAILURE_THRESHOLD`` (consecutive failures before
+    opening; default 5), ``RESET_TIMEOUT`` (seconds before a probe is
+    allowed; default 30), ``BACKEND`` (``'local'``, the default, or
+    ``'django'`` to share state across processes) and ``CACHE_ALIAS``
+    (Django cache to use, default ``'default'``).
+    '''
+    global _breaker
+    config = getattr(settings, 'PUCAS_LDAP', {}).get('CIRCUIT_BREAKER', None)
+    if not config:
+        return None
+    with _breaker_lock:
+        if _breaker is None:
+            options = {
+                'failure_threshold': config.get('FAILURE_THRESHOLD', 5),
+                'reset_timeout': config.get('RESET_TIMEOUT', 30),
+            }
+            if config.get('BACKEND', 'local') == 'django':
+                _breaker = DjangoCircuitBreaker(
+                    alias=config.get('CACHE_ALIAS', 'default'), **options)
+            else:
+                _breaker = LocalCircuitBreaker(**options)
+        return _breaker
+
+
+def ldap_unavailable():
+    '''Whether the circuit breaker is currently open.'''
+    breaker = get_circuit_breaker()
+    return breaker is not None and breaker.is_open()
+
+
+@receiver(setting_changed)
+def breaker_settings_changed(sender, setting, **kwargs):
+    global _breaker
+    if setting == 'PUCAS_LDAP':
+        with _breaker_lock:
+            _breaker = None
@@ -0,0 +1,232 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pucas.entry import DirectoryEntry
+
+
+#: Cached value for a netid with no match in LDAP
+NOT_FOUND = object()
+
+
+def attributes_key(attributes):
+    '''Short, stable key for a set of requested LDAP attributes.'''
+    if isinstance(attributes, str):
+        attributes = [attributes]
+    names = ','.join(sorted(set(attr.lower() for attr in attributes)))
+    return hashlib.md5(names.encode('utf-8')).hexdigest()[:12]
+
+
+class EntryCache(object):
+    '''Base class for caches of LDAP entries by netid.
+
+    One entry is cached per netid, along with the set of attributes it
+    was retrieved with; lookups with a different attribute set are
+    misses.  A netid with no match is cached as :data:`NOT_FOUND` for
+    ``negative_timeout`` seconds.  Entries are stored as
+    :class:`~pucas.entry.DirectoryEntry` so they can be shared.
+    '''
+
+    def __init__(self, timeout=3600, negative_timeout=300):
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get_many(self, netids, attributes):
+        '''Return a dict of cached entries (or :data:`NOT_FOUND`) for the
+        netids that are in the cache.'''
+        attrs_key = attributes_key(attributes)
+        cached = {}
+        for netid, value in self._get_many([n.lower() for n in netids]).items():
+            if value[0] == attrs_key:
+                # stored as None, since the sentinel does not survive pickling
+                cached[netid] = NOT_FOUND if value[1] is None else value[1]
+        # map back to netids as requested
+        result = {netid: cached[netid.lower()] for netid in netids
+                  if netid.lower() in cached}
+        with self._stats_lock:
+            self.hits += len(result)
+            self.misses += len(netids) - len(result)
+        return result
+
+    def get(self, netid, attributes):
+        '''Return the cached entry, :data:`NOT_FOUND`, or None if the
+        netid is not cached.'''
+        return self.get_many([netid], attributes).get(netid)
+
+    def set_many(self, entries, attributes):
+        '''Cache a dict of netid to entry; None or :data:`NOT_FOUND`
+        records a netid that was not found.'''
+        attrs_key = attributes_key(attributes)
+        found, not_found = {}, {}
+        for netid, entry in entries.items():
+            if entry is None or entry is NOT_FOUND:
+                not_found[netid.lower()] = (attrs_key, None)
+            else:
+                found[netid.lower()] = (attrs_key,
+                                        DirectoryEntry.from_entry(entry))
+        if found:
+            self._set_many(found, self.timeout)
+        if not_found and self.negative_timeout:
+            self._set_many(not_found, self.negative_timeout)
+
+    def set(self, netid, attributes, entry):
+        self.set_many({netid: entry}, attributes)
+
+    def invalidate(self, netid=None):
+        '''Remove one netid from the cache, or everything if no netid.'''
+        raise NotImplementedError
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get_many(self, keys):
+        raise NotImplementedError
+
+    def _set_many(self, values, timeout):
+        raise NotImplementedError
+
+
+class LocalEntryCache(EntryCache):
+    '''In-process, thread-safe LRU cache with at most ``max_entries``.'''
+
+    def __init__(self, max_entries=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_many(self, keys):
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for key in keys:
+                if key not in self._data:
+                    continue
+                expires, value = self._data[key]
+                if expires < now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                result[key] = value
+        return result
+
+    def _set_many(self, values, timeout):
+        expires = time.monotonic() + timeout
+        with self._lock:
+            for key, value in values.items():
+                self._data[key] = (expires, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, netid=None):
+        with self._lock:
+            if netid is None:
+                self._data.clear()
+            else:
+                self._data.pop(netid.lower(), None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DjangoEntryCache(EntryCache):
+    '''Cache using a configured Django cache, so that entries can be
+    shared across processes.'''
+
+    key_prefix = 'pucas:ldap:'
+    version_key = 'pucas:ldap-version'
+
+    def __init__(self, alias='default', **kwargs):
+        super().__init__(**kwargs)
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version(self):
+        # clearing everything increments this version, making all
+        # previously cached entries unreachable
+        return self.cache.get_or_set(self.version_key, 1, None)
+
+    def _get_many(self, keys):
+        version = self._version()
+        result = self.cache.get_many([self.key_prefix + key for key in keys],
+                                     version=version)
+        return {key[len(self.key_prefix):]: value
+                for key, value in result.items()}
+
+    def _set_many(self, values, timeout):
+        self.cache.set_many({self.key_prefix + key: value
+                             for key, value in values.items()},
+                            timeout=timeout, version=self._version())
+
+    def invalidate(self, netid=None):
+        if netid is None:
+            try:
+                self.cache.incr(self.version_key)
+            except ValueError:
+                # version key expired or was evicted
+                self.cache.set(self.version_key, 2, None)
+        else:
+            self.cache.delete(self.key_prefix + netid.lower(),
+                              version=self._version())
+
+
+_entry_cache = None
+_entry_cache_lock = threading.Lock()
+
+
+def get_entry_cache():
+    '''Get the configured LDAP entry cache, or None if caching is not
+    enabled.
+
+    Configured with ``CACHE`` in ``PUCAS_LDAP``, a dict with optional keys
+    ``BACKEND`` (``'local'``, the default, or ``'django'``),
+    ``CACHE_ALIAS`` (Django cache to use, default ``'default'``),
+    ``TIMEOUT`` (default 3600 seconds), ``NEGATIVE_TIMEOUT`` (default 300
+    seconds; 0 disables caching netids with no match) and
+    ``MAX_ENTRIES`` (local cache only, default 1000).
+    '''
+    global _entry_cache
+    config = getattr(settings, 'PUCAS_LDAP', {}).get('CACHE', None)
+    if not config:
+        return None
+    with _entry_cache_lock:
+        if _entry_cache is None:
+            options = {
+                'timeout': config.get('TIMEOUT', 3600),
+                'negative_timeout': config.get('NEGATIVE_TIMEOUT', 300),
+            }
+            if config.get('BACKEND', 'local') == 'django':
+                _entry_cache = DjangoEntryCache(
+                    alias=config.get('CACHE_ALIAS', 'default'), **options)
+            else:
+                _entry_cache = LocalEntryCache(
+                    max_entries=config.get('MAX_ENTRIES', 1000), **options)
+        return _entry_cache
+
+
+def invalidate_entry_cache(netid=None):
+    '''Remove one netid, or all entries, from the LDAP entry cache.'''
+    cache = get_entry_cache()
+    if cache is not None:
+        cache.invalidate(netid)
+
+
+@receiver(setting_changed)
+def cache_settings_changed(sender, setting, **kwargs):
+    global _entry_cache
+    if setting == 'PUCAS_LDAP':
+        with _entry_cache_lock:
+            _entry_cache = None
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pucas.metrics import incr
+
+
+logger = logging.getLogger(__name__)
+
+
+class Flight(object):
+    '''A call in progress, and its result once done.'''
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''Coalesces concurrent calls with the same key within a process: the
+    first caller runs the function, and callers arriving while it is in
+    progress wait for it and share its result or exception.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func):
+        '''Call ``func`` unless a call for ``key`` is already in progress.
+        Returns a tuple of ``(result, shared)``, where ``shared`` is True
+        if the result came from another caller.'''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            incr('coalesce.shared')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class CacheLock(object):
+    '''Coalesces calls with the same key across processes, with a lock in
+    a shared Django cache.
+
+    While one process holds the lock for a key, others poll until it is
+    released; if it succeeded they skip the call, and if it failed (or
+    does not finish within ``wait_timeout`` seconds) they make the call
+    themselves.  Locks expire after ``lock_timeout`` seconds in case the
+    holder dies.
+    '''
+
+    key_prefix = 'pucas:flight:'
+
+    def __init__(self, alias='default', lock_timeout=30, wait_timeout=10,
+                 poll_interval=0.05):
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def do(self, key, func):
+        '''Like :meth:`SingleFlight.do`, but the result of a call made by
+        another process is not available, so it is returned as None.'''
+        lock_key = self.key_prefix + key
+        done_key = lock_key + ':done'
+        acquired = self.cache.add(lock_key, 1, self.lock_timeout)
+        if not acquired:
+            deadline = time.monotonic() + self.wait_timeout
+            while True:
+                time.sleep(self.poll_interval)
+                if self.cache.get(done_key):
+                    incr('coalesce.shared')
+                    return None, True
+                acquired = self.cache.add(lock_key, 1, self.lock_timeout)
+                if acquired:
+                    break
+                if time.monotonic() >= deadline:
+                    logger.warning('Timed out waiting for %s; continuing '
+                                   'without lock', key)
+                    break
+
+        if acquired:
+            # clear any marker from an earlier call
+            self.cache.delete(done_key)
+        try:
+            result = func()
+            if acquired:
+                self.cache.set(done_key, 1, self.lock_timeout)
+            return result, False
+        finally:
+            if acquired:
+                self.cache.delete(lock_key)
+
+
+_flights = SingleFlight()
+
+_lock = None
+_lock_lock = threading.Lock()
+
+
+def get_cache_lock():
+    '''Get the cross-process :class:`CacheLock`, or None if not enabled.
+
+    Configured with ``COALESCE`` in ``PUCAS_LDAP``, a dict with
+    ``BACKEND`` (``'local'``, the default, to coalesce within each
+    process only, or ``'django'`` to also coalesce across processes) and
+    optional ``CACHE_ALIAS`` (default ``'default'``), ``LOCK_TIMEOUT``
+    (default 30) and ``WAIT_TIMEOUT`` (default 10), in seconds.
+    '''
+    global _lock
+    config = getattr(settings, 'PUCAS_LDAP', {}).get('COALESCE', None)
+    if not config or config.get('BACKEND', 'local') != 'django':
+        return None
+    with _lock_lock:
+        if _lock is None:
+            _lock = CacheLock(alias=config.get('CACHE_ALIAS', 'default'),
+                              lock_timeout=config.get('LOCK_TIMEOUT', 30),
+                              wait_timeout=config.get('WAIT_TIMEOUT', 10))
+        return _lock
+
+
+def single_flight(key, func):
+    '''Call ``func``, sharing one call among concurrent callers with the
+    same ``key`` in this process (and across processes, if configured
+    with ``COALESCE``).  Returns a tuple of ``(result, shared)``, where
+    ``shared`` is True if the call was made by another caller; the
+    result is None if that was in another process.'''
+    lock = get_cache_lock()
+    if lock is not None:
+        (result, shared), joined = _flights.do(
+            key, lambda: lock.do(key, func))
+        return result, shared or joined
+    return _flights.do(key, func)
+
+
+@receiver(setting_changed)
+def coalesce_settings_changed(sender, setting, **kwargs):
+    global _lock
+    if setting == 'PUCAS_LDAP':
+        with _lock_lock:
+            _lock = None
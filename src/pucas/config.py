@@ -0,0 +1,168 @@
+import logging
+import re
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+#: A user field and the LDAP attributes to populate it from, in order
+#: of preference; the first attribute present on the entry is used.
+FieldMapping = namedtuple('FieldMapping', ['field', 'ldap_attributes'])
+
+#: ``PUCAS_LDAP`` settings compiled for populating users: a tuple of
+#: :class:`FieldMapping`, the tuple of LDAP attributes to request, and
+#: the resolved ``EXTRA_USER_INIT`` function (or None).
+UserInfoPlan = namedtuple('UserInfoPlan',
+                          ['fields', 'attributes', 'extra_init'])
+
+#: Supported values for ``GET_INFO`` in ``PUCAS_LDAP``, controlling how
+#: much server information ldap3 reads when a connection is opened
+GET_INFO_MODES = ('NONE', 'DSA', 'SCHEMA', 'ALL')
+
+# matches the attribute compared against the netid in SEARCH_FILTER,
+# e.g. uid in (uid=%(user)s)
+NETID_FILTER_RE = re.compile(r'\(([\w.;-]+)=%\(user\)s\)')
+
+
+def unique_attributes(attributes):
+    '''De-duplicate LDAP attribute names (case-insensitive), preserving
+    order and the first spelling of each.'''
+    unique = {}
+    for attr in attributes:
+        unique.setdefault(attr.lower(), attr)
+    return tuple(unique.values())
+
+
+def check_search_settings(config):
+    '''Validate the ``PUCAS_LDAP`` settings for connecting to and
+    searching the directory: ``SERVERS``, ``SEARCH_BASE`` and
+    ``SEARCH_FILTER`` are required, ``GET_INFO`` must be one of
+    :data:`GET_INFO_MODES`, and the netid attribute must be configured
+    as ``NETID_ATTRIBUTE`` or compared to the netid in ``SEARCH_FILTER``.
+    Raises :exc:`ImproperlyConfigured` if they are invalid.'''
+    missing = [name for name in ('SERVERS', 'SEARCH_BASE', 'SEARCH_FILTER')
+               if not config.get(name, None)]
+    if missing:
+        raise ImproperlyConfigured('PUCAS_LDAP %s must be configured'
+                                   % ', '.join(missing))
+    if isinstance(config['SERVERS'], str):
+        raise ImproperlyConfigured('PUCAS_LDAP SERVERS must be a list')
+
+    get_info = config.get('GET_INFO', 'ALL')
+    if not isinstance(get_info, str) or get_info.upper() not in GET_INFO_MODES:
+        raise ImproperlyConfigured(
+            'PUCAS_LDAP GET_INFO %r must be one of %s'
+            % (get_info, ', '.join(GET_INFO_MODES)))
+
+    search_filter = config['SEARCH_FILTER']
+    if '%(user)s' not in search_filter:
+        raise ImproperlyConfigured(
+            'PUCAS_LDAP SEARCH_FILTER must include %(user)s for the netid')
+    if not config.get('NETID_ATTRIBUTE', None) and \
+            not NETID_FILTER_RE.search(search_filter):
+        raise ImproperlyConfigured(
+            'Unable to determine netid attribute from PUCAS_LDAP '
+            'SEARCH_FILTER; configure NETID_ATTRIBUTE')
+
+
+def compile_plan(config):
+    '''Validate a ``PUCAS_LDAP`` dict and compile it into a
+    :class:`UserInfoPlan`.  Raises :exc:`ImproperlyConfigured` if the
+    configuration is invalid.
+
+    When there is an ``ATTRIBUTE_MAP``, the attributes to request are
+    derived from it, plus any listed in an ``ldap_attributes`` attribute
+    on the ``EXTRA_USER_INIT`` function; ``ATTRIBUTES`` is only used if
+    there is no map, or if ``EXTRA_USER_INIT`` does not declare the
+    attributes it needs.'''
+    attr_map = config.get('ATTRIBUTE_MAP', None) or {}
+    if not isinstance(attr_map, dict):
+        raise ImproperlyConfigured('PUCAS_LDAP ATTRIBUTE_MAP must be a dict')
+
+    User = get_user_model()
+    fields = []
+    for field, ldap_attrs in attr_map.items():
+        if not hasattr(User, field):
+            raise ImproperlyConfigured(
+                'PUCAS_LDAP ATTRIBUTE_MAP field %s is not an attribute of %s'
+                % (field, User.__name__))
+        # a single attribute or a list of fallbacks
+        if isinstance(ldap_attrs, str):
+            ldap_attrs = [ldap_attrs]
+        if not ldap_attrs or \
+                not all(attr and isinstance(attr, str) for attr in ldap_attrs):
+            raise ImproperlyConfigured(
+                'PUCAS_LDAP ATTRIBUTE_MAP value for %s must be an LDAP '
+                'attribute name or a list of them' % field)
+        fields.append(FieldMapping(field, unique_attributes(ldap_attrs)))
+
+    extra_init = config.get('EXTRA_USER_INIT', None)
+    if extra_init:
+        try:
+            extra_init = import_string(extra_init)
+        except ImportError as err:
+            raise ImproperlyConfigured(
+                'PUCAS_LDAP EXTRA_USER_INIT could not be imported: %s' % err)
+        if not callable(extra_init):
+            raise ImproperlyConfigured(
+                'PUCAS_LDAP EXTRA_USER_INIT %s is not callable'
+                % config['EXTRA_USER_INIT'])
+
+    extra_init = extra_init or None
+
+    configured = config.get('ATTRIBUTES', None) or ()
+    if isinstance(configured, str):
+        configured = [configured]
+    # LDAP attributes used by EXTRA_USER_INIT, if it declares them
+    extra_attrs = getattr(extra_init, 'ldap_attributes', None)
+    if isinstance(extra_attrs, str):
+        extra_attrs = [extra_attrs]
+
+    mapped = [attr for mapping in fields for attr in mapping.ldap_attributes]
+    if fields and (extra_init is None or extra_attrs is not None):
+        # request only the attributes that are actually used
+        attributes = unique_attributes(mapped + list(extra_attrs or ()))
+        used = set(attr.lower() for attr in attributes)
+        unused = [attr for attr in configured if attr.lower() not in used]
+        if unused:
+            logger.warning('PUCAS_LDAP ATTRIBUTES not used by ATTRIBUTE_MAP '
+                           'or EXTRA_USER_INIT will not be requested: %s',
+                           ', '.join(unused))
+    else:
+        # no mapping, or an init function that may use any attribute
+        # configured as well as those the mapping needs
+        attributes = unique_attributes(list(configured) + mapped)
+
+    return UserInfoPlan(tuple(fields), attributes, extra_init)
+
+
+_plan = None
+_plan_lock = threading.Lock()
+
+
+def get_plan():
+    '''Get the :class:`UserInfoPlan` for the current ``PUCAS_LDAP``
+    settings; compiled once, and again only when the settings change.'''
+    global _plan
+    if _plan is None:
+        with _plan_lock:
+            if _plan is None:
+                _plan = compile_plan(getattr(settings, 'PUCAS_LDAP', {}))
+    return _plan
+
+
+@receiver(setting_changed)
+def plan_settings_changed(sender, setting, **kwargs):
+    global _plan
+    if setting == 'PUCAS_LDAP':
+        with _plan_lock:
+            _plan = None
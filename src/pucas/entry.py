@@ -0,0 +1,102 @@
+from ldap3.core.exceptions import LDAPCursorError
+
+
+class DirectoryAttribute(object):
+    '''Attribute of a :class:`DirectoryEntry`; mirrors the parts of
+    :class:`ldap3.abstract.attribute.Attribute` used by pucas.'''
+
+    __slots__ = ('key', 'values')
+
+    def __init__(self, key, values):
+        self.key = key
+        self.values = list(values)
+
+    @property
+    def value(self):
+        if not self.values:
+            return None
+        return self.values[0] if len(self.values) == 1 else self.values
+
+    def __str__(self):
+        # same as ldap3: single value as is, otherwise the list
+        if len(self.values) == 1:
+            return str(self.values[0])
+        return str(self.values)
+
+    def __repr__(self):
+        return '%s: %s' % (self.key, ', '.join(str(v) for v in self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __eq__(self, other):
+        if isinstance(other, DirectoryAttribute):
+            return self.key == other.key and self.values == other.values
+        return NotImplemented
+
+
+class DirectoryEntry(object):
+    '''LDAP entry detached from any connection, so that it can be cached,
+    pickled or stored.  Attribute access behaves like an ldap3
+    :class:`~ldap3.abstract.entry.Entry`: attribute names are
+    case-insensitive and missing attributes raise :exc:`LDAPCursorError`.
+    '''
+
+    def __init__(self, dn, attributes):
+        self.entry_dn = dn
+        self._attributes = {key: DirectoryAttribute(key, values)
+                            for key, values in attributes.items()}
+        self._keys = {key.lower(): key for key in attributes}
+
+    @classmethod
+    def from_entry(cls, entry):
+        '''Create from an ldap3 entry (or another :class:`DirectoryEntry`).'''
+        if isinstance(entry, cls):
+            return entry
+        return cls(entry.entry_dn, entry.entry_attributes_as_dict)
+
+    @property
+    def entry_attributes(self):
+        return list(self._attributes)
+
+    @property
+    def entry_attributes_as_dict(self):
+        return {key: list(attr.values)
+                for key, attr in self._attributes.items()}
+
+    def __getattr__(self, name):
+        # only called for names that are not regular attributes
+        if name.startswith('_'):
+            raise AttributeError(name)
+        key = self.__dict__['_keys'].get(name.lower())
+        if key is None:
+            raise LDAPCursorError('attribute \'%s\' not found' % name)
+        return self._attributes[key]
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    def __contains__(self, name):
+        return name.lower() in self._keys
+
+    def __eq__(self, other):
+        if isinstance(other, DirectoryEntry):
+            return self.entry_dn == other.entry_dn and \
+                self.entry_attributes_as_dict == other.entry_attributes_as_dict
+        return NotImplemented
+
+    def __getstate__(self):
+        return {'dn': self.entry_dn,
+                'attributes': self.entry_attributes_as_dict}
+
+    def __setstate__(self, state):
+        self.__init__(state['dn'], state['attributes'])
+
+    def __repr__(self):
+        lines = ['DN: %s' % self.entry_dn]
+        for key in sorted(self._attributes):
+            lines.append('    %r' % self._attributes[key])
+        return '\n'.join(lines)
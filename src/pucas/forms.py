@@ -16,9 +16,16 @@ class CasUserInitForm(forms.Form):
         help_text="Enter one or more Princeton NetIDs, separated by spaces or newlines.",
         widget=forms.Textarea(attrs={"rows": 4}),
     )
+    refresh_existing = forms.BooleanField(
+        label="Refresh existing accounts",
+        help_text="Also update accounts that already exist from LDAP; "
+                  "otherwise they are left unchanged.",
+        required=False,
+    )
 
     def clean_netids(self):
         netids = self.cleaned_data["netids"].split()
         for netid in netids:
             netid_validator(netid)
-        return netids
+        # de-duplicate, preserving order
+        return list(dict.fromkeys(netids))
@@ -0,0 +1,34 @@
+from ldap3.core.exceptions import LDAPException
+
+from pucas.ldap import user_info_from_ldap
+from pucas.models import PendingUserInfo
+
+
+def mark_pending(user):
+    '''Record that a user's info should be populated from LDAP when it
+    is first needed.'''
+    PendingUserInfo.objects.get_or_create(user=user)
+
+
+def is_pending(user):
+    return PendingUserInfo.objects.filter(user=user).exists()
+
+
+def ensure_user_info(user):
+    '''Populate a user's info from LDAP if it is still pending; call
+    before using LDAP-derived fields.  Returns True if the user was
+    populated by this call.
+
+    The pending record is claimed by deleting it, so concurrent calls
+    populate a user at most once; if the LDAP lookup fails, the user is
+    marked as pending again and the error is raised.
+    '''
+    claimed, _ = PendingUserInfo.objects.filter(user=user).delete()
+    if not claimed:
+        return False
+    try:
+        user_info_from_ldap(user)
+    except LDAPException:
+        mark_pending(user)
+        raise
+    return True
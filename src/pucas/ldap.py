@@ -1,10 +1,30 @@
+import copy
 import ldap3
 import logging
-import importlib
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from ldap3.core.exceptions import LDAPException, LDAPCursorError
+from ldap3.core.exceptions import LDAPException, LDAPCursorError, \
+    LDAPCommunicationError
+from ldap3.utils.conv import escape_filter_chars
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, close_old_connections, transaction
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pucas.breaker import LDAPUnavailable, get_circuit_breaker
+from pucas.cache import NOT_FOUND, get_entry_cache
+from pucas.coalesce import single_flight
+from pucas.config import GET_INFO_MODES, NETID_FILTER_RE, get_plan
+from pucas.metrics import incr, timer
+from pucas.mirror import get_mirrored, mirror_config, update_mirror
+from pucas.pool import LDAPConnectionPool
+from pucas.schema import load_schema, save_schema, snapshot_configured
+from pucas.servers import get_server_selector
 
 
 logger = logging.getLogger(__name__)
@@ -14,64 +34,527 @@ class LDAPSearchException(LDAPException):
     pass
 
 
+#: Results of :meth:`LDAPSearch.find_users`: a dict of netid to LDAP
+#: entry for netids with exactly one match, and lists of netids with
+#: no match or with more than one match.
+LDAPBatchResult = namedtuple('LDAPBatchResult',
+                             ['found', 'missing', 'ambiguous'])
+
+#: Results of :func:`bulk_init_cas_users`: lists of netids for accounts
+#: created, existing accounts updated, and netids with no LDAP match or
+#: with more than one match.
+BulkInitResult = namedtuple('BulkInitResult',
+                            ['created', 'updated', 'not_found', 'ambiguous'])
+
+# LDAP simple paged results control
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+
+def get_info_mode():
+    mode = settings.PUCAS_LDAP.get('GET_INFO', 'ALL').upper()
+    if mode not in GET_INFO_MODES:
+        raise LDAPSearchException('Invalid GET_INFO %r; must be one of %s'
+                                  % (mode, ', '.join(GET_INFO_MODES)))
+    return getattr(ldap3, mode)
+
+
+def create_connection():
+    '''Open and bind a new LDAP connection based on configured settings.
+
+    Raises :exc:`~pucas.breaker.LDAPUnavailable` without trying to
+    connect if the circuit breaker is open.
+    '''
+    breaker = get_circuit_breaker()
+    if breaker is not None and not breaker.allow():
+        raise LDAPUnavailable('LDAP directory is unavailable')
+
+    get_info = get_info_mode()
+    # use schema snapshot if there is one, instead of reading it
+    # from the server on every new connection
+    schema = load_schema()
+    if schema is not None:
+        get_info = ldap3.NONE
+    elif snapshot_configured() and get_info not in (ldap3.SCHEMA, ldap3.ALL):
+        # read schema once from the server to save a snapshot
+        get_info = ldap3.SCHEMA
+
+    # retrieve settings and initialize connection
+    server_args = {}
+    if settings.PUCAS_LDAP.get('CONNECT_TIMEOUT', None):
+        server_args['connect_timeout'] = settings.PUCAS_LDAP['CONNECT_TIMEOUT']
+    # with latency-aware selection, try servers in order of preference
+    selector = get_server_selector()
+    if selector is not None:
+        servers, strategy = selector.order(), ldap3.FIRST
+    else:
+        servers, strategy = settings.PUCAS_LDAP['SERVERS'], ldap3.ROUND_ROBIN
+    ldap_servers = []
+    for server in servers:
+        ldap_server = ldap3.Server(server, get_info=get_info, use_ssl=True,
+                                   **server_args)
+        if schema is not None:
+            ldap_server.attach_schema_info(schema)
+        ldap_servers.append(ldap_server)
+    # by default, keep trying servers until one is available
+    server_pool = ldap3.ServerPool(ldap_servers, strategy,
+        active=settings.PUCAS_LDAP.get('SERVER_POOL_CYCLES', True),
+        exhaust=5)
+
+    # Load username (in DN format) and password, if in settings
+    bind_dn = settings.PUCAS_LDAP.get('BIND_DN', None)
+    bind_password = settings.PUCAS_LDAP.get('BIND_PASSWORD', None)
+
+    extra_args = {}
+    if settings.PUCAS_LDAP.get('RECEIVE_TIMEOUT', None):
+        extra_args['receive_timeout'] = settings.PUCAS_LDAP['RECEIVE_TIMEOUT']
+    # Use DN and password if set. Otherwise, use anononymous bind.
+    if bind_dn and bind_password:
+        extra_args.update({'user': bind_dn, 'password': bind_password})
+
+    start = time.perf_counter()
+    try:
+        with timer('ldap.connect'):
+            conn = ldap3.Connection(server_pool, auto_bind=True, **extra_args)
+    except LDAPException as err:
+        logging.error('Error establishing LDAP connection: %s', err)
+        if breaker is not None:
+            breaker.record_failure()
+        if selector is not None:
+            for server in servers:
+                selector.record(server, error=True)
+        # re-raise to be caught elsewhere
+        raise
+    if breaker is not None:
+        breaker.record_success()
+    if selector is not None:
+        for server, ldap_server in zip(servers, ldap_servers):
+            if ldap_server is conn.server:
+                selector.record(server, time.perf_counter() - start)
+                # keep track of the server for search latency
+                conn.pucas_server = server
+                break
+            # servers tried first were unavailable
+            selector.record(server, error=True)
+
+    if schema is None and snapshot_configured():
+        save_schema(conn.server.schema)
+    return conn
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    '''Get the process-wide LDAP connection pool, creating it if needed.
+
+    Pool size and idle timeout are configured with ``POOL_SIZE`` and
+    ``POOL_IDLE_TIMEOUT`` in ``PUCAS_LDAP``.
+    '''
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = LDAPConnectionPool(
+                create_connection,
+                size=settings.PUCAS_LDAP.get('POOL_SIZE', 10),
+                idle_timeout=settings.PUCAS_LDAP.get('POOL_IDLE_TIMEOUT', 300))
+        return _connection_pool
+
+
+def reset_connection_pool():
+    '''Close pooled connections and discard the process-wide pool.'''
+    global _connection_pool
+    with _connection_pool_lock:
+        pool, _connection_pool = _connection_pool, None
+    if pool is not None:
+        pool.clear()
+
+
+_ldap_search = None
+_ldap_search_lock = threading.Lock()
+
+
+def get_ldap_search():
+    '''Get a process-wide :class:`LDAPSearch` that can be used from any
+    thread; each search checks out its own pooled connection.'''
+    global _ldap_search
+    with _ldap_search_lock:
+        if _ldap_search is None:
+            _ldap_search = LDAPSearch(shared=True)
+        return _ldap_search
+
+
+@receiver(setting_changed)
+def ldap_settings_changed(sender, setting, **kwargs):
+    global _ldap_search
+    # pooled connections are bound with the old settings
+    if setting == 'PUCAS_LDAP':
+        with _ldap_search_lock:
+            _ldap_search = None
+        reset_connection_pool()
+
+
 class LDAPSearch(object):
+    '''LDAP user search using a connection borrowed from the shared pool.
+
+    Call :meth:`close` (or use as a context manager) when done to return
+    the connection to the pool for reuse.
+
+    With ``shared=True``, no connection is held; each search checks one
+    out from the pool and returns it when done, so a single instance can
+    be used from multiple threads at once (see :func:`get_ldap_search`).
+    '''
+
+    def __init__(self, shared=False):
+        self.pool = get_connection_pool()
+        self.shared = shared
+        self.conn = None
+        if not shared:
+            try:
+                self.conn = self._acquire()
+            except LDAPException:
+                # lookups can still be served from the directory mirror
+                # while LDAP is down; connect again on the first search
+                if mirror_config() is None:
+                    raise
 
-    def __init__(self):
-        # retrieve settings and initialize connection
-        ldap_servers = []
-        for server in settings.PUCAS_LDAP['SERVERS']:
-            ldap_servers.append(ldap3.Server(server, get_info=ldap3.ALL,
-                use_ssl=True))
-        server_pool = ldap3.ServerPool(ldap_servers,
-            ldap3.ROUND_ROBIN, active=True, exhaust=5)
+    def close(self):
+        '''Return the connection to the pool.'''
+        if not self.shared:
+            self.pool.release(self.conn)
+            self.conn = None
 
-        # Load username (in DN format) and password, if in settings
-        bind_dn = settings.PUCAS_LDAP.get('BIND_DN', None)
-        bind_password = settings.PUCAS_LDAP.get('BIND_PASSWORD', None)
+    def __enter__(self):
+        return self
 
-        extra_args = {}
-        # Use DN and password if set. Otherwise, use anononymous bind.
-        if bind_dn and bind_password:
-            extra_args.update({'user': bind_dn, 'password': bind_password})
+    def __exit__(self, *exc_info):
+        self.close()
 
+    def _acquire(self):
+        if self.conn is not None:
+            return self.conn
+        # includes connection setup and bind if none are pooled
+        with timer('ldap.acquire'):
+            return self.pool.acquire()
+
+    def _release(self, conn):
+        if self.shared:
+            self.pool.release(conn)
+        else:
+            # may have been replaced after a connection error
+            self.conn = conn
+
+    def _search_on(self, conn, *args, **kwargs):
+        # search on conn, reconnecting once if it has been dropped;
+        # returns the connection used with its entries and result.  On
+        # error, the connection has already been released or discarded.
+        selector = get_server_selector()
+        with timer('ldap.search'):
+            start = time.perf_counter()
+            try:
+                conn.search(*args, **kwargs)
+            except LDAPCommunicationError as err:
+                # pooled socket may have been dropped by the server;
+                # rebind on a fresh connection and retry once
+                logger.info('LDAP connection error (%s); reconnecting', err)
+                incr('ldap.reconnect')
+                if selector is not None:
+                    selector.record(getattr(conn, 'pucas_server', None),
+                                    error=True)
+                if not self.shared:
+                    self.conn = None
+                conn = self.pool.replace(conn)
+                start = time.perf_counter()
+                try:
+                    conn.search(*args, **kwargs)
+                except LDAPCommunicationError:
+                    breaker = get_circuit_breaker()
+                    if breaker is not None:
+                        breaker.record_failure()
+                    self.pool.discard(conn)
+                    raise
+                except Exception:
+                    self._release(conn)
+                    raise
+            except Exception:
+                self._release(conn)
+                raise
+        if selector is not None:
+            selector.record(getattr(conn, 'pucas_server', None),
+                            time.perf_counter() - start)
+        entries = conn.entries
+        incr('ldap.entries', len(entries))
+        return conn, entries, conn.result
+
+    def _search(self, *args, **kwargs):
+        conn, entries, _ = self._search_on(self._acquire(), *args, **kwargs)
+        self._release(conn)
+        return entries
+
+    def _paged_search(self, search_base, search_filter, attributes,
+                      page_size):
+        # all pages are retrieved on the same connection, since the
+        # paged results cookie is only valid there
+        conn = self._acquire()
+        try:
+            cookie = None
+            while True:
+                try:
+                    conn, entries, result = self._search_on(
+                        conn, search_base, search_filter,
+                        attributes=attributes, paged_size=page_size,
+                        paged_cookie=cookie)
+                except Exception:
+                    conn = None
+                    raise
+                yield from entries
+                controls = (result or {}).get('controls') or {}
+                cookie = controls.get(PAGED_RESULTS_OID, {}) \
+                    .get('value', {}).get('cookie')
+                if not cookie or not entries:
+                    break
+        finally:
+            if conn is not None:
+                self._release(conn)
+
+    @staticmethod
+    def check_config():
+        # check for required settings and error if not available
+        required_configs = ['SEARCH_BASE', 'SEARCH_FILTER']
+        if any(req not in settings.PUCAS_LDAP for req in required_configs) \
+                or not get_plan().attributes:
+            raise LDAPSearchException('LDAP is not configured for user lookup')
+
+    @staticmethod
+    def netid_attribute():
+        '''LDAP attribute that holds the netid; uses ``NETID_ATTRIBUTE``
+        if configured, otherwise the attribute in ``SEARCH_FILTER``.'''
+        netid_attr = settings.PUCAS_LDAP.get('NETID_ATTRIBUTE', None)
+        if not netid_attr:
+            match = NETID_FILTER_RE.search(settings.PUCAS_LDAP['SEARCH_FILTER'])
+            if not match:
+                raise LDAPSearchException(
+                    'Unable to determine netid attribute from SEARCH_FILTER; '
+                    'configure NETID_ATTRIBUTE')
+            netid_attr = match.group(1)
+        return netid_attr
+
+    def _search_chunk(self, chunk, netid_attr, search_attributes, page_size,
+                      extra_filter=None):
+        # returns a dict of netid to matching entries, keyed by dn
+        matches = defaultdict(dict)
+        # ldap attribute matching is case-insensitive
+        lookup = {netid.lower(): netid for netid in chunk}
+        search_filter = '(|%s)' % ''.join(
+            settings.PUCAS_LDAP['SEARCH_FILTER'] %
+            {'user': escape_filter_chars(netid)} for netid in chunk)
+        if extra_filter:
+            search_filter = '(&%s%s)' % (search_filter, extra_filter)
+
+        for entry in self._paged_search(
+                settings.PUCAS_LDAP['SEARCH_BASE'], search_filter,
+                search_attributes, page_size):
+            try:
+                values = getattr(entry, netid_attr).values
+            except LDAPCursorError:
+                continue
+            for value in values:
+                netid = lookup.get(str(value).lower())
+                if netid:
+                    matches[netid][entry.entry_dn] = entry
+        return matches
+
+    def _search_chunk_pooled(self, *args):
+        # search on a separate pooled connection, for concurrent searches
+        if self.shared:
+            return self._search_chunk(*args)
+        ldap = LDAPSearch()
         try:
-            self.conn = ldap3.Connection(server_pool, auto_bind=True,
-                                         **extra_args)
-        except LDAPException as err:
-            logging.error('Error establishing LDAP connection: %s', err)
-            # re-raise to be caught elsewhere
-            raise
+            return ldap._search_chunk(*args)
+        finally:
+            ldap.close()
+
+    def find_users(self, netids, chunk_size=None, all_attributes=False,
+                   workers=None, extra_filter=None, use_cache=True):
+        '''Look up multiple netids with as few searches as possible.
+
+        Netids are searched in chunks of ``chunk_size`` (default
+        ``BATCH_SIZE`` from ``PUCAS_LDAP``, or 100), combining
+        ``SEARCH_FILTER`` for each netid in a chunk into a single OR filter
+        and retrieving results with paged searches (``PAGE_SIZE``, default
+        500).  Returns an :class:`LDAPBatchResult`; netids are listed in
+        the order they were given, without duplicates.
+
+        With ``workers`` (default ``MAX_CONCURRENCY``, or 1) greater than
+        one, netids are split across up to that many chunks searched
+        concurrently, each on its own pooled connection.
+
+        ``extra_filter`` is an LDAP filter that entries must also match
+        (e.g. ``(modifyTimestamp>=20260101000000Z)``); netids that don't
+        match it are listed as missing.  With ``use_cache=False``, cached
+        entries are not used but results are still cached; neither is
+        cached when searching with ``extra_filter``.
+        '''
+        self.check_config()
+        chunk_size = chunk_size or settings.PUCAS_LDAP.get('BATCH_SIZE', 100)
+        page_size = settings.PUCAS_LDAP.get('PAGE_SIZE', 500)
+        workers = workers or settings.PUCAS_LDAP.get('MAX_CONCURRENCY', 1)
+        netid_attr = self.netid_attribute()
+        attributes = get_plan().attributes
+
+        if all_attributes:
+            search_attributes = '*'
+        else:
+            search_attributes = list(attributes)
+            # netid is needed to match entries to the requested netids
+            if netid_attr.lower() not in \
+                    [attr.lower() for attr in search_attributes]:
+                search_attributes.append(netid_attr)
+
+        # de-duplicate, preserving order
+        netids = list(dict.fromkeys(netid for netid in netids if netid))
+
+        cache = None if all_attributes or extra_filter else get_entry_cache()
+        cached = {}
+        if cache is not None and use_cache:
+            cached = cache.get_many(netids, attributes)
+        uncached = [netid for netid in netids if netid not in cached]
+        mirror = not all_attributes and not extra_filter and use_cache \
+            and mirror_config() is not None
+        if mirror:
+            # mirrored entries are found; netids not mirrored are searched
+            mirrored = get_mirrored(uncached, attributes)
+            cached.update(mirrored)
+            uncached = [netid for netid in uncached if netid not in mirrored]
+
+        if workers > 1:
+            # spread netids across workers, even if under one chunk
+            chunk_size = max(1, min(chunk_size, -(-len(uncached) // workers)))
+        chunks = [uncached[i:i + chunk_size]
+                  for i in range(0, len(uncached), chunk_size)]
+        search_args = (netid_attr, search_attributes, page_size, extra_filter)
+
+        matches = {}
+        if workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks)),
+                                    thread_name_prefix='pucas-ldap') as executor:
+                for chunk_matches in executor.map(
+                        lambda chunk: self._search_chunk_pooled(chunk, *search_args),
+                        chunks):
+                    matches.update(chunk_matches)
+        else:
+            for chunk in chunks:
+                matches.update(self._search_chunk(chunk, *search_args))
+
+        result = LDAPBatchResult({}, [], [])
+        for netid in netids:
+            if netid in cached:
+                entries = [] if cached[netid] is NOT_FOUND else [cached[netid]]
+            else:
+                entries = list(matches.get(netid, {}).values())
+            if len(entries) == 1:
+                result.found[netid] = entries[0]
+            elif entries:
+                result.ambiguous.append(netid)
+            else:
+                result.missing.append(netid)
+
+        if cache is not None and uncached:
+            # ambiguous netids are not cached
+            new_entries = {netid: result.found.get(netid) for netid in uncached
+                           if netid not in result.ambiguous}
+            cache.set_many(new_entries, attributes)
+        if mirror and uncached:
+            update_mirror({netid: result.found[netid] for netid in uncached
+                           if netid in result.found}, attributes)
+        return result
 
     def find_user(self, netid, all_attributes=False):
         if netid:
-            # check for required settings and error if not available
-            required_configs = ['ATTRIBUTES', 'SEARCH_BASE', 'SEARCH_FILTER']
-            if any(req not in settings.PUCAS_LDAP for req in required_configs):
-                raise LDAPSearchException('LDAP is not configured for user lookup')
+            self.check_config()
 
             # for testing, to see all available attributes
             if all_attributes:
                 search_attributes = '*'
             else:
-                search_attributes = settings.PUCAS_LDAP['ATTRIBUTES']
+                search_attributes = list(get_plan().attributes)
+
+            cache = None if all_attributes else get_entry_cache()
+            if cache is not None:
+                entry = cache.get(netid, search_attributes)
+                if entry is NOT_FOUND:
+                    raise LDAPSearchException('No match found for %s' % netid)
+                if entry is not None:
+                    return entry
 
-            self.conn.search(settings.PUCAS_LDAP['SEARCH_BASE'],
-                    settings.PUCAS_LDAP['SEARCH_FILTER'] % {'user': netid},
-                    attributes=search_attributes)
-            if self.conn.entries:
-                if len(self.conn.entries) > 1:
+            mirror = not all_attributes and mirror_config() is not None
+            if mirror:
+                entry = get_mirrored([netid], search_attributes).get(netid)
+                if entry is not None:
+                    return entry
+
+            try:
+                entries = self._search(settings.PUCAS_LDAP['SEARCH_BASE'],
+                        settings.PUCAS_LDAP['SEARCH_FILTER'] % {'user': netid},
+                        attributes=search_attributes)
+            except LDAPException as err:
+                # use an older mirrored entry if the directory is down
+                entry = get_mirrored([netid], search_attributes,
+                                     stale=True).get(netid) if mirror else None
+                if entry is None:
+                    raise
+                logger.warning('Error searching LDAP for %s (%s); using '
+                               'mirrored entry', netid, err)
+                return entry
+            if entries:
+                if len(entries) > 1:
                     raise LDAPSearchException('Found more than one entry for %s' % netid)
 
-                return self.conn.entries[0]
+                if cache is not None:
+                    cache.set(netid, search_attributes, entries[0])
+                if mirror:
+                    update_mirror({netid: entries[0]}, search_attributes)
+                return entries[0]
 
             else:
+                if cache is not None:
+                    cache.set(netid, search_attributes, NOT_FOUND)
                 raise LDAPSearchException('No match found for %s' % netid)
 
         else:
             raise LDAPSearchException('Error: requested LDAP lookup on empty netid')
 
 
-def init_cas_user(netid, ldap=None):
+class AsyncLDAPSearch(object):
+    '''Asyncio interface to :class:`LDAPSearch` for ASGI deployments.
+
+    Searches run in worker threads (not the thread-sensitive thread used
+    for the ORM), each with a connection borrowed from the shared pool, so
+    concurrent lookups do not block the event loop or each other.
+    '''
+
+    @staticmethod
+    def _run(method, *args, **kwargs):
+        ldap = LDAPSearch()
+        try:
+            return getattr(ldap, method)(*args, **kwargs)
+        finally:
+            ldap.close()
+            # lookups may query the directory mirror; don't leave this
+            # worker thread's database connection open
+            close_old_connections()
+
+    async def find_user(self, netid, all_attributes=False):
+        return await sync_to_async(self._run, thread_sensitive=False)(
+            'find_user', netid, all_attributes=all_attributes)
+
+    async def find_users(self, netids, chunk_size=None, all_attributes=False):
+        return await sync_to_async(self._run, thread_sensitive=False)(
+            'find_users', netids, chunk_size=chunk_size,
+            all_attributes=all_attributes)
+
+
+def init_cas_user(netid, ldap=None, user_info=None):
     """Initialize a CAS user account from LDAP by netid.
 
     Looks up the netid in LDAP, creates the user account if it does not exist,
@@ -83,65 +566,265 @@ def init_cas_user(netid, ldap=None):
     Raises :exc:`LDAPSearchException` if the netid is not found in LDAP.
 
     An existing :class:`LDAPSearch` instance can be passed as ``ldap`` to
-    reuse an existing connection when initializing multiple users.
+    reuse an existing connection when initializing multiple users. If the
+    LDAP entry has already been retrieved (e.g. with
+    :meth:`LDAPSearch.find_users`), pass it as ``user_info`` to skip
+    the search.
+
+    Concurrent calls for the same netid share one search and one write
+    (see :func:`pucas.coalesce.single_flight`); only the first reports
+    the account as created.
     """
+    if user_info is not None:
+        return _init_cas_user(netid, user_info)
+
+    # a shared search only checks out a connection to search, so callers
+    # waiting on a concurrent lookup for the same netid don't hold one
     if ldap is None:
-        ldap = LDAPSearch()
-    User = get_user_model()
+        ldap = LDAPSearch(shared=True)
     # verify netid exists in LDAP before creating a DB record
-    ldap.find_user(netid)
-    user, created = User.objects.get_or_create(username=netid)
-    user_info_from_ldap(user)
+    result, shared = single_flight(
+        'init:%s' % netid,
+        lambda: _init_cas_user(netid, ldap.find_user(netid)))
+    if not shared:
+        return result
+    if result is None:
+        # initialized by another process
+        user, created = get_user_model().objects.get_or_create(username=netid)
+        if created:
+            user_info_from_ldap(user)
+        return user, created
+    # copy, so threads don't share a model instance
+    return copy.copy(result[0]), False
+
+
+def _init_cas_user(netid, user_info):
+    user, created = get_user_model().objects.get_or_create(username=netid)
+    # populate from the entry already retrieved instead of searching again
+    user_info_from_ldap(user, user_info=user_info)
     return user, created
 
 
-def user_info_from_ldap(user):
-    '''Populate django user info from ldap'''
+def user_info_from_ldap(user, user_info=None, ldap=None):
+    '''Populate django user info from ldap.
+
+    If the LDAP entry for the user has already been retrieved, pass it as
+    ``user_info`` to skip the search.  Otherwise the user is looked up by
+    username, using the :class:`LDAPSearch` passed as ``ldap`` if there
+    is one, or a pooled connection if not.  Concurrent lookups for the
+    same saved user share one search and one write; the other callers'
+    user instances are updated with the changed values.
+    '''
 
-    # configured mapping of user fields to ldap fields
-    attr_map = settings.PUCAS_LDAP.get('ATTRIBUTE_MAP', None)
-    # if no map is configured, nothing to do
-    if not attr_map:
+    # if no mapping of user fields to ldap fields is configured,
+    # nothing to do
+    if not get_plan().fields:
         # is logging sufficient here? or should it be an exception
         logging.warning('No attribute map configured; not populating user info'
                         ' from ldap')
         return
 
-    user_info = LDAPSearch().find_user(user.username)
+    if user_info is None and user.pk is not None:
+        changed, shared = single_flight(
+            'user_info:%s' % user.username,
+            lambda: _update_user_info(user, None, ldap))
+        if shared:
+            if changed is None:
+                # updated by another process
+                user.refresh_from_db(
+                    fields=[mapping.field for mapping in get_plan().fields])
+            else:
+                for attname, value in changed.items():
+                    setattr(user, attname, value)
+        return
+
+    _update_user_info(user, user_info, ldap)
+
+
+def _update_user_info(user, user_info, ldap):
+    # populate and save user; returns a dict of changed values
+    if user_info is None:
+        if ldap is None:
+            ldap = LDAPSearch(shared=True)
+        user_info = ldap.find_user(user.username)
+
+    if not user_info:
+        return {}
+    initial = user_field_values(user)
+    with timer('user.populate'):
+        populate_user(user, user_info)
+    with timer('user.save'):
+        if user.pk is None:
+            user.save()
+            return user_field_values(user)
+        # only write fields that changed, if any
+        changed_fields = changed_user_fields(user, initial)
+        if changed_fields:
+            user.save(update_fields=changed_fields)
+    return {field: getattr(user, field) for field in changed_fields}
+
+
+async def ainit_cas_user(netid, ldap=None, user_info=None):
+    '''Async version of :func:`init_cas_user`; ``ldap`` should be an
+    :class:`AsyncLDAPSearch`.  Database queries run in the sync thread,
+    since the async ORM methods are not available before Django 4.2.'''
+    User = get_user_model()
+    # verify netid exists in LDAP before creating a DB record
+    if user_info is None:
+        user_info = await (ldap or AsyncLDAPSearch()).find_user(netid)
+    user, created = await sync_to_async(User.objects.get_or_create)(
+        username=netid)
+    await auser_info_from_ldap(user, user_info=user_info)
+    return user, created
+
+
+async def auser_info_from_ldap(user, user_info=None, ldap=None):
+    '''Async version of :func:`user_info_from_ldap`; ``ldap`` should be
+    an :class:`AsyncLDAPSearch`.'''
+    if not get_plan().fields:
+        logging.warning('No attribute map configured; not populating user info'
+                        ' from ldap')
+        return
+
+    if user_info is None:
+        user_info = await (ldap or AsyncLDAPSearch()).find_user(user.username)
+
     if user_info:
-        for user_attr, ldap_attr in attr_map.items():
-            # Handle issues where an attribute may need to be populated by
-            # multiple attributes OR where it is missing.
-
-            # if just a string, convert to a list so handling can be uniform,
-            # in cases where a field is multivalued.
-            if isinstance(ldap_attr, str):
-                ldap_attr = [ldap_attr]
-
-            # iterate through the list items and break on the first one to
-            # correct set without raising LDAPCursorError
-            # This is a simplification for multivalued fields, since
-            # typically we're mapping to only one value.
-            for val in ldap_attr:
-                try:
-                    setattr(user, user_attr, str(getattr(user_info, val)))
-                    break
-                except LDAPCursorError:
-                    pass
-            # user getattr to check for a still unset value, in which case
-            # set it to an empty string, used in situations where
-            # a user is being updated -- and ot make sure values are
-            # strings, not lists
-            if not getattr(user, user_attr, None):
-                setattr(user, user_attr, '')
-
-        # optional custom user-init method set in django config
-        extra_init = settings.PUCAS_LDAP.get('EXTRA_USER_INIT', None)
-        if extra_init:
-            # use importlib to import the module and get hte function
-            mod_name, func_name = extra_init.rsplit('.', 1)
-            mod = importlib.import_module(mod_name)
-            extra_init_func = getattr(mod, func_name)
-            extra_init_func(user, user_info)
-
-        user.save()
+        initial = user_field_values(user)
+        # EXTRA_USER_INIT may use the ORM, so run in the sync thread
+        await sync_to_async(populate_user)(user, user_info)
+        if user.pk is None:
+            await sync_to_async(user.save)()
+        else:
+            changed_fields = changed_user_fields(user, initial)
+            if changed_fields:
+                await sync_to_async(user.save)(update_fields=changed_fields)
+
+
+def populate_user(user, user_info):
+    '''Set user fields from an LDAP entry according to the configured
+    ``ATTRIBUTE_MAP`` and run any ``EXTRA_USER_INIT``; does not save.'''
+    plan = get_plan()
+    if not plan.fields:
+        return
+
+    for user_attr, ldap_attrs in plan.fields:
+        # Handle issues where an attribute may need to be populated by
+        # multiple attributes OR where it is missing.
+
+        # iterate through the list items and break on the first one to
+        # correct set without raising LDAPCursorError
+        # This is a simplification for multivalued fields, since
+        # typically we're mapping to only one value.
+        for val in ldap_attrs:
+            try:
+                setattr(user, user_attr, str(getattr(user_info, val)))
+                break
+            except LDAPCursorError:
+                pass
+        # user getattr to check for a still unset value, in which case
+        # set it to an empty string, used in situations where
+        # a user is being updated -- and ot make sure values are
+        # strings, not lists
+        if not getattr(user, user_attr, None):
+            setattr(user, user_attr, '')
+
+    # optional custom user-init method set in django config
+    if plan.extra_init:
+        with timer('user.extra_init'):
+            plan.extra_init(user, user_info)
+
+
+def user_field_values(user):
+    '''Dict of a user's field values by attname (excluding the primary
+    key), for comparison with :func:`changed_user_fields`.'''
+    return {field.attname: getattr(user, field.attname)
+            for field in user._meta.concrete_fields if not field.primary_key}
+
+
+def changed_user_fields(user, initial):
+    '''List of fields (by attname) whose values differ from ``initial``,
+    as returned by :func:`user_field_values` before the user was
+    modified.'''
+    return [field for field, value in user_field_values(user).items()
+            if initial[field] != value]
+
+
+def bulk_init_cas_users(netids, ldap=None, staff=False, superuser=False,
+                        activate_created=False, workers=None, use_cache=True):
+    '''Initialize CAS user accounts for many netids at once.
+
+    Bulk equivalent of :func:`init_cas_user`: netids are looked up with
+    :meth:`LDAPSearch.find_users`, existing accounts are fetched with a
+    single query and missing ones created with ``bulk_create``.  User info
+    is then populated from LDAP (including ``EXTRA_USER_INIT``) and all
+    modified fields are written with a single ``bulk_update``, within one
+    transaction.
+
+    ``staff`` and ``superuser`` grant those permissions to all found
+    users and ensure they are active; ``activate_created`` ensures newly
+    created accounts are active.  Either overrides an ``EXTRA_USER_INIT``
+    that sets accounts inactive.  ``workers`` and ``use_cache`` are
+    passed to :meth:`LDAPSearch.find_users`; use ``use_cache=False`` to
+    refresh accounts from the directory rather than cached entries.
+
+    Returns a :class:`BulkInitResult` of netid lists.
+    '''
+    if ldap is None:
+        ldap = LDAPSearch()
+        try:
+            results = ldap.find_users(netids, workers=workers,
+                                      use_cache=use_cache)
+        finally:
+            ldap.close()
+    else:
+        results = ldap.find_users(netids, workers=workers,
+                                  use_cache=use_cache)
+
+    User = get_user_model()
+    found = results.found
+    summary = BulkInitResult([], [], results.missing, results.ambiguous)
+    if not found:
+        return summary
+
+    with transaction.atomic():
+        existing = set(User.objects.filter(username__in=list(found))
+                           .values_list('username', flat=True))
+        created = [netid for netid in found if netid not in existing]
+        if created:
+            try:
+                with transaction.atomic():
+                    User.objects.bulk_create(
+                        [User(username=netid) for netid in created])
+            except IntegrityError:
+                # some accounts were created concurrently (e.g. by a CAS
+                # login) since the query above; create the rest one at a
+                # time, so those are reported as updated, not created
+                created = [netid for netid in created if
+                           User.objects.get_or_create(username=netid)[1]]
+        created = set(created)
+
+        # re-fetch so that new accounts have primary keys on all databases
+        users = list(User.objects.filter(username__in=list(found)))
+        changed_fields = set()
+        for user in users:
+            initial = user_field_values(user)
+            populate_user(user, found[user.username])
+            if staff or superuser:
+                user.is_staff = True
+                if superuser:
+                    user.is_superuser = True
+                user.is_active = True
+            elif activate_created and user.username in created:
+                user.is_active = True
+            changed_fields.update(changed_user_fields(user, initial))
+
+        if changed_fields:
+            User.objects.bulk_update(users, sorted(changed_fields))
+
+    for netid in found:
+        if netid in created:
+            summary.created.append(netid)
+        else:
+            summary.updated.append(netid)
+    return summary
@@ -1,50 +1,198 @@
-from django.core.management.base import BaseCommand
+import csv
+import json
+import os
+import sys
+from itertools import chain, islice
 
-from pucas.ldap import LDAPSearchException, init_cas_user
+from django.core.management.base import BaseCommand, CommandError
+
+from pucas.ldap import bulk_init_cas_users
+
+
+#: values treated as true for per-row staff/admin flags
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'x')
+
+
+def is_true(value):
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def read_roster(infile):
+    '''Read ``(netid, staff, admin)`` rows from a roster file.
+
+    JSONL (one object per line with ``netid`` and optional ``staff`` and
+    ``admin``) is detected by a first line starting with ``{``; otherwise
+    the file is read as CSV, with a header row including ``netid`` (and
+    optional ``staff`` and ``admin`` columns), or netids in the first
+    column if there is no header.  Rows are read as needed, so large
+    files are not loaded into memory.
+    '''
+    first_line = infile.readline()
+    lines = chain([first_line], infile)
+    if first_line.lstrip().startswith('{'):
+        for line in lines:
+            if line.strip():
+                row = json.loads(line)
+                yield (str(row['netid']).strip(), is_true(row.get('staff')),
+                       is_true(row.get('admin')))
+        return
+
+    reader = csv.reader(lines)
+    header = [col.strip().lower() for col in next(reader, [])]
+    if 'netid' in header:
+        columns = {name: header.index(name) for name in
+                   ('netid', 'staff', 'admin') if name in header}
+    else:
+        # no header; first row is data
+        columns = {'netid': 0}
+        reader = chain([header], reader)
+
+    def value(row, name):
+        index = columns.get(name)
+        return row[index] if index is not None and index < len(row) else ''
+
+    for row in reader:
+        netid = value(row, 'netid').strip()
+        if netid:
+            yield netid, is_true(value(row, 'staff')), \
+                is_true(value(row, 'admin'))
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class Command(BaseCommand):
     help = 'Initialize a new CAS user account'
 
     def add_arguments(self, parser):
-        parser.add_argument('netids', nargs='+')
+        parser.add_argument('netids', nargs='*')
         parser.add_argument(
             '--admin',
             help='Give the specified user(s) superuser permissions (equivalent to createsuperuser)',
             action='store_true',
             default=False
         )
+        parser.add_argument(
+            '--workers',
+            help='Number of concurrent LDAP searches (default: MAX_CONCURRENCY setting, or 1)',
+            type=int,
+            default=None
+        )
         parser.add_argument(
             '--staff',
             help='Give the specified user(s) staff permissions',
             action='store_true',
             default=False
         )
+        parser.add_argument(
+            '--from-file',
+            help='Read netids from a CSV or JSONL roster file ("-" for stdin), '
+                 'with optional per-row staff and admin flags',
+            metavar='PATH'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            help='Number of roster rows to process at a time (default: 1000)',
+            type=int,
+            default=1000
+        )
+        parser.add_argument(
+            '--result-log',
+            help='Append a JSON line with the result for each netid to this file',
+            metavar='PATH'
+        )
+        parser.add_argument(
+            '--resume',
+            help='Skip netids already recorded in the result log',
+            action='store_true',
+            default=False
+        )
 
     def handle(self, *args, **options):
         netids = options['netids']
         admin = options['admin']
         staff = options['staff']
-        for netid in netids:
-            try:
-                user, created = init_cas_user(netid)
-
-                # If admin flag is set, make the user an admin
-                if admin or staff:
-                    user.is_staff = True
-                    if admin:
-                        user.is_superuser = True
-                    # ensure admin/staff accounts are active even if
+        from_file = options.get('from_file')
+        result_log = options.get('result_log')
+
+        if not netids and not from_file:
+            raise CommandError('Specify one or more netids or --from-file')
+        if options.get('resume') and not result_log:
+            raise CommandError('--resume requires --result-log')
+
+        rows = ((netid, False, False) for netid in netids)
+        infile = None
+        if from_file:
+            if from_file == '-':
+                infile = sys.stdin
+            else:
+                try:
+                    infile = open(from_file, newline='', encoding='utf-8')
+                except OSError as err:
+                    raise CommandError(err)
+            rows = chain(rows, read_roster(infile))
+
+        done = set()
+        if options.get('resume') and os.path.exists(result_log):
+            with open(result_log, encoding='utf-8') as logfile:
+                done = set(json.loads(line)['netid'] for line in logfile
+                           if line.strip())
+            if done:
+                self.stdout.write('Skipping %d netids in %s' %
+                                  (len(done), result_log))
+
+        logfile = open(result_log, 'a', encoding='utf-8') \
+            if result_log else None
+        try:
+            rows = (row for row in rows if row[0] not in done)
+            for chunk in chunked(rows, options.get('chunk_size') or 1000):
+                # group by permissions, since they apply to a whole batch
+                groups = {}
+                for netid, row_staff, row_admin in chunk:
+                    row_admin = admin or row_admin
+                    # If admin flag is set, make the user an admin;
+                    # admin/staff accounts are also made active even if
                     # EXTRA_USER_INIT set them inactive
-                    user.is_active = True
-                    user.save()
-
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        "%s user '%s'"
-                        % ('Created' if created else 'Updated', netid)))
-
-            except LDAPSearchException:
-                self.stderr.write(
-                    self.style.ERROR("LDAP information for '%s' not found"
-                                     % netid))
+                    key = (staff or row_staff or row_admin, row_admin)
+                    groups.setdefault(key, []).append(netid)
+
+                for (group_staff, group_admin), group in groups.items():
+                    result = bulk_init_cas_users(
+                        group, staff=group_staff, superuser=group_admin,
+                        workers=options.get('workers'))
+                    self.report(result, logfile)
+        finally:
+            if logfile is not None:
+                logfile.close()
+            if infile is not None and infile is not sys.stdin:
+                infile.close()
+
+    def report(self, result, logfile=None):
+        for netid in result.created:
+            self.stdout.write(self.style.SUCCESS("Created user '%s'" % netid))
+        for netid in result.updated:
+            self.stdout.write(self.style.SUCCESS("Updated user '%s'" % netid))
+        for netid in result.ambiguous:
+            self.stderr.write(
+                self.style.ERROR("Found more than one LDAP entry for '%s'"
+                                 % netid))
+        for netid in result.not_found:
+            self.stderr.write(
+                self.style.ERROR("LDAP information for '%s' not found"
+                                 % netid))
+
+        if logfile is not None:
+            for status, netids in result._asdict().items():
+                for netid in netids:
+                    logfile.write(json.dumps({'netid': netid,
+                                              'status': status}) + '\n')
+            # flush after each batch, so an interrupted run can resume
+            logfile.flush()
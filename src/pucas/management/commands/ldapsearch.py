@@ -1,31 +1,138 @@
+import csv
+import json
+import sys
+from itertools import chain, islice
+
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
+from pucas.config import get_plan
 from pucas.ldap import LDAPSearch, LDAPSearchException
 
 
+FORMATS = ('text', 'json', 'jsonl', 'csv')
+
+
+def entry_record(netid, status, entry=None):
+    '''Dict for machine-readable output of one netid's search result.'''
+    record = {'netid': netid, 'status': status}
+    if entry is not None:
+        record['dn'] = entry.entry_dn
+        record['attributes'] = entry.entry_attributes_as_dict
+    return record
+
+
 class Command(BaseCommand):
     help = 'Look up one or more users in LDAP by netid'
 
     def add_arguments(self, parser):
-        parser.add_argument('netid', nargs='+')
+        parser.add_argument('netid', nargs='*')
         parser.add_argument('--all', '-a', action='store_true',
             help='Retrieve all available LDAP attributes')
+        parser.add_argument('--workers', type=int, default=None,
+            help='Number of concurrent LDAP searches (default: '
+                 'MAX_CONCURRENCY setting, or 1)')
+        parser.add_argument('--format', choices=FORMATS, default='text',
+            help='Output format (default: text)')
+        parser.add_argument('--stdin', action='store_true',
+            help='Also read netids from stdin, one per line')
 
     def handle(self, *args, **options):
+        output_format = options.get('format') or 'text'
+        if output_format == 'csv' and options['all']:
+            raise CommandError('--all is not supported with csv output')
+
+        if not options['netid'] and not options.get('stdin'):
+            raise CommandError('Specify one or more netids or --stdin')
+
+        netids = iter(options['netid'])
+        if options.get('stdin'):
+            netids = (line.strip() for line in
+                      chain(options['netid'], sys.stdin) if line.strip())
+
+        writer = getattr(self, 'write_%s' % output_format)
+        # search and output a batch at a time, so results are streamed
+        batch_size = getattr(settings, 'PUCAS_LDAP', {}).get('BATCH_SIZE', 100)
         ldap_search = LDAPSearch()
-        for netid in options['netid']:
+        self.start(output_format)
+        try:
+            while True:
+                batch = list(islice(netids, batch_size))
+                if not batch:
+                    break
+                results = ldap_search.find_users(
+                    batch, all_attributes=options['all'],
+                    workers=options.get('workers'))
+                writer(batch, results, options)
+                self.stdout.flush()
+        except LDAPSearchException as err:
+            self.stderr.write(self.style.ERROR(str(err)))
+        finally:
+            # close the output (e.g. the json array) even if a search
+            # fails partway, so results so far are still valid
+            self.finish(output_format)
+            ldap_search.close()
+
+    def start(self, output_format):
+        self._records = 0
+        if output_format == 'json':
+            self.stdout.write('[', ending='')
+        elif output_format == 'csv':
+            self._csv = csv.writer(self.stdout, lineterminator='')
+            self._csv.writerow(['netid', 'status', 'dn'] +
+                               list(get_plan().attributes))
+
+    def finish(self, output_format):
+        if output_format == 'json':
+            self.stdout.write('\n]' if self._records else ']')
+
+    def records(self, batch, results):
+        for netid in batch:
+            if netid in results.found:
+                yield entry_record(netid, 'found', results.found[netid])
+            elif netid in results.ambiguous:
+                yield entry_record(netid, 'ambiguous')
+            else:
+                yield entry_record(netid, 'not_found')
+
+    def write_text(self, batch, results, options):
+        for netid in batch:
             self.stdout.write('\nLooking for %s...' % netid)
-            try:
-                info = ldap_search.find_user(netid, all_attributes=options['all'])
+            if netid in results.found:
+                info = results.found[netid]
                 # if all attributes were requested, just print the returned
                 # ldap search object
                 if options['all']:
-                    self.stdout.write(info)
-                # otherwise, display attributes configured in settings
+                    self.stdout.write(str(info))
+                # otherwise, display the attributes requested
                 else:
-                    for attr in settings.PUCAS_LDAP['ATTRIBUTES']:
+                    for attr in get_plan().attributes:
                         self.stdout.write('%-15s %s' % (attr, getattr(info, attr)))
-            except LDAPSearchException as err:
-                self.stderr.write(self.style.ERROR(str(err)))
+            elif netid in results.ambiguous:
+                self.stderr.write(self.style.ERROR(
+                    'Found more than one entry for %s' % netid))
+            else:
+                self.stderr.write(self.style.ERROR(
+                    'No match found for %s' % netid))
+
+    def write_json(self, batch, results, options):
+        for record in self.records(batch, results):
+            self.stdout.write('%s\n  %s' % (',' if self._records else '',
+                                            json.dumps(record, default=str)),
+                              ending='')
+            self._records += 1
+
+    def write_jsonl(self, batch, results, options):
+        for record in self.records(batch, results):
+            self.stdout.write(json.dumps(record, default=str))
 
+    def write_csv(self, batch, results, options):
+        attributes = get_plan().attributes
+        for record in self.records(batch, results):
+            # ldap attribute names are case-insensitive
+            values = {attr.lower(): value for attr, value in
+                      record.get('attributes', {}).items()}
+            self._csv.writerow(
+                [record['netid'], record['status'], record.get('dn', '')] +
+                ['; '.join(str(val) for val in values.get(attr.lower(), []))
+                 for attr in attributes])
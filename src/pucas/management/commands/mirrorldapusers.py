@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pucas.ldap import LDAPSearchException
+from pucas.mirror import import_directory, mirror_config
+
+
+class Command(BaseCommand):
+    help = 'Import LDAP entries into the local directory mirror'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--filter',
+            help='LDAP filter for entries to import (default: MIRROR '
+                 'FILTER setting, or all entries with a netid)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of entries to save at a time (default: 1000)')
+
+    def handle(self, *args, **options):
+        if mirror_config() is None:
+            raise CommandError('Directory mirror is not enabled; '
+                               'configure MIRROR in PUCAS_LDAP')
+        try:
+            imported, removed = import_directory(
+                batch_size=options['batch_size'],
+                search_filter=options['filter'])
+        except LDAPSearchException as err:
+            raise CommandError(str(err))
+        self.stdout.write('Mirrored %d entries, removed %d' %
+                          (imported, removed))
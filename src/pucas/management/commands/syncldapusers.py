@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from pucas.sync import cas_users, run_sync
+
+
+class Command(BaseCommand):
+    help = 'Refresh CAS user account info from LDAP'
+
+    def add_arguments(self, parser):
+        parser.add_argument('netids', nargs='*',
+            help='Only refresh the specified users (default: all CAS users)')
+        parser.add_argument('--full', action='store_true',
+            help='Check all entries, not only those modified since the last sync')
+        parser.add_argument('--since',
+            help='Only check entries modified since this LDAP timestamp '
+                 '(e.g. 20260101000000Z)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of users to load and look up at a time (default: 1000)')
+        parser.add_argument('--workers', type=int, default=None,
+            help='Number of concurrent LDAP searches (default: '
+                 'MAX_CONCURRENCY setting, or 1)')
+
+    def handle(self, *args, **options):
+        users = None
+        if options['netids']:
+            users = cas_users().filter(username__in=options['netids'])
+
+        sync, result = run_sync(users, full=options['full'],
+                                since=options['since'],
+                                batch_size=options['batch_size'],
+                                workers=options['workers'])
+
+        self.stdout.write(
+            '%s sync: %d checked, %d changed in LDAP, %d updated' % (
+                'Incremental' if sync.incremental else 'Full',
+                result.checked, result.changed, result.updated))
+        if result.not_found:
+            self.stderr.write(self.style.WARNING(
+                '%d users not found in LDAP' % result.not_found))
@@ -0,0 +1,153 @@
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Sent for each metric recorded, with the metric name as sender and
+#: ``kind`` (``'timing'``, in milliseconds, or ``'counter'``),
+#: ``value`` and ``tags`` (a dict) as arguments.
+metric_recorded = Signal()
+
+
+class MetricsBackend(object):
+    '''Base class for metrics backends.'''
+
+    def timing(self, name, value, tags):
+        '''Record a duration in milliseconds.'''
+        raise NotImplementedError
+
+    def incr(self, name, value, tags):
+        '''Increment a counter.'''
+        raise NotImplementedError
+
+
+class InMemoryMetrics(MetricsBackend):
+    '''Keeps metrics in memory; for tests and debugging.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def timing(self, name, value, tags):
+        with self._lock:
+            self.timings[name].append(value)
+
+    def incr(self, name, value, tags):
+        with self._lock:
+            self.counters[name] += value
+
+    def reset(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+
+
+class StatsdMetrics(MetricsBackend):
+    '''Sends metrics to a statsd server over UDP.  With
+    ``tag_format='dogstatsd'``, tags are sent in DogStatsD format;
+    otherwise they are not sent.'''
+
+    def __init__(self, host='localhost', port=8125, prefix='pucas',
+                 tag_format=None):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tag_format = tag_format
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, name, value, metric_type, tags):
+        if self.prefix:
+            name = '%s.%s' % (self.prefix, name)
+        packet = '%s:%s|%s' % (name, value, metric_type)
+        if tags and self.tag_format == 'dogstatsd':
+            packet += '|#' + ','.join('%s:%s' % tag for tag in tags.items())
+        try:
+            self.sock.sendto(packet.encode('utf-8'), self.address)
+        except OSError as err:
+            # metrics should never break a login
+            logger.debug('Error sending metric to statsd: %s', err)
+
+    def timing(self, name, value, tags):
+        self.send(name, round(value, 3), 'ms', tags)
+
+    def incr(self, name, value, tags):
+        self.send(name, value, 'c', tags)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_metrics_backend():
+    '''Get the configured metrics backend, or None.
+
+    Configured with ``METRICS`` in ``PUCAS_LDAP``, a dict with
+    ``BACKEND`` (dotted path to a :class:`MetricsBackend` subclass) and
+    optional ``OPTIONS`` to initialize it with.
+    '''
+    global _backend
+    config = getattr(settings, 'PUCAS_LDAP', {}).get('METRICS', None)
+    if not config:
+        return None
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(config['BACKEND'])(
+                **config.get('OPTIONS', {}))
+        return _backend
+
+
+@receiver(setting_changed)
+def metrics_settings_changed(sender, setting, **kwargs):
+    global _backend
+    if setting == 'PUCAS_LDAP':
+        with _backend_lock:
+            _backend = None
+
+
+def _record(kind, name, value, tags):
+    backend = get_metrics_backend()
+    if backend is not None:
+        if kind == 'timing':
+            backend.timing(name, value, tags)
+        else:
+            backend.incr(name, value, tags)
+    if metric_recorded.has_listeners(name):
+        metric_recorded.send(sender=name, kind=kind, value=value, tags=tags)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s %s=%s', kind, name, value, extra={
+            'metric': name, 'metric_kind': kind, 'metric_value': value,
+            'metric_tags': tags})
+
+
+def incr(name, value=1, **tags):
+    '''Increment a counter.'''
+    _record('counter', name, value, tags)
+
+
+def timing(name, value, **tags):
+    '''Record a duration in milliseconds.'''
+    _record('timing', name, value, tags)
+
+
+@contextmanager
+def timer(name, **tags):
+    '''Context manager to record the time taken by a block, in
+    milliseconds; an exception also increments ``<name>.errors``.'''
+    start = time.perf_counter()
+    try:
+        yield tags
+    except Exception:
+        incr('%s.errors' % name, **tags)
+        raise
+    finally:
+        _record('timing', name, (time.perf_counter() - start) * 1000, tags)
@@ -0,0 +1,35 @@
+import logging
+
+from ldap3.core.exceptions import LDAPException
+
+from pucas.lazy import ensure_user_info
+
+
+logger = logging.getLogger(__name__)
+
+
+class LazyUserInfoMiddleware(object):
+    '''Populate a logged-in user's info from LDAP on their first request,
+    if it is pending because of ``POPULATE_ON_LOGIN = 'lazy'``.
+
+    Checked once per session; add after
+    ``AuthenticationMiddleware`` and ``SessionMiddleware``.
+    '''
+
+    session_key = 'pucas_user_info_checked'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated and \
+                not request.session.get(self.session_key):
+            try:
+                ensure_user_info(user)
+                request.session[self.session_key] = True
+            except LDAPException as err:
+                # don't fail the request; try again on the next one
+                logger.warning('Unable to populate user info for %s: %s',
+                               user.username, err)
+        return self.get_response(request)
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LDAPSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('incremental', models.BooleanField(default=False)),
+                ('high_water_mark', models.CharField(max_length=32)),
+                ('checked', models.PositiveIntegerField(default=0)),
+                ('updated', models.PositiveIntegerField(default=0)),
+                ('not_found', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'LDAP sync',
+                'ordering': ['-started'],
+                'get_latest_by': 'started',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pucas', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUserInfo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pucas_pending_user_info', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'pending LDAP user info',
+                'verbose_name_plural': 'pending LDAP user info',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pucas', '0003_casuserinitjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryMirrorEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('netid', models.CharField(max_length=150, unique=True)),
+                ('dn', models.TextField()),
+                ('attributes', models.TextField()),
+                ('attributes_key', models.CharField(max_length=12)),
+                ('fetched_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name': 'directory mirror entry',
+                'verbose_name_plural': 'directory mirror entries',
+            },
+        ),
+    ]
@@ -0,0 +1,134 @@
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from ldap3.core.exceptions import LDAPCursorError
+
+from pucas.cache import attributes_key
+from pucas.config import get_plan
+from pucas.entry import DirectoryEntry
+from pucas.metrics import incr
+from pucas.models import DirectoryMirrorEntry
+
+
+logger = logging.getLogger(__name__)
+
+
+def mirror_config():
+    '''Options for the directory mirror, from ``MIRROR`` in
+    ``PUCAS_LDAP``, or None if not enabled: ``MAX_AGE`` (seconds a
+    mirrored entry is used for lookups; default 86400) and ``FILTER``
+    (optional LDAP filter for entries to import).'''
+    config = getattr(settings, 'PUCAS_LDAP', {}).get('MIRROR', None)
+    if not config:
+        return None
+    options = {'MAX_AGE': 86400, 'FILTER': None}
+    options.update(config)
+    return options
+
+
+def get_mirrored(netids, attributes, stale=False):
+    '''Return a dict of netid to :class:`~pucas.entry.DirectoryEntry` for
+    netids with a mirrored entry retrieved with ``attributes`` within
+    ``MAX_AGE``, or of any age with ``stale=True``.  Returns an empty
+    dict if the mirror is not enabled.'''
+    config = mirror_config()
+    if config is None or not netids:
+        return {}
+    entries = DirectoryMirrorEntry.objects.filter(
+        netid__in=[netid.lower() for netid in netids],
+        attributes_key=attributes_key(attributes))
+    if not stale:
+        entries = entries.filter(fetched_at__gte=timezone.now() -
+                                 timedelta(seconds=config['MAX_AGE']))
+    mirrored = {entry.netid: DirectoryEntry(entry.dn,
+                                            json.loads(entry.attributes))
+                for entry in entries}
+    # map back to netids as requested
+    result = {netid: mirrored[netid.lower()] for netid in netids
+              if netid.lower() in mirrored}
+    incr('mirror.hits', len(result))
+    incr('mirror.misses', len(netids) - len(result))
+    return result
+
+
+def update_mirror(entries, attributes):
+    '''Store a dict of netid to LDAP entry in the mirror, replacing any
+    existing entries for those netids.  Best effort: if a concurrent
+    write for the same netids conflicts, the entries are not stored.'''
+    if not entries:
+        return
+    attrs_key = attributes_key(attributes)
+    now = timezone.now()
+    rows = {}
+    for netid, entry in entries.items():
+        entry = DirectoryEntry.from_entry(entry)
+        rows[netid.lower()] = DirectoryMirrorEntry(
+            netid=netid.lower(), dn=entry.entry_dn,
+            # values that aren't JSON types (e.g. dates) are stored as text
+            attributes=json.dumps(entry.entry_attributes_as_dict, default=str),
+            attributes_key=attrs_key, fetched_at=now)
+    try:
+        with transaction.atomic():
+            DirectoryMirrorEntry.objects.filter(netid__in=list(rows)).delete()
+            DirectoryMirrorEntry.objects.bulk_create(rows.values())
+    except IntegrityError as err:
+        # e.g. the same user looked up in two requests at once; the
+        # other write has the entry
+        logger.warning('Unable to update directory mirror: %s', err)
+        incr('mirror.errors')
+
+
+def import_directory(batch_size=1000, search_filter=None):
+    '''Import all matching LDAP entries into the mirror with a paged
+    search, saving ``batch_size`` entries at a time; entries that were
+    not returned (e.g. removed from the directory) are deleted from the
+    mirror afterwards.  Entries are matched with ``search_filter``, the
+    ``FILTER`` option, or any value for the netid attribute.  Returns a
+    tuple of the number of entries imported and removed.'''
+    # avoid circular import
+    from pucas.ldap import LDAPSearch
+
+    config = mirror_config() or {}
+    attributes = get_plan().attributes
+    started = timezone.now()
+    imported = 0
+
+    ldap = LDAPSearch()
+    try:
+        ldap.check_config()
+        netid_attr = ldap.netid_attribute()
+        search_attributes = list(attributes)
+        if netid_attr.lower() not in [attr.lower() for attr in attributes]:
+            search_attributes.append(netid_attr)
+        search_filter = search_filter or config.get('FILTER') or \
+            '(%s=*)' % netid_attr
+
+        batch = {}
+        for entry in ldap._paged_search(
+                settings.PUCAS_LDAP['SEARCH_BASE'], search_filter,
+                search_attributes, settings.PUCAS_LDAP.get('PAGE_SIZE', 500)):
+            try:
+                values = getattr(entry, netid_attr).values
+            except LDAPCursorError:
+                continue
+            for value in values:
+                batch[str(value)] = entry
+            if len(batch) >= batch_size:
+                update_mirror(batch, attributes)
+                imported += len(batch)
+                batch = {}
+        if batch:
+            update_mirror(batch, attributes)
+            imported += len(batch)
+    finally:
+        ldap.close()
+
+    removed, _ = DirectoryMirrorEntry.objects \
+        .filter(fetched_at__lt=started).delete()
+    logger.info('Imported %d entries into directory mirror; removed %d',
+                imported, removed)
+    return imported, removed
@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.db import models
+
+
+class LDAPSync(models.Model):
+    '''Record of a run of the ``syncldapusers`` command, used to find
+    the changes since the last run.'''
+
+    #: when the sync started
+    started = models.DateTimeField()
+    #: when the sync finished; empty if it did not complete
+    finished = models.DateTimeField(null=True, blank=True)
+    #: whether only entries modified since the previous sync were requested
+    incremental = models.BooleanField(default=False)
+    #: LDAP generalized time to use as ``modifyTimestamp`` lower bound
+    #: for the next incremental sync
+    high_water_mark = models.CharField(max_length=32)
+    #: number of users checked
+    checked = models.PositiveIntegerField(default=0)
+    #: number of users updated
+    updated = models.PositiveIntegerField(default=0)
+    #: number of users not found in LDAP (full sync only)
+    not_found = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-started']
+        get_latest_by = 'started'
+        verbose_name = 'LDAP sync'
+
+    def __str__(self):
+        return 'LDAP sync %s' % self.started.isoformat()
+
+
+class PendingUserInfo(models.Model):
+    '''Marks a user whose info has not been populated from LDAP yet,
+    with ``POPULATE_ON_LOGIN = 'lazy'``.'''
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+                                on_delete=models.CASCADE,
+                                related_name='pucas_pending_user_info')
+    #: when the user was marked as pending
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'pending LDAP user info'
+        verbose_name_plural = 'pending LDAP user info'
+
+    def __str__(self):
+        return 'LDAP user info pending for %s' % self.user
+
+
+class CasUserInitJob(models.Model):
+    '''Background job to initialize CAS user accounts for a large
+    submission of the admin **Add CAS Users** form.'''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    #: netids to initialize, one per line
+    netids = models.TextField()
+    #: whether existing accounts are also updated from LDAP
+    refresh_existing = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    #: number of netids to initialize
+    total = models.PositiveIntegerField(default=0)
+    #: number of netids processed, including those not found
+    completed = models.PositiveIntegerField(default=0)
+    #: number of netids that could not be processed due to errors
+    failed = models.PositiveIntegerField(default=0)
+    #: results, as netids one per line
+    created_netids = models.TextField(blank=True)
+    existing_netids = models.TextField(blank=True)
+    not_found_netids = models.TextField(blank=True)
+    failed_netids = models.TextField(blank=True)
+    #: error message, if the job failed
+    error = models.TextField(blank=True)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+                                     blank=True, on_delete=models.SET_NULL,
+                                     related_name='+')
+    created = models.DateTimeField(auto_now_add=True)
+    #: last saved progress, for restarting jobs that have stalled
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = 'CAS user init job'
+
+    def __str__(self):
+        return 'CAS user init job %s (%s)' % (self.pk, self.status)
+
+    @staticmethod
+    def split(netids):
+        return netids.split() if netids else []
+
+    def netid_list(self):
+        return self.split(self.netids)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def results(self):
+        '''Dict of result netid lists: created, existing, not_found
+        and failed.'''
+        return {
+            'created': self.split(self.created_netids),
+            'existing': self.split(self.existing_netids),
+            'not_found': self.split(self.not_found_netids),
+            'failed': self.split(self.failed_netids),
+        }
+
+
+class DirectoryMirrorEntry(models.Model):
+    '''Local copy of an LDAP entry, for lookups without contacting the
+    directory; see :mod:`pucas.mirror`.'''
+
+    #: netid, lower case
+    netid = models.CharField(max_length=150, unique=True)
+    dn = models.TextField()
+    #: LDAP attributes, as a JSON object of attribute name to list of values
+    attributes = models.TextField()
+    #: key for the set of attributes requested (see
+    #: :func:`pucas.cache.attributes_key`)
+    attributes_key = models.CharField(max_length=12)
+    #: when the entry was retrieved from LDAP
+    fetched_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = 'directory mirror entry'
+        verbose_name_plural = 'directory mirror entries'
+
+    def __str__(self):
+        return self.netid
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from ldap3.core.exceptions import LDAPException
+
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPConnectionPool(object):
+    '''Thread-safe pool of bound LDAP connections.
+
+    Connections are created on demand by calling ``factory`` and returned
+    to the pool with :meth:`release`.  At most ``size`` idle connections are
+    kept; checking out never blocks, so a connection that is never
+    released is simply not reused.  Idle connections older than
+    ``idle_timeout`` seconds, or that are no longer open and bound, are
+    discarded at checkout instead of being handed out.
+    '''
+
+    def __init__(self, factory, size=10, idle_timeout=300):
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Check out a healthy connection, opening a new one if needed.'''
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                # most recently released first, so stale connections
+                # age out at the other end of the queue
+                conn, last_used = self._idle.pop()
+            if self.idle_timeout and now - last_used > self.idle_timeout:
+                logger.debug('Discarding idle LDAP connection %s', conn)
+                self.discard(conn)
+            elif not self.is_healthy(conn):
+                logger.debug('Discarding stale LDAP connection %s', conn)
+                self.discard(conn)
+            else:
+                return conn
+
+        return self.factory()
+
+    def release(self, conn):
+        '''Return a connection to the pool, or close it if the pool is full.'''
+        if conn is None:
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self.discard(conn)
+
+    def replace(self, conn):
+        '''Discard a connection that failed and open a fresh one.'''
+        self.discard(conn)
+        return self.factory()
+
+    def discard(self, conn):
+        '''Unbind a connection without returning it to the pool.'''
+        try:
+            conn.unbind()
+        except LDAPException as err:
+            logger.debug('Error closing LDAP connection: %s', err)
+
+    def clear(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self.discard(conn)
+
+    @staticmethod
+    def is_healthy(conn):
+        return not conn.closed and conn.bound
+
+    def __len__(self):
+        return len(self._idle)
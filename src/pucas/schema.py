@@ -0,0 +1,93 @@
+import logging
+import os
+import tempfile
+import threading
+
+from ldap3.core.exceptions import LDAPException
+from ldap3.protocol.rfc4512 import SchemaInfo
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA_CACHE_KEY = 'pucas:ldap-schema'
+
+_schema = None
+_schema_lock = threading.Lock()
+
+
+def snapshot_configured():
+    return bool(settings.PUCAS_LDAP.get('SCHEMA_FILE') or
+                settings.PUCAS_LDAP.get('SCHEMA_CACHE_ALIAS'))
+
+
+def load_schema():
+    '''Load the schema snapshot configured with ``SCHEMA_FILE`` and/or
+    ``SCHEMA_CACHE_ALIAS``; loaded once per process.  Returns None if no
+    snapshot is configured or none has been saved yet.'''
+    global _schema
+    if _schema is not None or not snapshot_configured():
+        return _schema
+
+    with _schema_lock:
+        if _schema is None:
+            schema_json = None
+            alias = settings.PUCAS_LDAP.get('SCHEMA_CACHE_ALIAS')
+            if alias:
+                schema_json = caches[alias].get(SCHEMA_CACHE_KEY)
+            path = settings.PUCAS_LDAP.get('SCHEMA_FILE')
+            if schema_json is None and path and os.path.exists(path):
+                with open(path) as schema_file:
+                    schema_json = schema_file.read()
+            if schema_json is not None:
+                try:
+                    _schema = SchemaInfo.from_json(schema_json)
+                except (LDAPException, ValueError) as err:
+                    # e.g. a truncated file
+                    logger.warning('Ignoring invalid LDAP schema snapshot: %s',
+                                   err)
+    return _schema
+
+
+def save_schema(schema):
+    '''Save a schema read from the server as the configured snapshot.'''
+    global _schema
+    if schema is None or not snapshot_configured():
+        return
+    schema_json = schema.to_json()
+    alias = settings.PUCAS_LDAP.get('SCHEMA_CACHE_ALIAS')
+    if alias:
+        caches[alias].set(SCHEMA_CACHE_KEY, schema_json, None)
+    path = settings.PUCAS_LDAP.get('SCHEMA_FILE')
+    if path:
+        # write to a temporary file and move it into place, so other
+        # processes never read a partially written snapshot
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(os.path.abspath(path)),
+                    prefix='.schema-', delete=False) as schema_file:
+                tmp_path = schema_file.name
+                schema_file.write(schema_json)
+            # temporary files are only readable by the owner
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            logger.warning('Unable to save LDAP schema snapshot to %s: %s',
+                           path, err)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    with _schema_lock:
+        _schema = schema
+
+
+@receiver(setting_changed)
+def schema_settings_changed(sender, setting, **kwargs):
+    global _schema
+    if setting == 'PUCAS_LDAP':
+        with _schema_lock:
+            _schema = None
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from pucas.metrics import timing
+
+
+class ServerStats(object):
+    '''Moving averages of latency (in milliseconds) and error rate for
+    one LDAP server.'''
+
+    __slots__ = ('latency', 'error_rate', 'samples', 'probed')
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.probed = 0.0
+
+    def as_dict(self):
+        return {'latency': self.latency, 'error_rate': self.error_rate,
+                'samples': self.samples}
+
+
+class ServerSelector(object):
+    '''Orders LDAP servers by recent latency and error rate.
+
+    Latency and errors for binds and searches are tracked as
+    exponentially weighted moving averages (``alpha`` is the weight of
+    each new sample).  Servers are ordered by latency, penalized by
+    ``error_penalty`` times their error rate and divided by their
+    ``weights`` (default 1; higher is preferred, e.g. for a nearby
+    replica).  Servers not yet measured are tried first, and every
+    ``probe_interval`` seconds the least recently probed of the other
+    servers is moved to the front, so demoted servers are measured again
+    when they recover.
+    '''
+
+    def __init__(self, servers, weights=None, alpha=0.3, error_penalty=10,
+                 probe_interval=60):
+        self.servers = list(servers)
+        self.weights = weights or {}
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.probe_interval = probe_interval
+        self._stats = {server: ServerStats() for server in self.servers}
+        self._lock = threading.Lock()
+        self._last_probe = time.monotonic()
+
+    def score(self, server):
+        stats = self._stats[server]
+        if stats.latency is None:
+            return 0
+        return stats.latency * (1 + self.error_penalty * stats.error_rate) \
+            / self.weights.get(server, 1)
+
+    def order(self):
+        '''Servers in order of preference.'''
+        with self._lock:
+            ordered = sorted(self.servers, key=self.score)
+            now = time.monotonic()
+            if len(ordered) > 1 and \
+                    now - self._last_probe >= self.probe_interval:
+                # re-probe a demoted server
+                self._last_probe = now
+                server = min(ordered[1:],
+                             key=lambda server: self._stats[server].probed)
+                self._stats[server].probed = now
+                ordered.remove(server)
+                ordered.insert(0, server)
+            return ordered
+
+    def record(self, server, latency=None, error=False):
+        '''Record a bind or search on a server, with its latency in
+        seconds if it succeeded.'''
+        stats = self._stats.get(server)
+        if stats is None:
+            return
+        with self._lock:
+            stats.samples += 1
+            stats.error_rate += self.alpha * (float(error) - stats.error_rate)
+            if latency is not None:
+                latency *= 1000
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency += self.alpha * (latency - stats.latency)
+        if latency is not None:
+            timing('ldap.server.latency', latency, server=server)
+
+    def stats(self):
+        '''Current stats for each server, by server.'''
+        with self._lock:
+            return {server: dict(self._stats[server].as_dict(),
+                                 score=self.score(server),
+                                 weight=self.weights.get(server, 1))
+                    for server in self.servers}
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+
+def get_server_selector():
+    '''Get the process-wide :class:`ServerSelector`, or None unless
+    ``SERVER_SELECTION`` in ``PUCAS_LDAP`` is ``'latency'``.
+
+    Optional ``SERVER_WEIGHTS`` is a dict of server to weight, and
+    ``SERVER_PROBE_INTERVAL`` the seconds between re-probes of demoted
+    servers (default 60).
+    '''
+    global _selector
+    config = getattr(settings, 'PUCAS_LDAP', {})
+    if config.get('SERVER_SELECTION', 'round_robin') != 'latency':
+        return None
+    with _selector_lock:
+        if _selector is None:
+            _selector = ServerSelector(
+                config['SERVERS'], weights=config.get('SERVER_WEIGHTS', None),
+                probe_interval=config.get('SERVER_PROBE_INTERVAL', 60))
+        return _selector
+
+
+def server_stats():
+    '''Per-server latency and error stats, or an empty dict if
+    latency-aware selection is not enabled.'''
+    selector = get_server_selector()
+    return selector.stats() if selector is not None else {}
+
+
+@receiver(setting_changed)
+def servers_settings_changed(sender, setting, **kwargs):
+    global _selector
+    if setting == 'PUCAS_LDAP':
+        with _selector_lock:
+            _selector = None
@@ -1,7 +1,11 @@
+from django.conf import settings
+from django.db import transaction
 from django.dispatch import receiver
 from django_cas_ng.signals import cas_user_authenticated
 
+from pucas.breaker import ldap_unavailable
 from pucas.ldap import user_info_from_ldap
+from pucas.tasks import defer_user_info
 
 
 @receiver(cas_user_authenticated)
@@ -11,6 +15,17 @@ def cas_login(sender, user, created, **kwargs):
 
     # only populate attributes when a new user is created
     if created:
-        user_info_from_ldap(user)
-
-
+        populate = getattr(settings, 'PUCAS_LDAP', {}) \
+            .get('POPULATE_ON_LOGIN', 'sync')
+        # if the directory is known to be down, mark the user as pending
+        # rather than failing the login; it is populated once LDAP is
+        # back, when first needed or by the next sync (see pucas.lazy)
+        if populate == 'lazy' or ldap_unavailable():
+            from pucas.lazy import mark_pending
+            mark_pending(user)
+        elif populate == 'deferred':
+            # don't make the login wait on LDAP; queue once the new
+            # user record is committed, so the task can load it
+            transaction.on_commit(lambda: defer_user_info(user))
+        else:
+            user_info_from_ldap(user)
@@ -0,0 +1,162 @@
+import logging
+from collections import namedtuple
+from datetime import timedelta, timezone
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone as django_timezone
+
+from pucas.cache import invalidate_entry_cache
+from pucas.ldap import LDAPSearch, changed_user_fields, populate_user, \
+    user_field_values
+from pucas.models import LDAPSync, PendingUserInfo
+
+
+logger = logging.getLogger(__name__)
+
+#: format for LDAP generalized time, as used for ``modifyTimestamp``
+GENERALIZED_TIME = '%Y%m%d%H%M%SZ'
+
+#: margin subtracted from the sync start time when recording the high
+#: water mark, to allow for clock differences with the directory
+CLOCK_SKEW_MARGIN = timedelta(minutes=10)
+
+#: Results of :func:`sync_users`; ``changed`` is the number of entries
+#: modified in LDAP since the last sync for an incremental sync, or that
+#: differ from the user's fields for a full sync
+SyncResult = namedtuple('SyncResult',
+                        ['checked', 'changed', 'updated', 'not_found'])
+
+
+def cas_users():
+    '''Users with no usable password, i.e. accounts created for CAS login.'''
+    return get_user_model().objects.filter(
+        Q(password='') | Q(password__startswith='!'))
+
+
+def to_generalized_time(dt):
+    return dt.astimezone(timezone.utc).strftime(GENERALIZED_TIME)
+
+
+def sync_users(users, since=None, batch_size=1000, workers=None):
+    '''Refresh user info from LDAP for a queryset of users.
+
+    Users are loaded and looked up in batches of ``batch_size``; only
+    users whose LDAP-derived fields changed are written, with one
+    ``bulk_update`` per batch.  If ``since`` (LDAP generalized time) is
+    given, only entries with ``modifyTimestamp`` at or after it are
+    requested.  Returns a :class:`SyncResult` of counts.
+    '''
+    User = get_user_model()
+    extra_filter = '(modifyTimestamp>=%s)' % since if since else None
+    checked = changed = updated = not_found = 0
+
+    ldap = LDAPSearch()
+    try:
+        batch = []
+        for user in users.order_by('pk').iterator(chunk_size=batch_size):
+            batch.append(user)
+            if len(batch) < batch_size:
+                continue
+            counts = _sync_batch(User, ldap, batch, extra_filter, workers)
+            batch = []
+            checked, changed, updated, not_found = [
+                total + count for total, count in
+                zip((checked, changed, updated, not_found), counts)]
+        if batch:
+            counts = _sync_batch(User, ldap, batch, extra_filter, workers)
+            checked, changed, updated, not_found = [
+                total + count for total, count in
+                zip((checked, changed, updated, not_found), counts)]
+    finally:
+        ldap.close()
+
+    return SyncResult(checked, changed, updated, not_found)
+
+
+def _sync_batch(User, ldap, users, extra_filter, workers):
+    results = ldap.find_users([user.username for user in users],
+                              workers=workers, extra_filter=extra_filter,
+                              use_cache=False)
+    modified = []
+    fields = set()
+    for user in users:
+        user_info = results.found.get(user.username)
+        if user_info is None:
+            continue
+        initial = user_field_values(user)
+        populate_user(user, user_info)
+        changed_fields = changed_user_fields(user, initial)
+        if changed_fields:
+            modified.append(user)
+            fields.update(changed_fields)
+
+    if modified:
+        with transaction.atomic():
+            User.objects.bulk_update(modified, sorted(fields))
+    if results.found:
+        # populated now, if waiting for lazy population
+        PendingUserInfo.objects.filter(
+            user__username__in=list(results.found)).delete()
+        for user in modified:
+            invalidate_entry_cache(user.username)
+
+    if extra_filter:
+        # in an incremental sync, found means modified in LDAP and
+        # missing just means unchanged
+        changed, missing = len(results.found), 0
+    else:
+        changed = len(modified)
+        missing = len(results.missing) + len(results.ambiguous)
+    return len(users), changed, len(modified), missing
+
+
+def run_sync(users=None, full=False, since=None, batch_size=1000,
+             workers=None):
+    '''Sync users (default: all CAS users) and return the run as an
+    :class:`~pucas.models.LDAPSync` along with the :class:`SyncResult`.
+
+    Unless ``full`` is set or ``since`` given, only LDAP entries modified
+    since the high water mark of the last completed sync are requested;
+    users still pending population (``POPULATE_ON_LOGIN = 'lazy'``) are
+    always populated.  Only runs over all CAS users without ``since``
+    are saved, so that a partial run doesn't advance the high water mark
+    past changes to users it didn't check.
+    '''
+    started = django_timezone.now()
+    record = users is None and since is None
+    if since is None and not full:
+        last_sync = LDAPSync.objects.filter(finished__isnull=False).first()
+        if last_sync:
+            since = last_sync.high_water_mark
+
+    sync = LDAPSync(
+        started=started, incremental=bool(since),
+        high_water_mark=to_generalized_time(started - CLOCK_SKEW_MARGIN))
+    if record:
+        sync.save()
+    users = users if users is not None else cas_users()
+    if since:
+        # pending users may not have been modified in LDAP since, so
+        # sync them in full and the rest incrementally
+        pending = users.filter(pucas_pending_user_info__isnull=False)
+        result = sync_users(users.exclude(pk__in=pending.values('pk')),
+                            since=since, batch_size=batch_size,
+                            workers=workers)
+        pending_result = sync_users(pending, batch_size=batch_size,
+                                    workers=workers)
+        result = SyncResult(*[total + count for total, count
+                              in zip(result, pending_result)])
+    else:
+        result = sync_users(users, since=since, batch_size=batch_size,
+                            workers=workers)
+    sync.checked = result.checked
+    sync.updated = result.updated
+    sync.not_found = result.not_found
+    sync.finished = django_timezone.now()
+    if record:
+        sync.save()
+    logger.info('LDAP sync since %s: %d checked, %d changed, %d updated, '
+                '%d not found', since or 'beginning', *result)
+    return sync, result
@@ -0,0 +1,276 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connections
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from ldap3.core.exceptions import LDAPException
+
+from pucas.breaker import LDAPUnavailable
+from pucas.ldap import LDAPSearchException, bulk_init_cas_users, \
+    user_info_from_ldap
+from pucas.lazy import mark_pending
+from pucas.models import CasUserInitJob
+
+
+logger = logging.getLogger(__name__)
+
+
+def background_config():
+    '''Options for background tasks, from ``BACKGROUND`` in ``PUCAS_LDAP``:
+    ``WORKERS`` (default 2), ``QUEUE_SIZE`` (default 100), ``RETRIES``
+    (default 3), ``RETRY_DELAY`` (seconds before the first retry, doubled
+    for each retry after; default 1) and ``BACKEND`` (optional dotted path
+    to a function to queue tasks with instead of the built-in thread pool).
+    '''
+    config = {
+        'WORKERS': 2,
+        'QUEUE_SIZE': 100,
+        'RETRIES': 3,
+        'RETRY_DELAY': 1,
+        'BACKEND': None,
+    }
+    config.update(getattr(settings, 'PUCAS_LDAP', {}).get('BACKGROUND', {}))
+    return config
+
+
+class BackgroundExecutor(object):
+    '''Thread pool for background tasks with a bounded queue.
+
+    :meth:`submit` returns False instead of queuing when ``max_workers``
+    tasks are running and ``queue_size`` more are waiting.
+    '''
+
+    def __init__(self, max_workers=2, queue_size=100):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='pucas')
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+
+    def submit(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except RuntimeError:
+            # executor has been shut down
+            self._slots.release()
+            return False
+        future.add_done_callback(lambda f: self._slots.release())
+        return True
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''Get the process-wide :class:`BackgroundExecutor`.'''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            config = background_config()
+            _executor = BackgroundExecutor(max_workers=config['WORKERS'],
+                                           queue_size=config['QUEUE_SIZE'])
+        return _executor
+
+
+@receiver(setting_changed)
+def background_settings_changed(sender, setting, **kwargs):
+    global _executor
+    if setting == 'PUCAS_LDAP':
+        with _executor_lock:
+            executor, _executor = _executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def run_task(task, *args):
+    '''Run a task (dotted path to a function) with retries.
+
+    Retries with exponential backoff on LDAP errors other than
+    :exc:`~pucas.ldap.LDAPSearchException`, since a user that was not
+    found will not be found on retry either, and
+    :exc:`~pucas.breaker.LDAPUnavailable`, since the circuit breaker stays
+    open for longer than the backoff.  Other errors are logged (since
+    the built-in thread pool would otherwise discard them) and raised.
+    Intended to run in a worker thread or process; closes database
+    connections when done.
+    '''
+    config = background_config()
+    func = import_string(task)
+    close_old_connections()
+    try:
+        for attempt in range(config['RETRIES'] + 1):
+            try:
+                return func(*args)
+            except (LDAPSearchException, LDAPUnavailable) as err:
+                # not found, or the directory is down for longer than
+                # the retry backoff (see RESET_TIMEOUT)
+                logger.warning('Background task %s%r failed: %s',
+                               task, args, err)
+                return
+            except LDAPException as err:
+                if attempt >= config['RETRIES']:
+                    logger.error('Background task %s%r failed after %d '
+                                 'attempts: %s', task, args, attempt + 1, err)
+                    return
+                delay = config['RETRY_DELAY'] * 2 ** attempt
+                logger.info('Background task %s%r failed (%s); retrying in '
+                            '%ss', task, args, err, delay)
+                time.sleep(delay)
+            except Exception:
+                logger.exception('Background task %s%r failed', task, args)
+                raise
+    finally:
+        connections.close_all()
+
+
+def enqueue(task, *args):
+    '''Queue a task (dotted path to a function, taking JSON-serializable
+    arguments) to run in the background.
+
+    Uses the configured ``BACKEND`` if there is one: a function called
+    with the task and arguments, which should arrange for
+    :func:`run_task` to be called with them (e.g. from a Celery task) and
+    return True if queued.  Otherwise the task is queued on the built-in
+    thread pool.  Returns False if the task could not be queued.
+    '''
+    backend = background_config()['BACKEND']
+    try:
+        if backend:
+            return bool(import_string(backend)(task, *args))
+        return get_executor().submit(run_task, task, *args)
+    except Exception as err:
+        logger.error('Error queuing background task %s: %s', task, err)
+        return False
+
+
+def populate_user_task(user_id):
+    '''Background task to populate user info from LDAP by user id.'''
+    user = get_user_model().objects.get(pk=user_id)
+    try:
+        user_info_from_ldap(user)
+    except LDAPUnavailable:
+        # populate once the directory is back (see pucas.lazy)
+        mark_pending(user)
+        raise
+
+
+def defer_user_info(user):
+    '''Populate user info from LDAP in the background, falling back to
+    populating immediately if the task can't be queued.'''
+    if not enqueue('pucas.tasks.populate_user_task', user.pk):
+        logger.warning('Unable to queue LDAP population for %s; '
+                       'populating now', user.username)
+        user_info_from_ldap(user)
+
+
+def run_init_job(job_id):
+    '''Background task to run a :class:`~pucas.models.CasUserInitJob`,
+    initializing its netids a batch at a time (``BATCH_SIZE``) and
+    saving progress after each batch.  Netids in a batch that fails with
+    an LDAP error are counted as failed and the job continues; a job
+    that was interrupted resumes after the last saved batch when run
+    again (see :func:`restart_stalled_job`).
+
+    Only one run works on a job at a time: a run claims a queued job
+    before starting, and stops if the job is claimed by another run
+    (i.e. it was restarted) in the meantime.'''
+    job = CasUserInitJob.objects.get(pk=job_id)
+    if job.status != CasUserInitJob.QUEUED:
+        # finished, or already running
+        return
+    job.status = CasUserInitJob.RUNNING
+    if not _save_job(job, ['status']):
+        return
+    batch_size = getattr(settings, 'PUCAS_LDAP', {}).get('BATCH_SIZE', 100)
+    netids = job.netid_list()
+    results = job.results()
+    try:
+        for i in range(job.completed + job.failed, len(netids), batch_size):
+            batch = netids[i:i + batch_size]
+            try:
+                result = bulk_init_cas_users(
+                    batch, activate_created=True,
+                    use_cache=not job.refresh_existing)
+            except LDAPException as err:
+                logger.warning('Error initializing CAS users in job %s: %s',
+                               job.pk, err)
+                results['failed'].extend(batch)
+                job.failed += len(batch)
+            else:
+                results['created'].extend(result.created)
+                results['existing'].extend(result.updated)
+                results['not_found'].extend(result.not_found +
+                                            result.ambiguous)
+                job.completed += len(batch)
+            if not _save_job_results(job, results):
+                logger.warning('CAS user init job %s was restarted; '
+                               'stopping this run', job.pk)
+                return
+        job.status = CasUserInitJob.DONE
+    except Exception as err:
+        logger.exception('CAS user init job %s failed', job.pk)
+        job.status = CasUserInitJob.FAILED
+        job.error = str(err)
+    job.finished = timezone.now()
+    _save_job(job, ['status', 'error', 'finished'])
+
+
+def _save_job(job, fields):
+    # save fields unless the job has changed since this run last saved
+    # it (i.e. another run has claimed it); returns whether saved
+    updated = timezone.now()
+    saved = CasUserInitJob.objects.filter(pk=job.pk, updated=job.updated) \
+        .update(updated=updated,
+                **{field: getattr(job, field) for field in fields})
+    if saved:
+        job.updated = updated
+    return bool(saved)
+
+
+def _save_job_results(job, results):
+    job.created_netids = '\n'.join(results['created'])
+    job.existing_netids = '\n'.join(results['existing'])
+    job.not_found_netids = '\n'.join(results['not_found'])
+    job.failed_netids = '\n'.join(results['failed'])
+    return _save_job(job, ['completed', 'failed', 'created_netids',
+                           'existing_netids', 'not_found_netids',
+                           'failed_netids'])
+
+
+def start_init_job(job):
+    '''Run a :class:`~pucas.models.CasUserInitJob` in the background,
+    falling back to running it immediately if it can't be queued.'''
+    if not enqueue('pucas.tasks.run_init_job', job.pk):
+        logger.warning('Unable to queue CAS user init job %s; running now',
+                       job.pk)
+        run_init_job(job.pk)
+
+
+def restart_stalled_job(job, timeout):
+    '''Start a :class:`~pucas.models.CasUserInitJob` again if it is not
+    finished and has saved no progress for ``timeout`` seconds, e.g.
+    because the process running it was restarted.  Returns True if the
+    job was restarted.'''
+    if job.is_finished or \
+            job.updated > timezone.now() - timedelta(seconds=timeout):
+        return False
+    # queue it again, so that it's only restarted once and any run still
+    # working on it stops at its next save
+    job.status = CasUserInitJob.QUEUED
+    if not _save_job(job, ['status']):
+        return False
+    logger.warning('Restarting stalled CAS user init job %s', job.pk)
+    start_init_job(job)
+    return True
@@ -1,21 +1,57 @@
+from datetime import timedelta
 from io import StringIO
+import json
+import os
+import re
+import tempfile
+import time
 from unittest import mock
 
+from asgiref.sync import sync_to_async
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.admin.sites import AdminSite
-from django.core.management import call_command
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.db.models import QuerySet
 from django.test import TestCase, RequestFactory, override_settings
-from ldap3.core.exceptions import LDAPCursorError, LDAPException
+from django.utils import timezone
+from ldap3.core.exceptions import LDAPCursorError, LDAPException, \
+    LDAPSocketOpenError, LDAPSocketReceiveError
 import pytest
 
 from pucas.admin import CasUserAdmin
+from pucas.coalesce import CacheLock, SingleFlight, get_cache_lock
+from pucas.breaker import DjangoCircuitBreaker, LDAPUnavailable, \
+    LocalCircuitBreaker, get_circuit_breaker
+from pucas.config import FieldMapping, UserInfoPlan, check_search_settings, \
+    compile_plan, get_plan
 from pucas.forms import CasUserInitForm
-from pucas.ldap import LDAPSearch, LDAPSearchException, \
-    init_cas_user, user_info_from_ldap
+from pucas.ldap import LDAPSearch, LDAPSearchException, LDAPBatchResult, \
+    BulkInitResult, init_cas_user, bulk_init_cas_users, user_info_from_ldap, \
+    get_connection_pool, get_ldap_search, AsyncLDAPSearch, ainit_cas_user, \
+    auser_info_from_ldap, changed_user_fields, user_field_values
+from pucas.lazy import ensure_user_info, is_pending, mark_pending
 from pucas.management.commands import createcasuser, ldapsearch
+from pucas import metrics
+from pucas.metrics import InMemoryMetrics, StatsdMetrics, \
+    get_metrics_backend, metric_recorded
+from pucas.middleware import LazyUserInfoMiddleware
+from pucas.models import CasUserInitJob, DirectoryMirrorEntry, LDAPSync
+from pucas.mirror import get_mirrored, import_directory, update_mirror
+from pucas.cache import NOT_FOUND, DjangoEntryCache, LocalEntryCache, \
+    get_entry_cache, invalidate_entry_cache
+from pucas.entry import DirectoryEntry
+from pucas.pool import LDAPConnectionPool
+from pucas import schema as pucas_schema
+from pucas.servers import ServerSelector, get_server_selector, server_stats
 from pucas.signals import cas_login
+from pucas.sync import SyncResult, cas_users, run_sync, sync_users
+from pucas import tasks
 
 
 class MockLDAPInfo(object):
@@ -59,6 +95,245 @@ class TestSignals(TestCase):
         cas_login(mock.Mock(), mockuser, True)
         mock_userinit.assert_called_with(mockuser)
 
+    @mock.patch('pucas.signals.defer_user_info')
+    @mock.patch('pucas.signals.user_info_from_ldap')
+    @override_settings(PUCAS_LDAP={'POPULATE_ON_LOGIN': 'deferred'})
+    def test_cas_login_deferred(self, mock_userinit, mock_defer):
+        mockuser = mock.Mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            cas_login(mock.Mock(), mockuser, True)
+            # not queued until the transaction is committed
+            mock_defer.assert_not_called()
+        mock_defer.assert_called_with(mockuser)
+        mock_userinit.assert_not_called()
+
+    @mock.patch('pucas.signals.defer_user_info')
+    @mock.patch('pucas.signals.user_info_from_ldap')
+    @override_settings(PUCAS_LDAP={'CIRCUIT_BREAKER': {'FAILURE_THRESHOLD': 1}})
+    def test_cas_login_unavailable(self, mock_userinit, mock_defer):
+        get_circuit_breaker().record_failure()
+        user = get_user_model().objects.create(username='jdoe')
+        # marked as pending while the directory is down, to be populated
+        # once it is back
+        with self.captureOnCommitCallbacks(execute=True):
+            cas_login(mock.Mock(), user, True)
+        assert is_pending(user)
+        mock_defer.assert_not_called()
+        mock_userinit.assert_not_called()
+
+
+def background_task(value):
+    return value
+
+
+class TestBackgroundTasks(TestCase):
+
+    def test_executor_bounded(self):
+        import threading
+        executor = tasks.BackgroundExecutor(max_workers=1, queue_size=1)
+        release = threading.Event()
+        try:
+            assert executor.submit(release.wait)
+            assert executor.submit(release.wait)
+            # one running and one waiting; queue is full
+            assert not executor.submit(release.wait)
+        finally:
+            release.set()
+            executor.shutdown()
+        # slots are freed when tasks finish
+        executor = tasks.BackgroundExecutor(max_workers=1, queue_size=0)
+        assert executor.submit(background_task, 1)
+        executor.shutdown()
+        assert not executor.submit(background_task, 1)
+
+    @mock.patch('pucas.tasks.time')
+    @override_settings(PUCAS_LDAP={'BACKGROUND': {'RETRIES': 2,
+                                                  'RETRY_DELAY': 3}})
+    def test_run_task(self, mocktime):
+        assert tasks.run_task('pucas.tests.background_task', 5) == 5
+
+        with mock.patch('pucas.tests.background_task') as mock_task:
+            # retried with backoff on LDAP errors
+            mock_task.side_effect = [LDAPException, LDAPException, 'done']
+            assert tasks.run_task('pucas.tests.background_task', 5) == 'done'
+            mocktime.sleep.assert_has_calls([mock.call(3), mock.call(6)])
+            assert mock_task.call_count == 3
+
+            # gives up after configured retries
+            mock_task.reset_mock()
+            mock_task.side_effect = LDAPException
+            tasks.run_task('pucas.tests.background_task', 5)
+            assert mock_task.call_count == 3
+
+            # not found is not retried
+            mock_task.reset_mock()
+            mock_task.side_effect = LDAPSearchException
+            tasks.run_task('pucas.tests.background_task', 5)
+            assert mock_task.call_count == 1
+
+            # nor is the directory being unavailable
+            mock_task.reset_mock()
+            mock_task.side_effect = LDAPUnavailable
+            tasks.run_task('pucas.tests.background_task', 5)
+            assert mock_task.call_count == 1
+
+        # other errors are logged and not retried
+        with self.assertLogs('pucas.tasks', 'ERROR') as logs:
+            with pytest.raises(get_user_model().DoesNotExist):
+                tasks.run_task('pucas.tasks.populate_user_task', 0)
+        assert 'pucas.tasks.populate_user_task(0,) failed' in logs.output[0]
+
+    def test_enqueue(self):
+        with mock.patch('pucas.tasks.get_executor') as mock_executor:
+            mock_executor.return_value.submit.return_value = True
+            assert tasks.enqueue('pucas.tests.background_task', 1)
+            mock_executor.return_value.submit.assert_called_with(
+                tasks.run_task, 'pucas.tests.background_task', 1)
+
+        backend = mock.Mock(return_value=True)
+        with mock.patch('pucas.tests.task_backend', backend, create=True):
+            with override_settings(PUCAS_LDAP={'BACKGROUND': {
+                    'BACKEND': 'pucas.tests.task_backend'}}):
+                assert tasks.enqueue('pucas.tests.background_task', 1)
+                backend.assert_called_with('pucas.tests.background_task', 1)
+                # errors queuing are reported as not queued
+                backend.side_effect = Exception
+                assert not tasks.enqueue('pucas.tests.background_task', 1)
+
+    @mock.patch('pucas.tasks.user_info_from_ldap')
+    @mock.patch('pucas.tasks.enqueue')
+    def test_defer_user_info(self, mock_enqueue, mock_userinfo):
+        mockuser = mock.Mock(pk=3)
+        mock_enqueue.return_value = True
+        tasks.defer_user_info(mockuser)
+        mock_enqueue.assert_called_with('pucas.tasks.populate_user_task', 3)
+        mock_userinfo.assert_not_called()
+
+        # populated immediately if it can't be queued
+        mock_enqueue.return_value = False
+        tasks.defer_user_info(mockuser)
+        mock_userinfo.assert_called_with(mockuser)
+
+    @mock.patch('pucas.tasks.user_info_from_ldap')
+    def test_populate_user_task(self, mock_userinfo):
+        user = get_user_model().objects.create(username='jdoe')
+        tasks.populate_user_task(user.pk)
+        mock_userinfo.assert_called_with(user)
+
+        # populated later if the directory is unavailable
+        mock_userinfo.side_effect = LDAPUnavailable
+        with pytest.raises(LDAPUnavailable):
+            tasks.populate_user_task(user.pk)
+        assert is_pending(user)
+
+    @mock.patch('pucas.tasks.bulk_init_cas_users')
+    @override_settings(PUCAS_LDAP={'BATCH_SIZE': 2})
+    def test_run_init_job(self, mock_init):
+        job = CasUserInitJob.objects.create(
+            netids='jdoe\njschmoe\nabc123\nxyz789\nunknown', total=5,
+            existing_netids='old')
+        mock_init.side_effect = [
+            BulkInitResult(['jdoe'], ['jschmoe'], [], []),
+            LDAPException('server down'),
+            BulkInitResult([], [], ['unknown'], []),
+        ]
+        tasks.run_init_job(job.pk)
+        # a batch at a time; a failed batch doesn't stop the job
+        mock_init.assert_has_calls([
+            mock.call(['jdoe', 'jschmoe'], activate_created=True,
+                      use_cache=True),
+            mock.call(['abc123', 'xyz789'], activate_created=True,
+                      use_cache=True),
+            mock.call(['unknown'], activate_created=True,
+                      use_cache=True)])
+        job.refresh_from_db()
+        assert job.status == CasUserInitJob.DONE
+        assert job.finished
+        assert (job.completed, job.failed) == (3, 2)
+        assert job.results() == {
+            'created': ['jdoe'], 'existing': ['old', 'jschmoe'],
+            'not_found': ['unknown'], 'failed': ['abc123', 'xyz789']}
+
+        # finished jobs are not run again
+        mock_init.reset_mock()
+        tasks.run_init_job(job.pk)
+        mock_init.assert_not_called()
+
+    @mock.patch('pucas.tasks.bulk_init_cas_users')
+    def test_run_init_job_refresh(self, mock_init):
+        job = CasUserInitJob.objects.create(netids='jdoe', total=1,
+                                            refresh_existing=True)
+        mock_init.return_value = BulkInitResult([], ['jdoe'], [], [])
+        tasks.run_init_job(job.pk)
+        mock_init.assert_called_once_with(['jdoe'], activate_created=True,
+                                          use_cache=False)
+
+    @mock.patch('pucas.tasks.bulk_init_cas_users')
+    @override_settings(PUCAS_LDAP={'BATCH_SIZE': 1})
+    def test_run_init_job_claimed(self, mock_init):
+        job = CasUserInitJob.objects.create(netids='jdoe\njschmoe', total=2)
+
+        def restart(batch, **kwargs):
+            # another run claims the job while this one is working on it
+            if batch == ['jdoe']:
+                CasUserInitJob.objects.filter(pk=job.pk).update(
+                    status=CasUserInitJob.RUNNING, updated=timezone.now())
+                return BulkInitResult(['jdoe'], [], [], [])
+            return BulkInitResult([], ['jschmoe'], [], [])
+        mock_init.side_effect = restart
+
+        with self.assertLogs('pucas.tasks', 'WARNING'):
+            tasks.run_init_job(job.pk)
+        # stopped without saving over the other run's progress
+        assert mock_init.call_count == 1
+        job.refresh_from_db()
+        assert job.status == CasUserInitJob.RUNNING
+        assert job.completed == 0
+
+        # a job that is already running is left to that run
+        tasks.run_init_job(job.pk)
+        assert mock_init.call_count == 1
+
+    @mock.patch('pucas.tasks.start_init_job')
+    def test_restart_stalled_job(self, mock_start):
+        job = CasUserInitJob.objects.create(netids='jdoe', total=1,
+                                            status=CasUserInitJob.RUNNING)
+        # recent progress
+        assert not tasks.restart_stalled_job(job, 600)
+        mock_start.assert_not_called()
+
+        stalled = timezone.now() - timedelta(seconds=601)
+        CasUserInitJob.objects.filter(pk=job.pk).update(updated=stalled)
+        job.refresh_from_db()
+        assert tasks.restart_stalled_job(job, 600)
+        mock_start.assert_called_once_with(job)
+        # queued again for the new run to claim
+        job.refresh_from_db()
+        assert job.status == CasUserInitJob.QUEUED
+        # only restarted once
+        assert not tasks.restart_stalled_job(job, 600)
+        assert mock_start.call_count == 1
+
+        # finished jobs are not restarted
+        CasUserInitJob.objects.filter(pk=job.pk).update(
+            updated=stalled, status=CasUserInitJob.DONE)
+        job.refresh_from_db()
+        assert not tasks.restart_stalled_job(job, 600)
+        assert mock_start.call_count == 1
+
+    @mock.patch('pucas.tasks.run_init_job')
+    @mock.patch('pucas.tasks.enqueue')
+    def test_start_init_job(self, mock_enqueue, mock_run):
+        job = mock.Mock(pk=4)
+        mock_enqueue.return_value = True
+        tasks.start_init_job(job)
+        mock_enqueue.assert_called_with('pucas.tasks.run_init_job', 4)
+        mock_run.assert_not_called()
+        # run immediately if it can't be queued
+        mock_enqueue.return_value = False
+        tasks.start_init_job(job)
+        mock_run.assert_called_with(4)
+
 
 class TestLDAPSearch(TestCase):
 
@@ -168,10 +443,1037 @@ class TestLDAPSearch(TestCase):
             assert 'LDAP is not configured for user lookup' in str(search_err.value)
 
 
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ldap_servers})
+    def test_pooled_connection(self, mockldap3):
+        mockldap3.Connection.return_value = mock.Mock(closed=False, bound=True)
+        ldsearch = LDAPSearch()
+        conn = ldsearch.conn
+        ldsearch.close()
+        assert ldsearch.conn is None
+        # connection is reused instead of opening a new one
+        with LDAPSearch() as ldsearch:
+            assert ldsearch.conn is conn
+        assert mockldap3.Connection.call_count == 1
+
+        # changing settings resets the pool
+        with override_settings(PUCAS_LDAP={'SERVERS': ['other']}):
+            assert get_connection_pool() is not ldsearch.pool
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ldap_servers,
+        'ATTRIBUTES': ['uid'], 'SEARCH_BASE': 'o=my_org',
+        'SEARCH_FILTER': "(uid=%(user)s)"})
+    def test_find_user_reconnect(self, mockldap3):
+        stale_conn = mock.Mock()
+        stale_conn.search.side_effect = LDAPSocketReceiveError
+        fresh_conn = mock.Mock(entries=[mock.sentinel.userinfo])
+        mockldap3.Connection.side_effect = [stale_conn, fresh_conn]
+        ldsearch = LDAPSearch()
+        assert ldsearch.find_user('jdoe') == mock.sentinel.userinfo
+        # stale connection is closed and replaced
+        stale_conn.unbind.assert_called_with()
+        assert ldsearch.conn is fresh_conn
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ldap_servers,
+        'ATTRIBUTES': ['uid'], 'SEARCH_BASE': 'o=my_org',
+        'SEARCH_FILTER': "(uid=%(user)s)"})
+    def test_shared_search(self, mockldap3):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        # both searches must be in progress at once
+        barrier = threading.Barrier(2, timeout=5)
+
+        def connection(*args, **kwargs):
+            conn = mock.Mock(closed=False, bound=True)
+
+            def search(search_base, search_filter, **kwargs):
+                barrier.wait()
+                conn.entries = [search_filter]
+            conn.search.side_effect = search
+            return conn
+        mockldap3.Connection.side_effect = connection
+
+        ldsearch = get_ldap_search()
+        assert ldsearch.conn is None
+        assert get_ldap_search() is ldsearch
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(ldsearch.find_user, ['jdoe', 'jschmoe']))
+        # each search used its own connection, returned to the pool after
+        assert results == ['(uid=jdoe)', '(uid=jschmoe)']
+        assert mockldap3.Connection.call_count == 2
+        assert len(ldsearch.pool) == 2
+        ldsearch.close()
+        assert len(ldsearch.pool) == 2
+
+        # changing settings resets the shared search
+        with override_settings(PUCAS_LDAP={'SERVERS': ['other']}):
+            assert get_ldap_search() is not ldsearch
+
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ldap_servers,
+        'ATTRIBUTES': ['sn', 'ou'], 'BATCH_SIZE': 2,
+        'SEARCH_BASE': 'o=my_org', 'SEARCH_FILTER': "(uid=%(user)s)"})
+    def test_find_users(self, mockldap3):
+        ldsearch = LDAPSearch()
+        jdoe = mock.Mock(entry_dn='uid=jdoe', uid=mock.Mock(values=['jdoe']))
+        # netid attribute matching is case-insensitive
+        jschmoe = mock.Mock(entry_dn='uid=jschmoe',
+                            uid=mock.Mock(values=['JSchmoe']))
+        dupe1 = mock.Mock(entry_dn='uid=dupe', uid=mock.Mock(values=['dupe']))
+        dupe2 = mock.Mock(entry_dn='uid=dupe2',
+                          uid=mock.Mock(values=['dupe2', 'dupe']))
+        # first chunk returned in two pages, second chunk in one
+        page_cookie = {'controls': {
+            '1.2.840.113556.1.4.319': {'value': {'cookie': b'next'}}}}
+        results = iter([
+            ([jdoe], page_cookie), ([jschmoe], {}), ([dupe1, dupe2], {})])
+
+        def search(*args, **kwargs):
+            ldsearch.conn.entries, ldsearch.conn.result = next(results)
+        ldsearch.conn.search.side_effect = search
+
+        result = ldsearch.find_users(
+            ['jdoe', 'jschmoe', 'jdoe', 'dupe', 'unknown'])
+        assert result.found == {'jdoe': jdoe, 'jschmoe': jschmoe}
+        assert result.ambiguous == ['dupe']
+        assert result.missing == ['unknown']
+
+        calls = ldsearch.conn.search.call_args_list
+        assert len(calls) == 3
+        # netids are combined into one filter per chunk, and netid
+        # attribute is requested
+        assert calls[0] == mock.call('o=my_org', '(|(uid=jdoe)(uid=jschmoe))',
+            attributes=['sn', 'ou', 'uid'], paged_size=500, paged_cookie=None)
+        assert calls[1] == mock.call('o=my_org', '(|(uid=jdoe)(uid=jschmoe))',
+            attributes=['sn', 'ou', 'uid'], paged_size=500, paged_cookie=b'next')
+        assert calls[2] == mock.call('o=my_org', '(|(uid=dupe)(uid=unknown))',
+            attributes=['sn', 'ou', 'uid'], paged_size=500, paged_cookie=None)
+
+        # netid attribute can't be determined from search filter
+        with override_settings(PUCAS_LDAP={'SERVERS': self.ldap_servers,
+                'ATTRIBUTES': ['sn'], 'SEARCH_BASE': 'o=my_org',
+                'SEARCH_FILTER': "(&(objectClass=person)(%(user)s))"}):
+            with pytest.raises(LDAPSearchException):
+                ldsearch.find_users(['jdoe'])
+            # unless configured
+            with override_settings(PUCAS_LDAP={'SERVERS': self.ldap_servers,
+                    'ATTRIBUTES': ['sn'], 'SEARCH_BASE': 'o=my_org',
+                    'SEARCH_FILTER': "(mail=%(user)s@example.com)",
+                    'NETID_ATTRIBUTE': 'uid'}):
+                ldsearch.conn.search.side_effect = None
+                ldsearch.conn.entries = []
+                ldsearch.find_users(['jdoe'])
+                ldsearch.conn.search.assert_called_with('o=my_org',
+                    '(|(mail=jdoe@example.com))', attributes=['sn', 'uid'],
+                    paged_size=500, paged_cookie=None)
+
+
+    @mock.patch('pucas.ldap.ldap3')
+    def test_get_info(self, mockldap3):
+        with override_settings(PUCAS_LDAP={'SERVERS': ['ldap1'],
+                                           'GET_INFO': 'none'}):
+            LDAPSearch()
+            mockldap3.Server.assert_called_with('ldap1',
+                get_info=mockldap3.NONE, use_ssl=True)
+        with override_settings(PUCAS_LDAP={'SERVERS': ['ldap1'],
+                                           'GET_INFO': 'some'}):
+            with pytest.raises(LDAPSearchException):
+                LDAPSearch()
+
+    @mock.patch('pucas.ldap.save_schema')
+    @mock.patch('pucas.ldap.load_schema')
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ['ldap1'], 'GET_INFO': 'NONE',
+                                   'SCHEMA_FILE': '/tmp/schema.json'})
+    def test_schema_snapshot(self, mockldap3, mock_load, mock_save):
+        # no snapshot yet: schema is read from the server and saved
+        mock_load.return_value = None
+        LDAPSearch()
+        mockldap3.Server.assert_called_with('ldap1',
+            get_info=mockldap3.SCHEMA, use_ssl=True)
+        mock_save.assert_called_with(
+            mockldap3.Connection.return_value.server.schema)
+
+        # snapshot is attached to servers instead of reading server info
+        mock_save.reset_mock()
+        with override_settings(PUCAS_LDAP={'SERVERS': ['ldap1'],
+                                           'SCHEMA_FILE': '/tmp/schema.json'}):
+            mock_load.return_value = mock.sentinel.schema
+            LDAPSearch()
+            mockldap3.Server.assert_called_with('ldap1',
+                get_info=mockldap3.NONE, use_ssl=True)
+            mockldap3.Server.return_value.attach_schema_info \
+                .assert_called_with(mock.sentinel.schema)
+            mock_save.assert_not_called()
+
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ldap_servers,
+        'ATTRIBUTES': ['sn'], 'MAX_CONCURRENCY': 3,
+        'SEARCH_BASE': 'o=my_org', 'SEARCH_FILTER': "(uid=%(user)s)"})
+    def test_find_users_concurrent(self, mockldap3):
+        import threading
+        netids = ['user%d' % i for i in range(7)]
+        searched = []
+        threads = set()
+
+        def search_chunk(ldap, chunk, *args):
+            searched.append(chunk)
+            threads.add(threading.current_thread().name)
+            return {netid: {'uid=' + netid: 'entry ' + netid}
+                    for netid in chunk if netid != 'user3'}
+
+        with mock.patch.object(LDAPSearch, '_search_chunk', autospec=True,
+                               side_effect=search_chunk):
+            with LDAPSearch() as ldsearch:
+                result = ldsearch.find_users(netids)
+        # split into chunks across configured number of workers
+        assert sorted(searched) == [netids[0:3], netids[3:6], netids[6:]]
+        assert all(name.startswith('pucas-ldap') for name in threads)
+        # results are collated in input order
+        assert list(result.found) == [n for n in netids if n != 'user3']
+        assert result.missing == ['user3']
+
+        # single worker searches in the current thread
+        searched.clear()
+        threads.clear()
+        with mock.patch.object(LDAPSearch, '_search_chunk', autospec=True,
+                               side_effect=search_chunk):
+            with LDAPSearch() as ldsearch:
+                ldsearch.find_users(netids, workers=1)
+        assert searched == [netids]
+        assert threads == {threading.current_thread().name}
+
+
+class TestSchemaSnapshot(TestCase):
+
+    def test_load_save(self):
+        from ldap3.protocol.rfc4512 import SchemaInfo
+        from ldap3.protocol.schemas.slapd24 import slapd_2_4_schema
+        schema = SchemaInfo.from_json(slapd_2_4_schema)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'schema.json')
+            with override_settings(PUCAS_LDAP={}):
+                assert not pucas_schema.snapshot_configured()
+                assert pucas_schema.load_schema() is None
+                # nothing saved when not configured
+                pucas_schema.save_schema(schema)
+                assert pucas_schema.load_schema() is None
+
+            with override_settings(PUCAS_LDAP={'SCHEMA_FILE': path,
+                                               'SCHEMA_CACHE_ALIAS': 'default'}):
+                assert pucas_schema.load_schema() is None
+                pucas_schema.save_schema(schema)
+                assert os.path.exists(path)
+                assert pucas_schema.load_schema() is schema
+
+            # loaded from file
+            with override_settings(PUCAS_LDAP={'SCHEMA_FILE': path}):
+                loaded = pucas_schema.load_schema()
+                assert loaded.to_json() == schema.to_json()
+                # only loaded once
+                assert pucas_schema.load_schema() is loaded
+
+            # loaded from django cache
+            with override_settings(PUCAS_LDAP={'SCHEMA_CACHE_ALIAS': 'default'}):
+                assert pucas_schema.load_schema().to_json() == schema.to_json()
+
+            # no temporary files left behind
+            assert os.listdir(tmpdir) == ['schema.json']
+            # truncated snapshot is ignored
+            with open(path, 'r+') as schema_file:
+                schema_file.truncate(100)
+            with override_settings(PUCAS_LDAP={'SCHEMA_FILE': path}):
+                assert pucas_schema.load_schema() is None
+
+
+class TestMetrics(TestCase):
+
+    metrics_config = {'BACKEND': 'pucas.metrics.InMemoryMetrics'}
+
+    def test_timer(self):
+        with override_settings(PUCAS_LDAP={'METRICS': self.metrics_config}):
+            backend = get_metrics_backend()
+            assert isinstance(backend, InMemoryMetrics)
+            with metrics.timer('test.block'):
+                pass
+            with pytest.raises(ValueError):
+                with metrics.timer('test.block'):
+                    raise ValueError
+            metrics.incr('test.count', 3)
+            assert len(backend.timings['test.block']) == 2
+            assert backend.counters == {'test.block.errors': 1,
+                                        'test.count': 3}
+
+        # no backend configured
+        with override_settings(PUCAS_LDAP={}):
+            assert get_metrics_backend() is None
+            with metrics.timer('test.block'):
+                pass
+
+    def test_signal(self):
+        received = []
+
+        def handler(sender, kind, value, tags, **kwargs):
+            received.append((sender, kind, value, tags))
+
+        metric_recorded.connect(handler, sender='test.count')
+        try:
+            metrics.incr('test.count', user='jdoe')
+            metrics.incr('test.other')
+        finally:
+            metric_recorded.disconnect(handler, sender='test.count')
+        assert received == [('test.count', 'counter', 1, {'user': 'jdoe'})]
+
+    @mock.patch('pucas.metrics.socket')
+    def test_statsd(self, mock_socket):
+        backend = StatsdMetrics(host='stats', prefix='app',
+                                tag_format='dogstatsd')
+        backend.timing('ldap.search', 1.23456, {})
+        backend.incr('ldap.entries', 2, {'batch': True})
+        sock = mock_socket.socket.return_value
+        assert sock.sendto.call_args_list == [
+            mock.call(b'app.ldap.search:1.235|ms', ('stats', 8125)),
+            mock.call(b'app.ldap.entries:2|c|#batch:True', ('stats', 8125))]
+
+    @mock.patch('pucas.ldap.ldap3')
+    def test_instrumented(self, mockldap3):
+        with override_settings(PUCAS_LDAP={
+                'SERVERS': ['ldap1'], 'ATTRIBUTES': ['uid', 'givenName'],
+                'SEARCH_BASE': 'o=my_org', 'SEARCH_FILTER': '(uid=%(user)s)',
+                'ATTRIBUTE_MAP': {'first_name': 'givenName'},
+                'EXTRA_USER_INIT': 'pucas.tests.extra_user_init',
+                'METRICS': self.metrics_config}):
+            backend = get_metrics_backend()
+            mockldap3.Connection.return_value = mock.Mock(
+                closed=False, bound=True,
+                entries=[MockLDAPInfo(givenName='John')])
+            user = get_user_model().objects.create(username='jdoe')
+            user_info_from_ldap(user)
+
+        for name in ['ldap.connect', 'ldap.acquire', 'ldap.search',
+                     'user.populate', 'user.extra_init', 'user.save']:
+            assert len(backend.timings[name]) == 1
+        assert backend.counters['ldap.entries'] == 1
+
+
+class TestCircuitBreaker(TestCase):
+
+    def check_breaker(self, breaker):
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.allow()
+        assert not breaker.is_open()
+        # a success resets the failure count
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        breaker.record_failure()
+        # opened after threshold
+        assert breaker.is_open()
+        assert not breaker.allow()
+
+        with mock.patch('pucas.breaker.time.time',
+                        return_value=time.time() + 31):
+            # half-open: one probe allowed
+            assert breaker.allow()
+            assert not breaker.allow()
+            # failed probe opens the breaker again
+            breaker.record_failure()
+        assert not breaker.allow()
+
+        # reopened when the probe failed, so wait again
+        with mock.patch('pucas.breaker.time.time',
+                        return_value=time.time() + 62):
+            assert breaker.allow()
+            breaker.record_success()
+        assert not breaker.is_open()
+        assert breaker.allow()
+
+    def test_local(self):
+        self.check_breaker(LocalCircuitBreaker(failure_threshold=2,
+                                               reset_timeout=30))
+
+    def test_django(self):
+        caches['default'].clear()
+        self.check_breaker(DjangoCircuitBreaker(failure_threshold=2,
+                                                reset_timeout=30))
+
+    def test_get_circuit_breaker(self):
+        with override_settings(PUCAS_LDAP={}):
+            assert get_circuit_breaker() is None
+        with override_settings(PUCAS_LDAP={'CIRCUIT_BREAKER': {
+                'BACKEND': 'django', 'RESET_TIMEOUT': 10}}):
+            breaker = get_circuit_breaker()
+            assert isinstance(breaker, DjangoCircuitBreaker)
+            assert breaker.reset_timeout == 10
+            assert breaker.failure_threshold == 5
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={
+        'SERVERS': ['ldap1'], 'CONNECT_TIMEOUT': 2, 'RECEIVE_TIMEOUT': 5,
+        'SERVER_POOL_CYCLES': 1,
+        'CIRCUIT_BREAKER': {'FAILURE_THRESHOLD': 2}})
+    def test_fail_fast(self, mockldap3):
+        mockldap3.Connection.side_effect = LDAPSocketOpenError
+        for _ in range(2):
+            with pytest.raises(LDAPSocketOpenError):
+                LDAPSearch()
+        mockldap3.Server.assert_called_with('ldap1', get_info=mockldap3.ALL,
+                                            use_ssl=True, connect_timeout=2)
+        mockldap3.ServerPool.assert_called_with(
+            [mockldap3.Server.return_value], mockldap3.ROUND_ROBIN, active=1,
+            exhaust=5)
+        assert mockldap3.Connection.call_count == 2
+        assert mockldap3.Connection.call_args[1]['receive_timeout'] == 5
+
+        # breaker is open; no further connection attempts
+        with pytest.raises(LDAPUnavailable):
+            LDAPSearch()
+        assert mockldap3.Connection.call_count == 2
+        # not treated as a netid that was not found
+        assert not issubclass(LDAPUnavailable, LDAPSearchException)
+
+
+class TestServerSelector(TestCase):
+
+    def test_order(self):
+        selector = ServerSelector(['ldap1', 'ldap2', 'ldap3'],
+                                  probe_interval=60)
+        # unmeasured servers first, in configured order
+        assert selector.order() == ['ldap1', 'ldap2', 'ldap3']
+        selector.record('ldap1', 0.050)
+        selector.record('ldap2', 0.010)
+        selector.record('ldap3', 0.020)
+        selector.record('unknown', 0.001)
+        assert selector.order() == ['ldap2', 'ldap3', 'ldap1']
+
+        # moving average of latency
+        selector.record('ldap2', 0.110)
+        assert selector.stats()['ldap2']['latency'] == pytest.approx(40)
+        assert selector.order() == ['ldap3', 'ldap2', 'ldap1']
+
+        # errors demote a server
+        selector.record('ldap3', error=True)
+        assert selector.stats()['ldap3']['error_rate'] == pytest.approx(0.3)
+        assert selector.order() == ['ldap2', 'ldap1', 'ldap3']
+
+    def test_weights(self):
+        selector = ServerSelector(['ldap1', 'ldap2'], weights={'ldap2': 4})
+        selector.record('ldap1', 0.010)
+        selector.record('ldap2', 0.030)
+        assert selector.order() == ['ldap2', 'ldap1']
+        assert selector.stats()['ldap2']['weight'] == 4
+
+    def test_probe(self):
+        selector = ServerSelector(['ldap1', 'ldap2', 'ldap3'],
+                                  probe_interval=60)
+        for server, latency in [('ldap1', 0.01), ('ldap2', 0.02),
+                                ('ldap3', 0.03)]:
+            selector.record(server, latency)
+        with mock.patch('pucas.servers.time.monotonic',
+                        return_value=time.monotonic() + 61):
+            # slower servers are probed in turn
+            assert selector.order() == ['ldap2', 'ldap1', 'ldap3']
+            assert selector.order() == ['ldap1', 'ldap2', 'ldap3']
+        with mock.patch('pucas.servers.time.monotonic',
+                        return_value=time.monotonic() + 122):
+            assert selector.order() == ['ldap3', 'ldap1', 'ldap2']
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={
+        'SERVERS': ['ldap1', 'ldap2'], 'SERVER_SELECTION': 'latency',
+        'SEARCH_BASE': 'o=my_org', 'SEARCH_FILTER': '(uid=%(user)s)',
+        'ATTRIBUTES': ['uid']})
+    def test_create_connection(self, mockldap3):
+        servers = {}
+        mockldap3.Server.side_effect = lambda host, **kwargs: \
+            servers.setdefault(host, mock.Mock(name=host))
+        # first server unavailable, connected to the second
+        mockldap3.Connection.side_effect = lambda *args, **kwargs: mock.Mock(
+            closed=False, bound=True, entries=[], server=servers['ldap2'])
+
+        ldap = LDAPSearch()
+        mockldap3.ServerPool.assert_called_with(
+            [servers['ldap1'], servers['ldap2']], mockldap3.FIRST,
+            active=True, exhaust=5)
+        assert ldap.conn.pucas_server == 'ldap2'
+        ldap._search('o=my_org', '(uid=jdoe)')
+        ldap.close()
+
+        stats = server_stats()
+        assert stats['ldap1']['error_rate'] > 0
+        assert stats['ldap2']['error_rate'] == 0
+        assert stats['ldap2']['samples'] == 2
+
+        with override_settings(PUCAS_LDAP={'SERVERS': ['ldap1']}):
+            assert get_server_selector() is None
+            assert server_stats() == {}
+
+
+class TestCoalesce(TestCase):
+
+    def run_concurrently(self, func, count=2):
+        # start the first call, then the others while it is in progress
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking(*args, **kwargs):
+            started.set()
+            assert release.wait(5)
+            return mock.DEFAULT
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(func, blocking)]
+            assert started.wait(5)
+            futures.extend(executor.submit(func, blocking)
+                           for _ in range(count - 1))
+            # give the other callers time to join
+            time.sleep(0.2)
+            release.set()
+            return [future.result() for future in futures]
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        calls = mock.Mock(return_value='result')
+
+        def call(blocking):
+            calls.side_effect = blocking
+            return flights.do('jdoe', calls)
+        results = self.run_concurrently(call, count=3)
+        assert calls.call_count == 1
+        assert results == [('result', False), ('result', True),
+                           ('result', True)]
+        # not coalesced once done
+        assert flights.do('jdoe', calls) == ('result', False)
+        assert calls.call_count == 2
+
+    def test_single_flight_error(self):
+        flights = SingleFlight()
+
+        def call(blocking):
+            def fail():
+                blocking()
+                raise LDAPSearchException('not found')
+            try:
+                flights.do('jdoe', fail)
+            except LDAPSearchException as err:
+                return str(err)
+        assert self.run_concurrently(call) == ['not found', 'not found']
+
+    def test_cache_lock(self):
+        lock = CacheLock(wait_timeout=0.2, poll_interval=0.01)
+        func = mock.Mock(return_value='result')
+        assert lock.do('jdoe', func) == ('result', False)
+        assert not lock.cache.get('pucas:flight:jdoe')
+
+        # another process holds the lock and succeeds
+        lock.cache.add('pucas:flight:jdoe', 1)
+        lock.cache.set('pucas:flight:jdoe:done', 1)
+        assert lock.do('jdoe', func) == (None, True)
+        assert func.call_count == 1
+        # ... or does not finish in time
+        lock.cache.delete('pucas:flight:jdoe:done')
+        assert lock.do('jdoe', func) == ('result', False)
+        assert func.call_count == 2
+        lock.cache.clear()
+
+        with override_settings(PUCAS_LDAP={'COALESCE': {'BACKEND': 'local'}}):
+            assert get_cache_lock() is None
+        with override_settings(PUCAS_LDAP={'COALESCE': {
+                'BACKEND': 'django', 'LOCK_TIMEOUT': 5}}):
+            assert get_cache_lock().lock_timeout == 5
+
+    @mock.patch('pucas.ldap.LDAPSearch')
+    @override_settings(PUCAS_LDAP={'ATTRIBUTE_MAP': {'email': 'mail'}})
+    def test_user_info_from_ldap(self, mockldapsearch):
+        mockldapsearch.return_value.find_user.return_value = \
+            MockLDAPInfo(mail='jdoe@example.com')
+        User = get_user_model()
+        users = []
+
+        def call(blocking):
+            mockldapsearch.return_value.find_user.side_effect = blocking
+            user = User(pk=1, username='jdoe')
+            users.append(user)
+            user_info_from_ldap(user)
+        with mock.patch.object(User, 'save') as mocksave:
+            self.run_concurrently(call)
+        # one search and one save, shared with the other caller
+        assert mockldapsearch.return_value.find_user.call_count == 1
+        mocksave.assert_called_once_with(update_fields=['email'])
+        assert [user.email for user in users] == ['jdoe@example.com'] * 2
+
+
+class TestLDAPConnectionPool(TestCase):
+
+    def test_acquire_release(self):
+        factory = mock.Mock(side_effect=lambda: mock.Mock(closed=False, bound=True))
+        pool = LDAPConnectionPool(factory, size=1)
+        conn = pool.acquire()
+        factory.assert_called_once_with()
+        pool.release(conn)
+        assert len(pool) == 1
+        assert pool.acquire() is conn
+        assert len(pool) == 0
+
+        # connections beyond pool size are closed instead of kept
+        other_conn = pool.acquire()
+        assert other_conn is not conn
+        pool.release(conn)
+        pool.release(other_conn)
+        assert len(pool) == 1
+        other_conn.unbind.assert_called_with()
+
+    def test_stale_connection(self):
+        factory = mock.Mock(side_effect=lambda: mock.Mock(closed=False, bound=True))
+        pool = LDAPConnectionPool(factory)
+        conn = pool.acquire()
+        conn.closed = True
+        pool.release(conn)
+        assert pool.acquire() is not conn
+        conn.unbind.assert_called_with()
+
+    @mock.patch('pucas.pool.time')
+    def test_idle_timeout(self, mocktime):
+        factory = mock.Mock(side_effect=lambda: mock.Mock(closed=False, bound=True))
+        pool = LDAPConnectionPool(factory, idle_timeout=60)
+        mocktime.monotonic.return_value = 100
+        conn = pool.acquire()
+        pool.release(conn)
+        mocktime.monotonic.return_value = 200
+        assert pool.acquire() is not conn
+        conn.unbind.assert_called_with()
+
+    def test_clear(self):
+        factory = mock.Mock(side_effect=lambda: mock.Mock(closed=False, bound=True))
+        pool = LDAPConnectionPool(factory)
+        conn = pool.acquire()
+        pool.release(conn)
+        assert len(pool) == 1
+
+        pool.clear()
+        assert len(pool) == 0
+        conn.unbind.assert_called_with()
+
+
+class TestDirectoryEntry(TestCase):
+
+    def test_attributes(self):
+        entry = DirectoryEntry('uid=jdoe,o=org', {
+            'givenName': ['John'], 'mail': ['jdoe@example.com', 'jd@example.com'],
+            'ou': []})
+        assert entry.entry_dn == 'uid=jdoe,o=org'
+        # same string conversions as ldap3 attributes
+        assert str(entry.givenName) == 'John'
+        assert str(entry.mail) == str(['jdoe@example.com', 'jd@example.com'])
+        assert entry.givenName.value == 'John'
+        assert entry.ou.value is None
+        # case-insensitive attribute names
+        assert entry.givenname.values == ['John']
+        assert entry['GIVENNAME'].values == ['John']
+        assert 'mail' in entry
+        with pytest.raises(LDAPCursorError):
+            entry.sn
+
+    def test_from_entry(self):
+        ldap_entry = mock.Mock(entry_dn='uid=jdoe',
+                               entry_attributes_as_dict={'sn': ['Doe']})
+        entry = DirectoryEntry.from_entry(ldap_entry)
+        assert entry.entry_attributes_as_dict == {'sn': ['Doe']}
+        assert DirectoryEntry.from_entry(entry) is entry
+
+    def test_pickle(self):
+        import pickle
+        entry = DirectoryEntry('uid=jdoe', {'sn': ['Doe']})
+        assert pickle.loads(pickle.dumps(entry)) == entry
+
+
+class TestEntryCache(TestCase):
+
+    attributes = ['givenName', 'sn']
+
+    def test_local_cache(self):
+        cache = LocalEntryCache(max_entries=2)
+        jdoe = DirectoryEntry('uid=jdoe', {'sn': ['Doe']})
+        assert cache.get('jdoe', self.attributes) is None
+        cache.set_many({'jdoe': jdoe, 'unknown': None}, self.attributes)
+        # netids are case-insensitive
+        assert cache.get('JDoe', self.attributes) == jdoe
+        assert cache.get('unknown', self.attributes) is NOT_FOUND
+        # different attributes requested
+        assert cache.get('jdoe', ['sn']) is None
+        assert cache.stats() == {'hits': 2, 'misses': 2}
+
+        # least recently used entry is evicted
+        cache.get('jdoe', self.attributes)
+        cache.set('jschmoe', self.attributes, jdoe)
+        assert len(cache) == 2
+        assert cache.get('unknown', self.attributes) is None
+        assert cache.get('jdoe', self.attributes) == jdoe
+
+        cache.invalidate('jschmoe')
+        assert cache.get('jschmoe', self.attributes) is None
+        cache.invalidate()
+        assert len(cache) == 0
+
+    @mock.patch('pucas.cache.time')
+    def test_local_cache_expiry(self, mocktime):
+        cache = LocalEntryCache(timeout=60, negative_timeout=10)
+        mocktime.monotonic.return_value = 100
+        cache.set_many({'jdoe': DirectoryEntry('uid=jdoe', {}),
+                        'unknown': NOT_FOUND}, self.attributes)
+        mocktime.monotonic.return_value = 120
+        assert cache.get('jdoe', self.attributes) is not None
+        assert cache.get('unknown', self.attributes) is None
+        mocktime.monotonic.return_value = 200
+        assert cache.get('jdoe', self.attributes) is None
+
+        # negative caching disabled
+        cache = LocalEntryCache(negative_timeout=0)
+        cache.set('unknown', self.attributes, None)
+        assert cache.get('unknown', self.attributes) is None
+
+    def test_django_cache(self):
+        cache = DjangoEntryCache()
+        jdoe = DirectoryEntry('uid=jdoe', {'sn': ['Doe']})
+        cache.set_many({'jdoe': jdoe, 'jschmoe': jdoe, 'unknown': None},
+                       self.attributes)
+        assert cache.get_many(['jdoe', 'unknown', 'other'], self.attributes) \
+            == {'jdoe': jdoe, 'unknown': NOT_FOUND}
+        # shared with other processes through the django cache
+        assert DjangoEntryCache().get('jdoe', self.attributes) == jdoe
+
+        cache.invalidate('jdoe')
+        assert cache.get('jdoe', self.attributes) is None
+        assert cache.get('jschmoe', self.attributes) == jdoe
+        cache.invalidate()
+        assert cache.get('jschmoe', self.attributes) is None
+
+    def test_get_entry_cache(self):
+        with override_settings(PUCAS_LDAP={}):
+            assert get_entry_cache() is None
+            # no error when not configured
+            invalidate_entry_cache()
+        with override_settings(PUCAS_LDAP={'CACHE': {'MAX_ENTRIES': 10}}):
+            cache = get_entry_cache()
+            assert isinstance(cache, LocalEntryCache)
+            assert cache.max_entries == 10
+            assert get_entry_cache() is cache
+        with override_settings(PUCAS_LDAP={'CACHE': {'BACKEND': 'django',
+                                                     'TIMEOUT': 60}}):
+            cache = get_entry_cache()
+            assert isinstance(cache, DjangoEntryCache)
+            assert cache.timeout == 60
+
+    @mock.patch('pucas.ldap.ldap3')
+    @override_settings(PUCAS_LDAP={'SERVERS': ['ldap1'],
+        'ATTRIBUTES': ['uid', 'sn'], 'CACHE': {'BACKEND': 'local'},
+        'SEARCH_BASE': 'o=my_org', 'SEARCH_FILTER': "(uid=%(user)s)"})
+    def test_find_user_cached(self, mockldap3):
+        ldsearch = LDAPSearch()
+        ldsearch.conn.entries = [DirectoryEntry('uid=jdoe', {'uid': ['jdoe']})]
+        entry = ldsearch.find_user('jdoe')
+        # second lookup is served from the cache
+        assert ldsearch.find_user('jdoe') == entry
+        assert ldsearch.conn.search.call_count == 1
+        # unless all attributes are requested
+        ldsearch.find_user('jdoe', all_attributes=True)
+        assert ldsearch.conn.search.call_count == 2
+
+        # not found is cached
+        ldsearch.conn.entries = []
+        for i in range(2):
+            with pytest.raises(LDAPSearchException):
+                ldsearch.find_user('unknown')
+        assert ldsearch.conn.search.call_count == 3
+
+        # batch lookup only searches for uncached netids
+        ldsearch.conn.result = {}
+        ldsearch.conn.entries = [
+            DirectoryEntry('uid=jschmoe', {'uid': ['jschmoe']})]
+        result = ldsearch.find_users(['jdoe', 'unknown', 'jschmoe'])
+        assert list(result.found) == ['jdoe', 'jschmoe']
+        assert result.missing == ['unknown']
+        ldsearch.conn.search.assert_called_with('o=my_org',
+            '(|(uid=jschmoe))', attributes=['uid', 'sn'], paged_size=500,
+            paged_cookie=None)
+        assert ldsearch.find_user('jschmoe') == result.found['jschmoe']
+        assert ldsearch.conn.search.call_count == 4
+
+        invalidate_entry_cache('jdoe')
+        ldsearch.find_user('jdoe')
+        assert ldsearch.conn.search.call_count == 5
+
+
 def extra_user_init(user, user_info):
     user.extra = 'custom init'
 
 
+mirror_settings = {
+    'SERVERS': ['ldap1'], 'SEARCH_BASE': 'o=my_org',
+    'SEARCH_FILTER': '(uid=%(user)s)', 'ATTRIBUTE_MAP': {'email': 'mail'},
+    'MIRROR': {'MAX_AGE': 3600}}
+
+
+@override_settings(PUCAS_LDAP=mirror_settings)
+class TestDirectoryMirror(TestCase):
+
+    jdoe = DirectoryEntry('uid=jdoe,o=my_org', {'mail': ['jdoe@example.com']})
+
+    def test_get_mirrored(self):
+        update_mirror({'JDoe': self.jdoe}, ['mail'])
+        # netids are case-insensitive
+        assert get_mirrored(['jdoe', 'unknown'], ['mail']) == \
+            {'jdoe': self.jdoe}
+        # different attributes requested
+        assert get_mirrored(['jdoe'], ['mail', 'sn']) == {}
+        # replaced when updated
+        update_mirror({'jdoe': self.jdoe}, ['mail'])
+        assert DirectoryMirrorEntry.objects.count() == 1
+
+        # entries older than MAX_AGE are only used if stale is allowed
+        DirectoryMirrorEntry.objects.update(
+            fetched_at=timezone.now() - timedelta(hours=2))
+        assert get_mirrored(['jdoe'], ['mail']) == {}
+        assert get_mirrored(['jdoe'], ['mail'], stale=True) == \
+            {'jdoe': self.jdoe}
+
+        with override_settings(PUCAS_LDAP={}):
+            assert get_mirrored(['jdoe'], ['mail'], stale=True) == {}
+
+    def test_update_conflict(self):
+        update_mirror({'jdoe': self.jdoe}, ['mail'])
+        # a concurrent write for the same netid is logged, not raised
+        with mock.patch.object(DirectoryMirrorEntry.objects, 'bulk_create',
+                               side_effect=IntegrityError('duplicate key')):
+            with self.assertLogs('pucas.mirror', 'WARNING'):
+                update_mirror({'jdoe': self.jdoe}, ['mail', 'sn'])
+        # rolled back
+        assert get_mirrored(['jdoe'], ['mail']) == {'jdoe': self.jdoe}
+
+    @mock.patch('pucas.ldap.ldap3')
+    def test_find_user(self, mockldap3):
+        ldsearch = LDAPSearch()
+        update_mirror({'jdoe': self.jdoe}, ['mail'])
+        # served from the mirror without searching
+        assert ldsearch.find_user('jdoe') == self.jdoe
+        ldsearch.conn.search.assert_not_called()
+
+        # searched and mirrored if not in the mirror
+        ldsearch.conn.entries = [DirectoryEntry(
+            'uid=jschmoe,o=my_org', {'mail': ['jschmoe@example.com']})]
+        ldsearch.find_user('jschmoe')
+        ldsearch.conn.search.assert_called_once()
+        assert get_mirrored(['jschmoe'], ['mail'])
+
+
+    @mock.patch('pucas.ldap.ldap3')
+    def test_directory_unavailable(self, mockldap3):
+        # older entries are used if the directory can't be reached
+        update_mirror({'jdoe': self.jdoe, 'jdoe2': self.jdoe}, ['mail'])
+        DirectoryMirrorEntry.objects.update(
+            fetched_at=timezone.now() - timedelta(hours=2))
+        mockldap3.Connection.side_effect = LDAPSocketOpenError
+        assert LDAPSearch().find_user('jdoe') == self.jdoe
+        assert get_ldap_search().find_user('jdoe') == self.jdoe
+        user, created = init_cas_user('jdoe')
+        assert user.email == 'jdoe@example.com'
+        user = get_user_model().objects.create(username='jdoe2')
+        user_info_from_ldap(user)
+        assert user.email == 'jdoe@example.com'
+
+        with pytest.raises(LDAPSocketOpenError):
+            LDAPSearch().find_user('unknown')
+        # without a mirror, connection errors are raised as before
+        with override_settings(PUCAS_LDAP=dict(mirror_settings, MIRROR=None)):
+            with pytest.raises(LDAPSocketOpenError):
+                LDAPSearch()
+
+    @mock.patch('pucas.ldap.ldap3')
+    def test_find_users(self, mockldap3):
+        ldsearch = LDAPSearch()
+        update_mirror({'jdoe': self.jdoe}, ['mail'])
+        jschmoe = DirectoryEntry('uid=jschmoe,o=my_org',
+                                 {'uid': ['jschmoe'], 'mail': ['js@example.com']})
+        ldsearch.conn.entries = [jschmoe]
+        ldsearch.conn.result = {}
+        results = ldsearch.find_users(['jdoe', 'jschmoe'])
+        assert results.found == {'jdoe': self.jdoe, 'jschmoe': jschmoe}
+        # only the netid not mirrored is searched
+        assert ldsearch.conn.search.call_count == 1
+        assert ldsearch.conn.search.call_args[0][1] == '(|(uid=jschmoe))'
+        assert get_mirrored(['jschmoe'], ['mail'])
+
+        # not used when skipping the cache, e.g. for sync
+        ldsearch.conn.entries = []
+        assert ldsearch.find_users(['jdoe'], use_cache=False).missing == \
+            ['jdoe']
+
+    @mock.patch('pucas.ldap.ldap3')
+    def test_init_cas_user(self, mockldap3):
+        update_mirror({'jdoe': self.jdoe}, ['mail'])
+        user, created = init_cas_user('jdoe')
+        # no connection needed
+        mockldap3.Connection.assert_not_called()
+        assert created
+        assert user.email == 'jdoe@example.com'
+
+    @mock.patch('pucas.ldap.LDAPSearch')
+    def test_import_directory(self, mockldapsearch):
+        ldsearch = mockldapsearch.return_value
+        ldsearch.netid_attribute.return_value = 'uid'
+        ldsearch._paged_search.return_value = [
+            DirectoryEntry('uid=jdoe,o=my_org', {'uid': ['jdoe'],
+                                                 'mail': ['jdoe@example.com']}),
+            DirectoryEntry('uid=jschmoe,o=my_org', {'uid': ['jschmoe']}),
+            DirectoryEntry('cn=group,o=my_org', {'cn': ['group']})]
+        # previously mirrored entry no longer in the directory
+        update_mirror({'gone': self.jdoe}, ['mail'])
+        DirectoryMirrorEntry.objects.update(
+            fetched_at=timezone.now() - timedelta(hours=2))
+
+        assert import_directory(batch_size=1) == (2, 1)
+        ldsearch._paged_search.assert_called_with(
+            'o=my_org', '(uid=*)', ['mail', 'uid'], 500)
+        ldsearch.close.assert_called_with()
+        assert sorted(DirectoryMirrorEntry.objects
+                      .values_list('netid', flat=True)) == ['jdoe', 'jschmoe']
+
+        stdout = StringIO()
+        call_command('mirrorldapusers', '--filter', '(ou=staff)',
+                     stdout=stdout)
+        assert ldsearch._paged_search.call_args[0][1] == '(ou=staff)'
+        assert 'Mirrored 2 entries, removed 0' in stdout.getvalue()
+
+        with override_settings(PUCAS_LDAP={}):
+            with pytest.raises(CommandError):
+                call_command('mirrorldapusers')
+
+
+class TestUserInfoPlan(TestCase):
+
+    def test_compile(self):
+        plan = compile_plan({
+            'ATTRIBUTES': ['givenName', 'sn', 'givenname', 'mail'],
+            'ATTRIBUTE_MAP': {'first_name': 'givenName',
+                              'email': ['mail', 'eduPersonPrincipalName']},
+            'EXTRA_USER_INIT': 'pucas.tests.extra_user_init'})
+        assert plan.fields == (
+            FieldMapping('first_name', ('givenName', )),
+            FieldMapping('email', ('mail', 'eduPersonPrincipalName')))
+        # duplicates removed, case-insensitively; the init function
+        # doesn't declare its attributes, so all of ATTRIBUTES are used
+        # along with those for the map
+        assert plan.attributes == ('givenName', 'sn', 'mail',
+                                   'eduPersonPrincipalName')
+        assert plan.extra_init is extra_user_init
+
+        plan = compile_plan({})
+        assert plan == UserInfoPlan((), (), None)
+
+    def test_derived_attributes(self):
+        attr_map = {'first_name': 'givenName',
+                    'email': ['mail', 'eduPersonPrincipalName']}
+        # attributes derived from the map, not ATTRIBUTES
+        with self.assertLogs('pucas.config', 'WARNING') as logs:
+            plan = compile_plan({'ATTRIBUTES': ['givenName', 'sn', 'ou'],
+                                 'ATTRIBUTE_MAP': attr_map})
+        assert plan.attributes == ('givenName', 'mail',
+                                   'eduPersonPrincipalName')
+        assert 'will not be requested: sn, ou' in logs.output[0]
+
+        # ATTRIBUTES is optional with a map
+        assert compile_plan({'ATTRIBUTE_MAP': attr_map}).attributes == \
+            plan.attributes
+
+        # plus attributes declared by the init function
+        extra_user_init.ldap_attributes = ['ou']
+        try:
+            plan = compile_plan({
+                'ATTRIBUTE_MAP': attr_map,
+                'EXTRA_USER_INIT': 'pucas.tests.extra_user_init'})
+        finally:
+            del extra_user_init.ldap_attributes
+        assert plan.attributes == ('givenName', 'mail',
+                                   'eduPersonPrincipalName', 'ou')
+
+        # an init function that doesn't declare them gets ATTRIBUTES too
+        plan = compile_plan({
+            'ATTRIBUTES': ['ou'], 'ATTRIBUTE_MAP': attr_map,
+            'EXTRA_USER_INIT': 'pucas.tests.extra_user_init'})
+        assert plan.attributes == ('ou', 'givenName', 'mail',
+                                   'eduPersonPrincipalName')
+        plan = compile_plan({
+            'ATTRIBUTE_MAP': attr_map,
+            'EXTRA_USER_INIT': 'pucas.tests.extra_user_init'})
+        assert plan.attributes == ('givenName', 'mail',
+                                   'eduPersonPrincipalName')
+
+    def test_invalid(self):
+        for config in [
+                {'ATTRIBUTE_MAP': ['first_name']},
+                {'ATTRIBUTE_MAP': {'not_a_field': 'givenName'}},
+                {'ATTRIBUTE_MAP': {'first_name': []}},
+                {'ATTRIBUTE_MAP': {'first_name': ['givenName', None]}},
+                {'EXTRA_USER_INIT': 'pucas.tests.no_such_function'},
+                {'EXTRA_USER_INIT': 'pucas.ldap.PAGED_RESULTS_OID'}]:
+            with pytest.raises(ImproperlyConfigured):
+                compile_plan(config)
+
+    def test_settings_changed(self):
+        with override_settings(PUCAS_LDAP={
+                'ATTRIBUTE_MAP': {'first_name': 'givenName'}}):
+            plan = get_plan()
+            # compiled once
+            assert get_plan() is plan
+        with override_settings(PUCAS_LDAP={
+                'ATTRIBUTE_MAP': {'last_name': 'sn'}}):
+            assert get_plan().fields == (FieldMapping('last_name', ('sn', )),)
+
+    search_config = {'SERVERS': ['ldap.example.com'],
+                     'SEARCH_BASE': 'o=my_org',
+                     'SEARCH_FILTER': '(uid=%(user)s)'}
+
+    def test_check_search_settings(self):
+        check_search_settings(self.search_config)
+        check_search_settings(dict(self.search_config, GET_INFO='schema'))
+        check_search_settings(dict(
+            self.search_config, SEARCH_FILTER='(|(uid=%(user)s)(mail=*))'))
+        for config in [
+                {},
+                dict(self.search_config, SERVERS=[]),
+                dict(self.search_config, SERVERS='ldap.example.com'),
+                dict(self.search_config, GET_INFO='everything'),
+                dict(self.search_config, SEARCH_FILTER='(uid=jdoe)'),
+                # netid attribute can't be determined from the filter
+                dict(self.search_config,
+                     SEARCH_FILTER='(uid=%(user)s@example.com)')]:
+            with pytest.raises(ImproperlyConfigured):
+                check_search_settings(config)
+        check_search_settings(dict(
+            self.search_config, SEARCH_FILTER='(uid=%(user)s@example.com)',
+            NETID_ATTRIBUTE='uid'))
+
+    def test_ready(self):
+        app_config = apps.get_app_config('pucas')
+        with override_settings(PUCAS_LDAP=self.search_config):
+            app_config.ready()
+        for config in [
+                dict(self.search_config,
+                     EXTRA_USER_INIT='pucas.tests.no_such_function'),
+                dict(self.search_config, GET_INFO='everything'),
+                {'ATTRIBUTE_MAP': {'first_name': 'givenName'}}]:
+            with override_settings(PUCAS_LDAP=config):
+                with pytest.raises(ImproperlyConfigured):
+                    app_config.ready()
+
+
 @mock.patch('pucas.ldap.LDAPSearch')
 class TestUserInfo(TestCase):
 
@@ -187,16 +1489,16 @@ class TestUserInfo(TestCase):
 
     @override_settings(PUCAS_LDAP={'ATTRIBUTE_MAP': test_attr_map})
     def test_attrs(self, mock_ldapsearch):
-        mockuser = mock.Mock(username='jdoe')
+        user = get_user_model().objects.create(username='jdoe')
         # simulate no user info returned
         mock_ldapsearch.return_value.find_user.return_value = None
-        user_info_from_ldap(mockuser)
-        # ldap search init should be called with no args
-        mock_ldapsearch.assert_called_with()
+        with self.assertNumQueries(0):
+            user_info_from_ldap(user)
+        # shared ldap search, holding no connection while waiting on a
+        # concurrent lookup
+        mock_ldapsearch.assert_called_with(shared=True)
         # find user should be called with username
         mock_ldapsearch.return_value.find_user.assert_called_with('jdoe')
-        # user save should not be called - no data
-        mockuser.save.assert_not_called()
 
         mock_ldapinfo = MockLDAPInfo(
                         eduPerson='jdoe2@example.com',
@@ -208,47 +1510,87 @@ class TestUserInfo(TestCase):
         # first test that list style attributes are set in order, and string
         # attributes are set as given
         mock_ldapsearch.return_value.find_user.return_value = mock_ldapinfo
-        user_info_from_ldap(mockuser)
-        assert mockuser.first_name == mock_ldapinfo.givenName
-        assert mockuser.last_name == mock_ldapinfo.surname
-        assert mockuser.email == mock_ldapinfo.mail
-        mockuser.save.assert_called_with()
+        with mock.patch.object(user, 'save', wraps=user.save) as mock_save:
+            user_info_from_ldap(user)
+        # only changed fields are saved
+        mock_save.assert_called_with(
+            update_fields=['first_name', 'last_name', 'email'])
+        user.refresh_from_db()
+        assert user.first_name == mock_ldapinfo.givenName
+        assert user.last_name == mock_ldapinfo.surname
+        assert user.email == mock_ldapinfo.mail
+
+        # no save when nothing changed
+        with self.assertNumQueries(0):
+            user_info_from_ldap(user)
 
         # second test that should pass over an unset eduPerson attr and
         # set using givenName in list
-        # NOTE: recreating mock to clear all assigned attrs
         delattr(mock_ldapinfo, 'mail')
-        user_info_from_ldap(mockuser)
-        assert mockuser.first_name == mock_ldapinfo.givenName
-        assert mockuser.last_name == mock_ldapinfo.surname
-        assert mockuser.email == mock_ldapinfo.eduPerson
-        mockuser.save.assert_called_with()
+        with mock.patch.object(user, 'save', wraps=user.save) as mock_save:
+            user_info_from_ldap(user)
+        mock_save.assert_called_with(update_fields=['email'])
+        user.refresh_from_db()
+        assert user.first_name == mock_ldapinfo.givenName
+        assert user.last_name == mock_ldapinfo.surname
+        assert user.email == mock_ldapinfo.eduPerson
 
         # missing attribute altogether should result in an empty string
         delattr(mock_ldapinfo, 'givenName')
         delattr(mock_ldapinfo, 'surname')
-        mockuser = mock.Mock(username='jdoe')
-        # set to none to avoid Mock returning a mock and default behavior of
-        # getattr
-        mockuser.first_name = None
-        mockuser.last_name = None
-        mock_ldapsearch.return_value.find_user.return_value = mock_ldapinfo
-        user_info_from_ldap(mockuser)
-        assert mockuser.first_name == ''
-        assert mockuser.last_name == ''
-        assert mockuser.email == mock_ldapinfo.eduPerson
-        mockuser.save.assert_called_with()
+        user = get_user_model().objects.create(username='jdoe2')
+        user_info_from_ldap(user)
+        user.refresh_from_db()
+        assert user.first_name == ''
+        assert user.last_name == ''
+        assert user.email == mock_ldapinfo.eduPerson
+
+    @override_settings(PUCAS_LDAP={'ATTRIBUTE_MAP': test_attr_map})
+    def test_unsaved_user(self, mock_ldapsearch):
+        user = get_user_model()(username='jdoe')
+        user_info_from_ldap(user, user_info=MockLDAPInfo(
+            givenName='John', surname='Doe', mail='jdoe@example.com'))
+        # new user is saved in full
+        assert get_user_model().objects.get(username='jdoe').first_name == \
+            'John'
+
+    @override_settings(PUCAS_LDAP={'ATTRIBUTE_MAP': test_attr_map})
+    def test_prefetched_entry(self, mock_ldapsearch):
+        user = get_user_model().objects.create(username='jdoe')
+        mock_ldapinfo = MockLDAPInfo(givenName='John', surname='Doe',
+                                     mail='jdoe@example.com')
+        user_info_from_ldap(user, user_info=mock_ldapinfo)
+        # no new search when the entry is passed in
+        mock_ldapsearch.assert_not_called()
+        user.refresh_from_db()
+        assert user.first_name == 'John'
+
+        # existing search instance is used when passed in
+        ldap = mock.Mock()
+        ldap.find_user.return_value = mock_ldapinfo
+        user_info_from_ldap(user, ldap=ldap)
+        mock_ldapsearch.assert_not_called()
+        ldap.find_user.assert_called_with('jdoe')
+        # caller's connection is not closed
+        ldap.close.assert_not_called()
 
     @override_settings(PUCAS_LDAP={'ATTRIBUTE_MAP': test_attr_map,
         'EXTRA_USER_INIT': 'pucas.tests.extra_user_init'})
     def test_extra_init(self, mock_ldapsearch):
-        mockuser = mock.Mock(username='jdoe')
+        user = get_user_model().objects.create(username='jdoe')
 
-        mock_ldapsearch.return_value.find_user.return_value = mock.Mock()
-        user_info_from_ldap(mockuser)
+        mock_ldapsearch.return_value.find_user.return_value = MockLDAPInfo()
+        user_info_from_ldap(user)
         # check for custom field set by test extra init method
-        assert mockuser.extra == 'custom init'
-        mockuser.save.assert_called_with()
+        assert user.extra == 'custom init'
+
+        # changes to fields made by the init method are saved
+        with override_settings(PUCAS_LDAP={
+                'ATTRIBUTE_MAP': self.test_attr_map,
+                'EXTRA_USER_INIT': 'pucas.tests.extra_user_deactivate'}):
+            user_info_from_ldap(user)
+        user.refresh_from_db()
+        assert not user.is_active
 
 
 @mock.patch('pucas.management.commands.ldapsearch.LDAPSearch')
@@ -263,11 +1605,13 @@ class TestLDAPSearchCommand(TestCase):
 
     def test_search(self, mock_ldapsearch):
         mock_ldapinfo = mock.Mock(foo='phooey', bar='none', baz='1')
-        mock_ldapsearch.return_value.find_user.return_value = mock_ldapinfo
+        mock_ldapsearch.return_value.find_users.return_value = \
+            LDAPBatchResult({'jdoe': mock_ldapinfo}, [], [])
         self.cmd.handle(netid=['jdoe'], all=False)
         mock_ldapsearch.assert_called_with()
-        mock_ldapsearch.return_value.find_user.assert_called_with('jdoe',
-            all_attributes=False)
+        mock_ldapsearch.return_value.find_users.assert_called_with(['jdoe'],
+            all_attributes=False, workers=None)
+        mock_ldapsearch.return_value.close.assert_called_with()
         output = self.cmd.stdout.getvalue()
         assert 'Looking for jdoe...' in output
         assert '%-15s %s' % ('foo', 'phooey') in output
@@ -275,29 +1619,99 @@ class TestLDAPSearchCommand(TestCase):
         assert '%-15s %s' % ('baz', '1') in output
 
     def test_search_all_attr(self, mock_ldapsearch):
-        mock_ldapsearch.return_value.find_user.return_value = 'full return'
+        mock_ldapsearch.return_value.find_users.return_value = \
+            LDAPBatchResult({'jdoe': 'full return'}, [], [])
         self.cmd.handle(netid=['jdoe'], all=True)
-        mock_ldapsearch.return_value.find_user.assert_called_with('jdoe',
-            all_attributes=True)
+        mock_ldapsearch.return_value.find_users.assert_called_with(['jdoe'],
+            all_attributes=True, workers=None)
         output = self.cmd.stdout.getvalue()
         # currently all attributes just prints the returned object
         assert 'full return' in output
 
     def test_err(self, mock_ldapsearch):
-        error_message = 'Error looking for jdoe'
-        mock_ldapsearch.return_value.find_user.side_effect = \
+        mock_ldapsearch.return_value.find_users.return_value = \
+            LDAPBatchResult({}, ['jdoe'], ['jschmoe'])
+        self.cmd.handle(netid=['jdoe', 'jschmoe'], all=False)
+        output = self.cmd.stderr.getvalue()
+        assert 'No match found for jdoe' in output
+        assert 'Found more than one entry for jschmoe' in output
+
+        error_message = 'LDAP is not configured for user lookup'
+        mock_ldapsearch.return_value.find_users.side_effect = \
             LDAPSearchException(error_message)
         self.cmd.handle(netid=['jdoe'], all=False)
         output = self.cmd.stderr.getvalue()
         assert error_message in output
 
     def test_call_command(self, mock_ldapsearch):
+        mock_ldapsearch.return_value.find_users.return_value = \
+            LDAPBatchResult({}, ['jdoe'], [])
         call_command('ldapsearch', 'jdoe')
-        mock_ldapsearch.return_value.find_user.assert_called_with('jdoe',
-            all_attributes=False)
-
-
-@mock.patch('pucas.management.commands.createcasuser.init_cas_user')
+        mock_ldapsearch.return_value.find_users.assert_called_with(['jdoe'],
+            all_attributes=False, workers=None)
+
+        with pytest.raises(CommandError):
+            call_command('ldapsearch')
+
+    @override_settings(PUCAS_LDAP={'ATTRIBUTES': ['uid', 'mail'],
+                                   'BATCH_SIZE': 2})
+    def test_formats(self, mock_ldapsearch):
+        jdoe = DirectoryEntry('uid=jdoe,o=org',
+                              {'uid': ['jdoe'], 'mail': ['jdoe@example.com']})
+        mock_ldapsearch.return_value.find_users.side_effect = \
+            lambda netids, **kwargs: LDAPBatchResult(
+                {'jdoe': jdoe} if 'jdoe' in netids else {},
+                [netid for netid in netids if netid == 'unknown'],
+                [netid for netid in netids if netid == 'dupe'])
+
+        # netids from stdin as well as arguments, searched in batches
+        out = StringIO()
+        with mock.patch('sys.stdin', StringIO('unknown\n\ndupe\n')):
+            call_command('ldapsearch', 'jdoe', '--stdin', '--format', 'jsonl',
+                         stdout=out)
+        assert mock_ldapsearch.return_value.find_users.call_args_list == [
+            mock.call(['jdoe', 'unknown'], all_attributes=False, workers=None),
+            mock.call(['dupe'], all_attributes=False, workers=None)]
+        assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+            {'netid': 'jdoe', 'status': 'found', 'dn': 'uid=jdoe,o=org',
+             'attributes': {'uid': ['jdoe'], 'mail': ['jdoe@example.com']}},
+            {'netid': 'unknown', 'status': 'not_found'},
+            {'netid': 'dupe', 'status': 'ambiguous'}]
+
+        out = StringIO()
+        call_command('ldapsearch', 'jdoe', 'unknown', 'dupe', '--format',
+                     'json', stdout=out)
+        records = json.loads(out.getvalue())
+        assert [record['status'] for record in records] == \
+            ['found', 'not_found', 'ambiguous']
+        out = StringIO()
+        call_command('ldapsearch', 'unknown', '--format', 'json', stdout=out)
+        assert json.loads(out.getvalue()) == \
+            [{'netid': 'unknown', 'status': 'not_found'}]
+
+        out = StringIO()
+        call_command('ldapsearch', 'jdoe', 'unknown', '--format', 'csv',
+                     stdout=out)
+        assert out.getvalue().splitlines() == [
+            'netid,status,dn,uid,mail',
+            'jdoe,found,"uid=jdoe,o=org",jdoe,jdoe@example.com',
+            'unknown,not_found,,,']
+        with pytest.raises(CommandError):
+            call_command('ldapsearch', 'jdoe', '--format', 'csv', '--all')
+
+        # json output is still valid if a later batch fails
+        mock_ldapsearch.return_value.find_users.side_effect = [
+            LDAPBatchResult({'jdoe': jdoe}, [], []),
+            LDAPSearchException('server down')]
+        out, err = StringIO(), StringIO()
+        call_command('ldapsearch', 'jdoe', 'unknown', 'dupe', '--format',
+                     'json', stdout=out, stderr=err)
+        assert [record['netid'] for record in json.loads(out.getvalue())] == \
+            ['jdoe', 'unknown']
+        assert 'server down' in err.getvalue()
+
+
+@mock.patch('pucas.management.commands.createcasuser.bulk_init_cas_users')
 class TestCreateCasUserCommand(TestCase):
 
     def setUp(self):
@@ -305,43 +1719,117 @@ class TestCreateCasUserCommand(TestCase):
         self.cmd.stdout = StringIO()
         self.cmd.stderr = StringIO()
 
-    def test_handle(self, mock_init_cas_user):
-        mockuser = mock.Mock(is_staff=False, is_superuser=False)
-        mock_init_cas_user.return_value = (mockuser, False)
+    def test_handle(self, mock_bulk_init):
+        mock_bulk_init.return_value = BulkInitResult([], ['jdoe'], [], [])
         self.cmd.handle(netids=['jdoe'], admin=False, staff=False)
-        mock_init_cas_user.assert_called_with('jdoe')
         # not given staff or superuser permissions
-        assert not mockuser.is_staff
-        assert not mockuser.is_superuser
+        mock_bulk_init.assert_called_with(['jdoe'], staff=False,
+                                          superuser=False, workers=None)
         output = self.cmd.stdout.getvalue()
         assert "Updated user 'jdoe'" in output
 
         # init with staff=True
         self.cmd.handle(netids=['jdoe'], admin=False, staff=True)
-        assert mockuser.is_staff
-        assert mockuser.is_active
+        mock_bulk_init.assert_called_with(['jdoe'], staff=True,
+                                          superuser=False, workers=None)
         # init with admin=True
-        self.cmd.handle(netids=['jdoe'], admin=True, staff=True)
-        assert mockuser.is_staff
-        assert mockuser.is_admin
-        assert mockuser.is_active
+        self.cmd.handle(netids=['jdoe'], admin=True, staff=False)
+        mock_bulk_init.assert_called_with(['jdoe'], staff=True,
+                                          superuser=True, workers=None)
 
         # created vs updated
-        mock_init_cas_user.return_value = (mockuser, True)
+        mock_bulk_init.return_value = BulkInitResult(['jschmoe'], [], [], [])
         self.cmd.handle(netids=['jschmoe'], admin=True, staff=True)
         output = self.cmd.stdout.getvalue()
         assert "Created user 'jschmoe'" in output
 
-    def test_err(self, mock_init_cas_user):
-        mock_init_cas_user.side_effect = LDAPSearchException
-        self.cmd.handle(netids=['jdoe'], admin=False, staff=False)
+    def test_err(self, mock_bulk_init):
+        mock_bulk_init.return_value = BulkInitResult([], [], ['jdoe'], ['jschmoe'])
+        self.cmd.handle(netids=['jdoe', 'jschmoe'], admin=False, staff=False)
         output = self.cmd.stderr.getvalue()
         assert "LDAP information for 'jdoe' not found" in output
+        assert "Found more than one LDAP entry for 'jschmoe'" in output
 
-    def test_call_command(self, mock_init_cas_user):
-        mock_init_cas_user.side_effect = LDAPSearchException
+    def test_call_command(self, mock_bulk_init):
+        mock_bulk_init.return_value = BulkInitResult([], [], ['jdoe'], [])
         call_command('createcasuser', 'jdoe', '--staff')
-        mock_init_cas_user.assert_called_with('jdoe')
+        mock_bulk_init.assert_called_with(['jdoe'], staff=True,
+                                          superuser=False, workers=None)
+        call_command('createcasuser', 'jdoe', '--workers', '4')
+        mock_bulk_init.assert_called_with(['jdoe'], staff=False,
+                                          superuser=False, workers=4)
+
+    def test_from_file(self, mock_bulk_init):
+        mock_bulk_init.side_effect = lambda netids, **kwargs: \
+            BulkInitResult([], netids, [], [])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'roster.csv')
+            with open(path, 'w') as roster:
+                roster.write('name,netid,staff\nJohn,jdoe,\nJoe,jschmoe,yes\n'
+                             'Jane,jane,\n')
+            call_command('createcasuser', '--from-file', path,
+                         '--chunk-size', '2', stdout=StringIO())
+        # rows are processed in chunks, grouped by permissions
+        assert mock_bulk_init.call_args_list == [
+            mock.call(['jdoe'], staff=False, superuser=False, workers=None),
+            mock.call(['jschmoe'], staff=True, superuser=False, workers=None),
+            mock.call(['jane'], staff=False, superuser=False, workers=None)]
+
+        # csv without a header
+        assert list(createcasuser.read_roster(StringIO('jdoe\njschmoe\n'))) \
+            == [('jdoe', False, False), ('jschmoe', False, False)]
+
+        # jsonl from stdin
+        mock_bulk_init.reset_mock()
+        stdin = StringIO('{"netid": "jdoe", "admin": true}\n\n'
+                         '{"netid": "jschmoe"}\n')
+        with mock.patch('sys.stdin', stdin):
+            call_command('createcasuser', '--from-file', '-',
+                         stdout=StringIO())
+        assert mock_bulk_init.call_args_list == [
+            mock.call(['jdoe'], staff=True, superuser=True, workers=None),
+            mock.call(['jschmoe'], staff=False, superuser=False, workers=None)]
+
+    def test_result_log(self, mock_bulk_init):
+        mock_bulk_init.side_effect = [
+            BulkInitResult(['jdoe'], [], ['unknown'], []),
+            BulkInitResult([], ['jschmoe'], [], [])]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_path = os.path.join(tmpdir, 'results.jsonl')
+            with open(log_path, 'w') as logfile:
+                logfile.write(json.dumps({'netid': 'jdoe',
+                                          'status': 'created'}) + '\n')
+            stdin = StringIO('netid\njdoe\nunknown\n')
+            with mock.patch('sys.stdin', stdin):
+                call_command('createcasuser', '--from-file', '-',
+                             '--result-log', log_path, stdout=StringIO(),
+                             stderr=StringIO())
+            # netids already in the log are not skipped without --resume
+            mock_bulk_init.assert_called_once_with(
+                ['jdoe', 'unknown'], staff=False, superuser=False,
+                workers=None)
+
+            stdin = StringIO('netid\njdoe\nunknown\njschmoe\n')
+            with mock.patch('sys.stdin', stdin):
+                call_command('createcasuser', '--from-file', '-',
+                             '--result-log', log_path, '--resume',
+                             stdout=StringIO())
+            mock_bulk_init.assert_called_with(
+                ['jschmoe'], staff=False, superuser=False, workers=None)
+
+            with open(log_path) as logfile:
+                results = [json.loads(line) for line in logfile]
+        assert results == [
+            {'netid': 'jdoe', 'status': 'created'},
+            {'netid': 'jdoe', 'status': 'created'},
+            {'netid': 'unknown', 'status': 'not_found'},
+            {'netid': 'jschmoe', 'status': 'updated'}]
+
+    def test_no_netids(self, mock_bulk_init):
+        with pytest.raises(CommandError):
+            call_command('createcasuser')
+        with pytest.raises(CommandError):
+            call_command('createcasuser', 'jdoe', '--resume')
 
 
 @mock.patch('pucas.ldap.LDAPSearch')
@@ -357,8 +1845,13 @@ class TestInitCasUser(TestCase):
 
         mock_ldapsearch.return_value.find_user.assert_called_with('jdoe')
         mock_getuser.return_value.objects.get_or_create.assert_called_with(username='jdoe')
-        # user info should be populated for new users
-        mock_userinfo.assert_called_with(mockuser)
+        # user info should be populated for new users, reusing the entry
+        # already found instead of searching again
+        mock_userinfo.assert_called_with(
+            mockuser,
+            user_info=mock_ldapsearch.return_value.find_user.return_value)
+        # only one search for the user
+        mock_ldapsearch.return_value.find_user.assert_called_once_with('jdoe')
         assert user == mockuser
         assert created is True
 
@@ -369,10 +1862,22 @@ class TestInitCasUser(TestCase):
         user, created = init_cas_user('jdoe')
 
         # user info should be repopulated for existing users too
-        mock_userinfo.assert_called_with(mockuser)
+        mock_userinfo.assert_called_with(
+            mockuser,
+            user_info=mock_ldapsearch.return_value.find_user.return_value)
         assert user == mockuser
         assert created is False
 
+    def test_prefetched_entry(self, mock_getuser, mock_userinfo, mock_ldapsearch):
+        mockuser = mock.Mock()
+        mock_getuser.return_value.objects.get_or_create.return_value = (mockuser, True)
+
+        init_cas_user('jdoe', user_info=mock.sentinel.userinfo)
+        # no search when the entry is passed in
+        mock_ldapsearch.assert_not_called()
+        mock_userinfo.assert_called_with(mockuser,
+                                         user_info=mock.sentinel.userinfo)
+
     def test_ldap_not_found(self, mock_getuser, mock_userinfo, mock_ldapsearch):
         mock_ldapsearch.return_value.find_user.side_effect = LDAPSearchException
 
@@ -383,6 +1888,331 @@ class TestInitCasUser(TestCase):
         mock_getuser.return_value.objects.get_or_create.assert_not_called()
 
 
+def extra_user_deactivate(user, user_info):
+    user.is_active = False
+
+
+@mock.patch('pucas.ldap.LDAPSearch')
+@override_settings(PUCAS_LDAP={
+    'ATTRIBUTE_MAP': {'first_name': 'givenName', 'email': 'mail'}})
+class TestBulkInitCasUsers(TestCase):
+
+    def setUp(self):
+        self.jdoe = MockLDAPInfo(givenName='John', mail='jdoe@example.com')
+        self.jschmoe = MockLDAPInfo(givenName='Joe', mail='js@example.com')
+
+    def test_bulk_init(self, mock_ldapsearch):
+        User = get_user_model()
+        User.objects.create(username='jschmoe', first_name='Joe')
+        mock_ldapsearch.return_value.find_users.return_value = LDAPBatchResult(
+            {'jdoe': self.jdoe, 'jschmoe': self.jschmoe}, ['unknown'], ['dupe'])
+
+        # 1 query for existing, 1 insert, 1 fetch, 1 update, + savepoints
+        with self.assertNumQueries(8):
+            result = bulk_init_cas_users(['jdoe', 'jschmoe', 'unknown', 'dupe'])
+        mock_ldapsearch.return_value.find_users.assert_called_with(
+            ['jdoe', 'jschmoe', 'unknown', 'dupe'], workers=None,
+            use_cache=True)
+        mock_ldapsearch.return_value.close.assert_called_with()
+        assert result == BulkInitResult(['jdoe'], ['jschmoe'], ['unknown'],
+                                        ['dupe'])
+
+        jdoe = User.objects.get(username='jdoe')
+        assert jdoe.first_name == 'John'
+        assert jdoe.email == 'jdoe@example.com'
+        assert not jdoe.is_staff
+        jschmoe = User.objects.get(username='jschmoe')
+        assert jschmoe.email == 'js@example.com'
+        assert not User.objects.filter(username__in=['unknown', 'dupe']).exists()
+
+    def test_created_concurrently(self, mock_ldapsearch):
+        User = get_user_model()
+        User.objects.create(username='jschmoe')
+        mock_ldapsearch.return_value.find_users.return_value = LDAPBatchResult(
+            {'jdoe': self.jdoe, 'jschmoe': self.jschmoe}, [], [])
+        # jschmoe created after checking for existing accounts
+        with mock.patch.object(QuerySet, 'values_list', return_value=[]):
+            result = bulk_init_cas_users(['jdoe', 'jschmoe'])
+        assert result == BulkInitResult(['jdoe'], ['jschmoe'], [], [])
+        assert User.objects.get(username='jdoe').first_name == 'John'
+        assert User.objects.get(username='jschmoe').email == 'js@example.com'
+
+    def test_nothing_found(self, mock_ldapsearch):
+        ldap = mock.Mock()
+        ldap.find_users.return_value = LDAPBatchResult({}, ['unknown'], [])
+        with self.assertNumQueries(0):
+            result = bulk_init_cas_users(['unknown'], ldap=ldap)
+        # passed in search is used and not closed
+        mock_ldapsearch.assert_not_called()
+        ldap.close.assert_not_called()
+        assert result == BulkInitResult([], [], ['unknown'], [])
+
+    @override_settings(PUCAS_LDAP={
+        'ATTRIBUTE_MAP': {'first_name': 'givenName', 'email': 'mail'},
+        'EXTRA_USER_INIT': 'pucas.tests.extra_user_deactivate'})
+    def test_flags(self, mock_ldapsearch):
+        User = get_user_model()
+        User.objects.create(username='jschmoe')
+        mock_ldapsearch.return_value.find_users.return_value = LDAPBatchResult(
+            {'jdoe': self.jdoe, 'jschmoe': self.jschmoe}, [], [])
+
+        # created accounts are activated, overriding extra init
+        bulk_init_cas_users(['jdoe', 'jschmoe'], activate_created=True)
+        assert User.objects.get(username='jdoe').is_active
+        assert not User.objects.get(username='jschmoe').is_active
+
+        bulk_init_cas_users(['jdoe', 'jschmoe'], staff=True)
+        for user in User.objects.all():
+            assert user.is_staff
+            assert not user.is_superuser
+            assert user.is_active
+
+        bulk_init_cas_users(['jdoe'], superuser=True)
+        jdoe = User.objects.get(username='jdoe')
+        assert jdoe.is_staff
+        assert jdoe.is_superuser
+
+
+@mock.patch('pucas.sync.LDAPSearch')
+@override_settings(PUCAS_LDAP={
+    'ATTRIBUTE_MAP': {'first_name': 'givenName', 'email': 'mail'}})
+class TestSyncUsers(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.jdoe = User.objects.create(username='jdoe', first_name='John',
+                                        email='jdoe@example.com')
+        self.jschmoe = User.objects.create(username='jschmoe',
+                                           first_name='Joe')
+        # local account with a password is not synced
+        User.objects.create_user('local', password='secret')
+        self.jdoe.set_unusable_password()
+        self.jdoe.save()
+
+    def test_full_sync(self, mock_ldapsearch):
+        mock_ldapsearch.return_value.find_users.return_value = LDAPBatchResult(
+            {'jdoe': MockLDAPInfo(givenName='John', mail='jdoe@example.com'),
+             'jschmoe': MockLDAPInfo(givenName='Joe', mail='js@example.com')},
+            [], [])
+        out = StringIO()
+        call_command('syncldapusers', '--full', stdout=out)
+
+        mock_ldapsearch.return_value.find_users.assert_called_with(
+            ['jdoe', 'jschmoe'], workers=None, extra_filter=None,
+            use_cache=False)
+        mock_ldapsearch.return_value.close.assert_called_with()
+        # only the changed user is updated
+        assert get_user_model().objects.get(username='jschmoe').email == \
+            'js@example.com'
+        # a full sync can only tell which entries differ
+        assert 'Full sync: 2 checked, 1 changed in LDAP, 1 updated' in \
+            out.getvalue()
+
+        sync = LDAPSync.objects.latest()
+        assert sync.finished
+        assert not sync.incremental
+        assert (sync.checked, sync.updated, sync.not_found) == (2, 1, 0)
+        assert re.match(r'^\d{14}Z$', sync.high_water_mark)
+
+    def test_incremental_sync(self, mock_ldapsearch):
+        mock_ldapsearch.return_value.find_users.return_value = LDAPBatchResult(
+            {}, ['jdoe', 'jschmoe'], [])
+        LDAPSync.objects.create(started=timezone.now(), finished=timezone.now(),
+                                high_water_mark='20260101000000Z')
+        out, err = StringIO(), StringIO()
+        call_command('syncldapusers', 'jdoe', '--batch-size', '1',
+                     stdout=out, stderr=err)
+        # only entries modified since the last sync are requested
+        mock_ldapsearch.return_value.find_users.assert_called_once_with(
+            ['jdoe'], workers=None,
+            extra_filter='(modifyTimestamp>=20260101000000Z)', use_cache=False)
+        assert 'Incremental sync: 1 checked, 0 changed' in out.getvalue()
+        # unmodified entries are not reported as missing
+        assert not err.getvalue()
+
+        # a partial sync isn't recorded, so the next sync of all users
+        # still starts from the last full run
+        assert LDAPSync.objects.count() == 1
+        call_command('syncldapusers', stdout=StringIO())
+        mock_ldapsearch.return_value.find_users.assert_called_with(
+            ['jdoe', 'jschmoe'], workers=None,
+            extra_filter='(modifyTimestamp>=20260101000000Z)', use_cache=False)
+        sync = LDAPSync.objects.latest()
+        assert sync.incremental
+        assert sync.finished
+        assert sync.high_water_mark > '20260101000000Z'
+
+        # nor is one with an explicit start
+        call_command('syncldapusers', '--since', '20260301000000Z',
+                     stdout=StringIO())
+        assert LDAPSync.objects.latest() == sync
+
+    def test_not_found(self, mock_ldapsearch):
+        mock_ldapsearch.return_value.find_users.side_effect = [
+            LDAPBatchResult({}, ['jdoe'], []),
+            LDAPBatchResult({}, [], ['jschmoe'])]
+        result = sync_users(cas_users(), batch_size=1)
+        assert mock_ldapsearch.return_value.find_users.call_count == 2
+        assert result == SyncResult(2, 0, 0, 2)
+
+    def test_changed_fields(self, mock_ldapsearch):
+        user = get_user_model()(username='jdoe', first_name='John')
+        initial = user_field_values(user)
+        assert changed_user_fields(user, initial) == []
+        user.first_name = 'Jon'
+        user.email = 'jdoe@example.com'
+        assert changed_user_fields(user, initial) == ['first_name', 'email']
+
+
+@mock.patch('pucas.lazy.user_info_from_ldap')
+class TestLazyUserInfo(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='jdoe')
+
+    @override_settings(PUCAS_LDAP={'POPULATE_ON_LOGIN': 'lazy'})
+    def test_cas_login(self, mock_userinfo):
+        with mock.patch('pucas.signals.user_info_from_ldap') as mock_signal_info:
+            cas_login(mock.Mock(), self.user, True)
+            mock_signal_info.assert_not_called()
+        assert is_pending(self.user)
+
+    def test_ensure_user_info(self, mock_userinfo):
+        # nothing to do if not pending
+        assert not ensure_user_info(self.user)
+        mock_userinfo.assert_not_called()
+
+        mark_pending(self.user)
+        mark_pending(self.user)
+        assert ensure_user_info(self.user)
+        mock_userinfo.assert_called_once_with(self.user)
+        assert not is_pending(self.user)
+        # populated at most once
+        assert not ensure_user_info(self.user)
+        assert mock_userinfo.call_count == 1
+
+        # still pending if the lookup fails
+        mark_pending(self.user)
+        mock_userinfo.side_effect = LDAPSocketOpenError
+        with pytest.raises(LDAPSocketOpenError):
+            ensure_user_info(self.user)
+        assert is_pending(self.user)
+
+    def test_middleware(self, mock_userinfo):
+        mark_pending(self.user)
+        middleware = LazyUserInfoMiddleware(lambda request: 'response')
+        request = RequestFactory().get('/')
+        request.user = self.user
+        request.session = {}
+
+        mock_userinfo.side_effect = LDAPSocketOpenError
+        assert middleware(request) == 'response'
+        # tried again on the next request
+        mock_userinfo.side_effect = None
+        middleware(request)
+        assert mock_userinfo.call_count == 2
+        assert not is_pending(self.user)
+        # checked once per session
+        with self.assertNumQueries(0):
+            middleware(request)
+
+        request.user = mock.Mock(is_authenticated=False)
+        middleware(request)
+
+    @mock.patch('pucas.sync.LDAPSearch')
+    @override_settings(PUCAS_LDAP={'ATTRIBUTE_MAP': {'first_name': 'givenName'}})
+    def test_sync(self, mock_ldapsearch, mock_userinfo):
+        other = get_user_model().objects.create(username='jschmoe')
+        get_user_model().objects.create(username='abc123')
+        mark_pending(self.user)
+        mark_pending(other)
+        LDAPSync.objects.create(started=timezone.now(), finished=timezone.now(),
+                                high_water_mark='20260101000000Z')
+        mock_ldapsearch.return_value.find_users.side_effect = [
+            # incremental: no modified entries
+            LDAPBatchResult({}, ['abc123'], []),
+            # pending users
+            LDAPBatchResult({'jdoe': MockLDAPInfo(givenName='John')},
+                            ['jschmoe'], [])]
+        sync, result = run_sync()
+        # pending users are only synced in full
+        assert mock_ldapsearch.return_value.find_users.call_args_list == [
+            mock.call(['abc123'], workers=None,
+                      extra_filter='(modifyTimestamp>=20260101000000Z)',
+                      use_cache=False),
+            mock.call(['jdoe', 'jschmoe'], workers=None, extra_filter=None,
+                      use_cache=False)]
+        assert result == SyncResult(3, 1, 1, 1)
+        assert not is_pending(self.user)
+        assert get_user_model().objects.get(username='jdoe').first_name == \
+            'John'
+        # not found; still pending
+        assert is_pending(other)
+
+
+@mock.patch('pucas.ldap.LDAPSearch')
+@override_settings(PUCAS_LDAP={
+    'ATTRIBUTE_MAP': {'first_name': 'givenName', 'email': 'mail'}})
+class TestAsyncLDAP(TestCase):
+
+    async def test_find_user(self, mock_ldapsearch):
+        mock_ldapsearch.return_value.find_user.return_value = mock.sentinel.info
+        ldap = AsyncLDAPSearch()
+        assert await ldap.find_user('jdoe') == mock.sentinel.info
+        mock_ldapsearch.return_value.find_user.assert_called_with(
+            'jdoe', all_attributes=False)
+        # connection is returned to the pool
+        mock_ldapsearch.return_value.close.assert_called_with()
+
+        # database connections in the worker thread are closed
+        with mock.patch('pucas.ldap.close_old_connections') as mock_close:
+            await ldap.find_user('jdoe')
+        mock_close.assert_called_once_with()
+
+        mock_ldapsearch.return_value.find_users.return_value = \
+            mock.sentinel.results
+        assert await ldap.find_users(['jdoe']) == mock.sentinel.results
+        mock_ldapsearch.return_value.find_users.assert_called_with(
+            ['jdoe'], chunk_size=None, all_attributes=False)
+
+    async def test_ainit_cas_user(self, mock_ldapsearch):
+        mock_ldapsearch.return_value.find_user.return_value = \
+            MockLDAPInfo(givenName='John', mail='jdoe@example.com')
+        user, created = await ainit_cas_user('jdoe')
+        assert created
+        mock_ldapsearch.return_value.find_user.assert_called_once_with(
+            'jdoe', all_attributes=False)
+        user = await sync_to_async(get_user_model().objects.get)(username='jdoe')
+        assert user.first_name == 'John'
+        assert user.email == 'jdoe@example.com'
+
+        # existing user, with entry passed in
+        user, created = await ainit_cas_user(
+            'jdoe', user_info=MockLDAPInfo(givenName='Jon', mail='jd@example.com'))
+        assert not created
+        assert mock_ldapsearch.return_value.find_user.call_count == 1
+        user = await sync_to_async(get_user_model().objects.get)(username='jdoe')
+        assert user.first_name == 'Jon'
+
+    async def test_auser_info_from_ldap(self, mock_ldapsearch):
+        user = await sync_to_async(get_user_model().objects.create)(
+            username='jdoe')
+        ldap = mock.Mock()
+
+        async def find_user(netid):
+            return MockLDAPInfo(givenName='John')
+        ldap.find_user = find_user
+        await auser_info_from_ldap(user, ldap=ldap)
+        mock_ldapsearch.assert_not_called()
+        await sync_to_async(user.refresh_from_db)()
+        assert user.first_name == 'John'
+        assert user.email == ''
+
+        with override_settings(PUCAS_LDAP={}):
+            await auser_info_from_ldap(user)
+        mock_ldapsearch.assert_not_called()
+
+
 class TestCasUserInitForm(TestCase):
 
     def test_valid_single_netid(self):
@@ -413,6 +2243,12 @@ class TestCasUserInitForm(TestCase):
         form = CasUserInitForm(data={"netids": ""})
         assert not form.is_valid()
 
+    def test_duplicate_netids(self):
+        form = CasUserInitForm(data={"netids": "jdoe jschmoe\njdoe"})
+        assert form.is_valid()
+        assert form.cleaned_data["netids"] == ["jdoe", "jschmoe"]
+        assert form.cleaned_data["refresh_existing"] is False
+
 
 class TestCasUserAdmin(TestCase):
 
@@ -421,7 +2257,7 @@ class TestCasUserAdmin(TestCase):
         self.admin = CasUserAdmin(get_user_model(), self.site)
         self.factory = RequestFactory()
 
-    @mock.patch("pucas.admin.init_cas_user")
+    @mock.patch("pucas.admin.bulk_init_cas_users")
     def test_get_renders_form(self, mock_init):
         request = self.factory.get("/admin/users/user/cas-init/")
         request.user = mock.Mock(is_active=True, is_staff=True)
@@ -434,11 +2270,9 @@ class TestCasUserAdmin(TestCase):
         assert response.status_code == 200
         assert isinstance(response.context_data["form"], CasUserInitForm)
 
-    @mock.patch("pucas.admin.LDAPSearch")
-    @mock.patch("pucas.admin.init_cas_user")
-    def test_post_creates_new_user(self, mock_init, mock_ldapsearch):
-        mock_user = mock.Mock()
-        mock_init.return_value = (mock_user, True)
+    @mock.patch("pucas.admin.bulk_init_cas_users")
+    def test_post_creates_new_user(self, mock_init):
+        mock_init.return_value = BulkInitResult(["jdoe"], [], [], [])
         request = self.factory.post(
             "/admin/users/user/cas-init/", data={"netids": "jdoe"}
         )
@@ -448,17 +2282,17 @@ class TestCasUserAdmin(TestCase):
         request._messages = FallbackStorage(request)
 
         response = self.admin.cas_user_init(request)
-        mock_init.assert_called_once_with("jdoe", ldap=mock_ldapsearch.return_value)
         # newly created accounts should be activated by the admin
-        assert mock_user.is_active is True
-        mock_user.save.assert_called()
+        mock_init.assert_called_once_with(["jdoe"], activate_created=True,
+                                          use_cache=True)
+        assert "Created accounts: jdoe" in \
+            [str(msg) for msg in request._messages]
         # should redirect back to changelist
         assert response.status_code == 302
 
-    @mock.patch("pucas.admin.LDAPSearch")
-    @mock.patch("pucas.admin.init_cas_user")
-    def test_post_existing_user(self, mock_init, mock_ldapsearch):
-        mock_init.return_value = (mock.Mock(), False)
+    @mock.patch("pucas.admin.bulk_init_cas_users")
+    def test_post_existing_user(self, mock_init):
+        mock_init.return_value = BulkInitResult([], ["jdoe"], [], [])
         request = self.factory.post(
             "/admin/users/user/cas-init/", data={"netids": "jdoe"}
         )
@@ -468,15 +2302,69 @@ class TestCasUserAdmin(TestCase):
         request._messages = FallbackStorage(request)
 
         response = self.admin.cas_user_init(request)
-        mock_init.assert_called_once_with("jdoe", ldap=mock_ldapsearch.return_value)
+        mock_init.assert_called_once_with(["jdoe"], activate_created=True,
+                                          use_cache=True)
+        assert "Already exists: jdoe" in \
+            [str(msg) for msg in request._messages]
         assert response.status_code == 302
 
-    @mock.patch("pucas.admin.LDAPSearch")
-    @mock.patch("pucas.admin.init_cas_user")
-    def test_post_ldap_not_found(self, mock_init, mock_ldapsearch):
-        mock_init.side_effect = LDAPSearchException("not found")
+    @mock.patch("pucas.admin.bulk_init_cas_users")
+    def test_post_skips_existing_users(self, mock_init):
+        get_user_model().objects.create(username="jdoe")
+        mock_init.return_value = BulkInitResult(["jschmoe"], [], [], [])
+        request = self.factory.post(
+            "/admin/users/user/cas-init/", data={"netids": "jdoe jschmoe jdoe"}
+        )
+        request.user = mock.Mock(is_active=True, is_staff=True)
+        request.session = {}
+        from django.contrib.messages.storage.fallback import FallbackStorage
+        request._messages = FallbackStorage(request)
+
+        self.admin.cas_user_init(request)
+        # existing accounts are not looked up in LDAP
+        mock_init.assert_called_once_with(["jschmoe"], activate_created=True,
+                                          use_cache=True)
+        msgs = [str(msg) for msg in request._messages]
+        assert "Created accounts: jschmoe" in msgs
+        assert "Already exists: jdoe" in msgs
+
+        # no LDAP lookups at all when every account exists
+        mock_init.reset_mock()
+        request = self.factory.post(
+            "/admin/users/user/cas-init/", data={"netids": "jdoe"}
+        )
+        request.user = mock.Mock(is_active=True, is_staff=True)
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        self.admin.cas_user_init(request)
+        mock_init.assert_not_called()
+
+    @mock.patch("pucas.admin.bulk_init_cas_users")
+    def test_post_refresh_existing(self, mock_init):
+        get_user_model().objects.create(username="jdoe")
+        mock_init.return_value = BulkInitResult(["jschmoe"], ["jdoe"], [], [])
+        request = self.factory.post(
+            "/admin/users/user/cas-init/",
+            data={"netids": "jdoe jschmoe", "refresh_existing": "on"}
+        )
+        request.user = mock.Mock(is_active=True, is_staff=True)
+        request.session = {}
+        from django.contrib.messages.storage.fallback import FallbackStorage
+        request._messages = FallbackStorage(request)
+
+        self.admin.cas_user_init(request)
+        # cached entries are not used when refreshing
+        mock_init.assert_called_once_with(["jdoe", "jschmoe"],
+                                          activate_created=True,
+                                          use_cache=False)
+        assert "Updated from LDAP: jdoe" in \
+            [str(msg) for msg in request._messages]
+
+    @mock.patch("pucas.admin.bulk_init_cas_users")
+    def test_post_ldap_not_found(self, mock_init):
+        mock_init.return_value = BulkInitResult([], [], ["unknown"], ["dupe"])
         request = self.factory.post(
-            "/admin/users/user/cas-init/", data={"netids": "unknown"}
+            "/admin/users/user/cas-init/", data={"netids": "unknown dupe"}
         )
         request.user = mock.Mock(is_active=True, is_staff=True)
         request.session = {}
@@ -484,10 +2372,12 @@ class TestCasUserAdmin(TestCase):
         request._messages = FallbackStorage(request)
 
         response = self.admin.cas_user_init(request)
+        assert "NetIDs not found in LDAP: unknown, dupe" in \
+            [str(msg) for msg in request._messages]
         # still redirects; error shown via message_user
         assert response.status_code == 302
 
-    @mock.patch("pucas.admin.init_cas_user")
+    @mock.patch("pucas.admin.bulk_init_cas_users")
     def test_post_invalid_netid_does_not_call_init(self, mock_init):
         request = self.factory.post(
             "/admin/users/user/cas-init/", data={"netids": "j doe!"}
@@ -502,6 +2392,61 @@ class TestCasUserAdmin(TestCase):
         # invalid form re-renders, no redirect
         assert response.status_code == 200
 
+    @mock.patch("pucas.admin.start_init_job")
+    @mock.patch("pucas.admin.bulk_init_cas_users")
+    @override_settings(PUCAS_LDAP={"ADMIN_BACKGROUND_THRESHOLD": 2})
+    def test_post_large_submission(self, mock_init, mock_start):
+        User = get_user_model()
+        User.objects.create(username="jdoe")
+        admin_user = User.objects.create(username="admin", is_staff=True)
+        request = self.factory.post(
+            "/admin/users/user/cas-init/",
+            data={"netids": "jdoe jschmoe abc123 xyz789"}
+        )
+        request.user = admin_user
+        request.session = {}
+        from django.contrib.messages.storage.fallback import FallbackStorage
+        request._messages = FallbackStorage(request)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.admin.cas_user_init(request)
+        # queued as a background job instead of initialized now
+        mock_init.assert_not_called()
+        job = CasUserInitJob.objects.get()
+        mock_start.assert_called_once_with(job)
+        assert job.netid_list() == ["jschmoe", "abc123", "xyz789"]
+        assert job.total == 3
+        assert job.results()["existing"] == ["jdoe"]
+        assert job.requested_by == admin_user
+        assert response.status_code == 302
+        assert response.url == "%d/" % job.pk
+
+        # progress page
+        request = self.factory.get("/admin/users/user/cas-init/%d/" % job.pk)
+        request.user = admin_user
+        response = self.admin.cas_user_init_job(request, job.pk)
+        assert response.status_code == 200
+        assert response.template_name == "admin/pucas/cas_user_init_job.html"
+        assert response.context_data["job"] == job
+        assert not job.is_finished
+        mock_start.assert_called_once_with(job)
+
+        # restarted if it has stalled
+        CasUserInitJob.objects.filter(pk=job.pk).update(
+            updated=timezone.now() - timedelta(seconds=601))
+        with mock.patch("pucas.tasks.start_init_job") as mock_restart:
+            self.admin.cas_user_init_job(request, job.pk)
+        mock_restart.assert_called_once_with(job)
+
+        job.status = CasUserInitJob.DONE
+        job.created_netids = "jschmoe\nabc123"
+        job.not_found_netids = "xyz789"
+        job.save()
+        response = self.admin.cas_user_init_job(request, job.pk)
+        assert response.context_data["job"].is_finished
+        assert response.context_data["results"]["created"] == \
+            ["jschmoe", "abc123"]
+
     def test_change_list_template(self):
         assert self.admin.change_list_template == "admin/pucas/user_change_list.html"
 
@@ -509,3 +2454,4 @@ class TestCasUserAdmin(TestCase):
         urls = self.admin.get_urls()
         url_names = [u.name for u in urls if hasattr(u, 'name')]
         assert "users_user_cas_init" in url_names
+        assert "users_user_cas_init_job" in url_names